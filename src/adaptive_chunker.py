@@ -0,0 +1,125 @@
+import json
+import threading
+
+# BigQuery caps a query request, parameters included, at 10 MB;
+# stay under it with some margin.
+PARAMETER_BYTES_LIMIT = 8 * 1024 ** 2
+TOO_LARGE_MARKERS = ('too large', 'resources exceeded', 'resourcesexceeded',
+                     'responsetoolarge', 'exceeds the maximum',
+                     'request payload size exceeds')
+
+
+def estimate_item_bytes(items, sample_size=1000):
+    """
+    Estimate the bytes each item adds to a query request, from a sample
+    of items. Array parameters send every value as a JSON object,
+    {"value": "..."}, followed by a separator.
+    """
+    sample = items[:sample_size]
+    if len(sample) == 0:
+        return 1
+    total = sum(len(json.dumps({'value': str(item)}).encode('utf-8')) + 2
+                for item in sample)
+    return max(1, -(-total // len(sample)))
+
+
+def is_too_large(error):
+    """ Helper function to spot errors a smaller chunk would avoid"""
+    message = str(error).lower()
+    return any(marker in message for marker in TOO_LARGE_MARKERS)
+
+
+class AdaptiveChunker:
+    """
+    Chunks a list for querying, adapting the chunk size as jobs finish.
+
+    The starting size is the largest whose items fit in max_bytes. Jobs
+    finishing in under half of target_seconds grow the next chunks by
+    growth, jobs taking over twice as long shrink them, and a chunk which
+    fails as too large is split in half and retried. Chunks are handed
+    out lazily, so every chunk is sized from the latest observations.
+
+    Parameters
+    ----------
+    items : list
+        items to chunk
+    initial_size : int, optional
+        starting chunk size, capped by the byte limit
+    max_bytes : int
+        budget for the items of one chunk in the query or its parameters
+    target_seconds : float
+        job runtime chunks are sized towards
+    min_size : int
+        smallest chunk size
+    growth : float
+        factor chunks grow by after a fast job
+
+    """
+
+    def __init__(self, items, initial_size=None,
+                 max_bytes=PARAMETER_BYTES_LIMIT, target_seconds=120,
+                 min_size=1, growth=1.5):
+        self.items = items
+        self.max_size = max(min_size, max_bytes // estimate_item_bytes(items))
+        self.size = self.max_size if initial_size is None else \
+            max(min_size, min(initial_size, self.max_size))
+        self.target_seconds = target_seconds
+        self.min_size = min_size
+        self.growth = growth
+        self.jobs = 0
+        self.splits = 0
+        self.seconds = 0.0
+        self.bytes_processed = 0
+        self.lock = threading.Lock()
+
+    def chunks(self):
+        """ Generator of chunks, each sized when it is requested"""
+        position = 0
+        while position < len(self.items):
+            with self.lock:
+                size = self.size
+            yield self.items[position:position + size]
+            position += size
+
+    def record(self, seconds=None, bytes_processed=None):
+        """Adapt the chunk size to the runtime of a finished job."""
+        with self.lock:
+            self.jobs += 1
+            self.bytes_processed += bytes_processed or 0
+            if seconds is None:
+                return
+            self.seconds += seconds
+            if seconds < self.target_seconds / 2:
+                self.size = min(self.max_size,
+                                max(self.size + 1, int(self.size * self.growth)))
+            elif seconds > self.target_seconds * 2:
+                self.size = max(self.min_size, self.size // 2)
+
+    def record_job(self, query_job):
+        """Record a finished BigQuery job from its timings and bytes."""
+        seconds = None
+        if getattr(query_job, 'started', None) and \
+                getattr(query_job, 'ended', None):
+            seconds = (query_job.ended - query_job.started).total_seconds()
+        self.record(seconds, getattr(query_job, 'total_bytes_processed', None))
+
+    def split(self, chunk):
+        """
+        Halve a chunk which failed as too large, shrinking later chunks too.
+
+        :return: the two halves of the chunk
+        """
+        half = max(1, len(chunk) // 2)
+        with self.lock:
+            self.splits += 1
+            self.size = max(self.min_size, min(self.size, half))
+            self.max_size = max(self.min_size, min(self.max_size, half))
+        return [chunk[:half], chunk[half:]]
+
+    def stats(self):
+        with self.lock:
+            return {'chunk_size': self.size,
+                    'jobs': self.jobs,
+                    'splits': self.splits,
+                    'seconds': round(self.seconds, 1),
+                    'bytes_processed': self.bytes_processed}
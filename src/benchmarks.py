@@ -0,0 +1,545 @@
+import os
+import re
+import gc
+import ast
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import traceback
+import multiprocessing
+from functools import cached_property
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from loguru import logger
+
+from citation_graph import CitationGraph
+from coverage import coverage_report
+from checkpoint import Checkpoint
+from fakes import FakeBigQueryClient, ScopusStandIn
+from gbq_collector import save_file, get_all_data, YEAR_PARTITIONING, \
+    conform_batch, get_refs_and_cites_server_side
+from helper_functions import build_spine
+from instrumentation import metrics
+from issn_index import load_or_build_issn_index, decode_issns
+from key_scheduler import KeyScheduler
+from pub_ids import get_all_refs, get_all_citations
+from response_cache import CachedResponse
+from result_sink import make_sink
+from scopus_counter import call_scopus_search_api, parse_scopus_returns, \
+    run_harvest, make_scopus_urls, SCOPUS_COLUMNS
+
+COUNTRIES = np.array(['United States', 'Brazil', 'Indonesia', 'Spain',
+                      'Canada', 'Germany', 'India', 'Mexico', 'Colombia',
+                      'United Kingdom', 'Nigeria', 'Ukraine'], dtype=object)
+FIRST_DAY = np.datetime64('2018-01-01', 'D').astype(np.int64)
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+MAXRSS_BYTES = 1 if sys.platform == 'darwin' else 1024
+
+
+def legacy_get_all_refs(df):
+    """ get_all_refs as it was before vectorisation, kept for comparison"""
+    all_refs = []
+    for element in df['reference_ids'].to_list():
+        element = element.replace('\n','')
+        element = element.replace('[', '')
+        element = element.replace(']', '')
+        element = element.replace("'", '')
+        element = element.split(' ')
+        for ele in element:
+            if len(ele) > 0:
+                all_refs.append(ele)
+    return list(set(all_refs))
+
+
+def legacy_get_all_citations(df):
+    """ get_all_citations as it was before vectorisation, kept for comparison"""
+    all_citations = []
+    for element in df['citations'].to_list():
+        if len(element) > 2:
+            for ele in element.split('\n'):
+                x = ast.literal_eval(re.search('({.+})', ele).group(0))
+                all_citations.append(x['id'])
+    return list(set(all_citations))
+
+
+def make_pub_frame(rows, refs_per_pub=20, cites_per_pub=10, seed=0):
+    """
+    Build a synthetic publication frame in the legacy csv string format,
+    with reference and citation ids drawn from a shared pool so that
+    duplicates occur as they do in real dumps.
+    """
+    rng = np.random.default_rng(seed)
+    pool = np.array([f'pub.{n}' for n in
+                     rng.integers(1_000_000_000, 1_200_000_000, rows * 5)])
+    reference_ids, citations = [], []
+    for row in range(rows):
+        refs = pool[rng.integers(0, len(pool), rng.poisson(refs_per_pub))]
+        reference_ids.append(str(refs))
+        cites = pool[rng.integers(0, len(pool), rng.poisson(cites_per_pub))]
+        citations.append('[' + '\n '.join(repr({'id': str(cite), 'year': 2020})
+                                           for cite in cites) + ']')
+    return pd.DataFrame({'id': pool[:rows],
+                         'reference_ids': reference_ids,
+                         'citations': citations})
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_extraction(rows):
+    """ Compare the legacy and vectorised pub id extraction"""
+    df = make_pub_frame(rows)
+    for name, legacy, vectorised in [
+            ('refs', legacy_get_all_refs, get_all_refs),
+            ('citations', legacy_get_all_citations, get_all_citations)]:
+        old, old_seconds = timed(legacy, df)
+        new, new_seconds = timed(vectorised, df)
+        assert set(old) == set(new), f'{name}: extracted ids differ'
+        print(f'{name:>10} {rows:>9} rows: legacy {old_seconds:8.3f}s, '
+              f'vectorised {new_seconds:8.3f}s, '
+              f'speedup {old_seconds / new_seconds:6.1f}x')
+
+
+def issn_check_values(digits):
+    """ Helper function to compute ISSN check values, X counting as 10"""
+    total = np.zeros(len(digits), dtype=np.int64)
+    for weight in range(2, 9):
+        total += (digits % 10) * weight
+        digits = digits // 10
+    return (11 - total % 11) % 11
+
+
+def make_issn_pairs(issn_ls, seed=0):
+    """
+    Build an ISSN-to-ISSN-L table of issn_ls groups of one to three
+    distinct, valid ISSNs each, the first of which is the ISSN-L.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, 4, issn_ls)
+    digits = rng.permutation(10_000_000)[:sizes.sum()]
+    keys = digits * 11 + issn_check_values(digits)
+    first = np.repeat(np.cumsum(sizes) - sizes, sizes)
+    issns = decode_issns(keys)
+    return pd.DataFrame({'ISSN': issns, 'ISSN-L': issns[first]})
+
+
+def make_issn_inputs(rows, issns, seed=0):
+    """
+    Build an OJS ISSN list drawn from known ISSNs, with the messiness of
+    the real one: lower case, missing hyphens, stray spaces and a few
+    malformed values.
+    """
+    rng = np.random.default_rng(seed)
+    values = pd.Series(issns[rng.integers(0, len(issns), rows)], dtype=str)
+    noise = rng.random(rows)
+    values[noise < 0.05] = values[noise < 0.05].str.replace('-', '')
+    values[(noise >= 0.05) & (noise < 0.08)] = ' ' + \
+        values[(noise >= 0.05) & (noise < 0.08)].str.lower()
+    values[noise >= 0.98] = 'n/a'
+    return pd.DataFrame({'issn_ojs': values})
+
+
+def make_list_array(values, counts):
+    """ Helper function to group values into lists of the given lengths"""
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+    return pa.ListArray.from_arrays(pa.array(offsets), values)
+
+
+def make_publications(rows, issns, refs_per_pub=10, cites_per_pub=5, seed=0):
+    """
+    Build a publications Table in the shape gbq_collector saves it, with
+    native list columns, referencing and citing a pool of twice as many
+    pubs so that expansion has ids it has not seen.
+    """
+    rng = np.random.default_rng(seed)
+    pool = pa.array(('pub.' + pd.Series(np.arange(1_000_000_000,
+                                                  1_000_000_000 + 2 * rows))
+                     .astype(str)).to_numpy(object), pa.string())
+    ids = pool.slice(0, rows)
+    ref_counts = rng.poisson(refs_per_pub, rows)
+    references = pool.take(pa.array(rng.integers(0, len(pool),
+                                                 ref_counts.sum())))
+    cite_counts = rng.poisson(cites_per_pub, rows)
+    citations = pa.StructArray.from_arrays(
+        [pool.take(pa.array(rng.integers(0, len(pool), cite_counts.sum()))),
+         pa.array(rng.integers(2000, 2024, cite_counts.sum()))],
+        names=['id', 'year'])
+    country_counts = rng.integers(0, 4, rows)
+    countries = pa.array(COUNTRIES[rng.integers(0, len(COUNTRIES),
+                                                country_counts.sum())],
+                         pa.string())
+    issn = issns[rng.integers(0, len(issns), rows)]
+    eissn = np.where(rng.random(rows) < 0.3, None,
+                     issns[rng.integers(0, len(issns), rows)])
+    days = FIRST_DAY + rng.integers(0, 5 * 365, rows)
+    return pa.table({
+        'id': ids,
+        'reference_ids': make_list_array(references, ref_counts),
+        'citations': make_list_array(citations, cite_counts),
+        'doi': pa.array(('10.5555/' + pd.Series(ids.to_numpy(
+            zero_copy_only=False))).to_numpy(object), pa.string()),
+        'issn': pa.array(issn, pa.string()),
+        'eissn': pa.array(eissn, pa.string()),
+        'type': pa.array(np.where(rng.random(rows) < 0.95, 'article',
+                                  'chapter').astype(object), pa.string()),
+        'date_normal': pa.array(days.astype(np.int32), pa.date32()),
+        'research_org_country_names': make_list_array(countries,
+                                                      country_counts)})
+
+
+def scopus_responses(issn, stand_in):
+    """ Helper function to answer an ISSN's three calls without a server"""
+    responses = []
+    for url in make_scopus_urls(issn):
+        parts = urlsplit(url)
+        status, body = stand_in.answer(parts.path, parse_qs(parts.query))
+        responses.append(CachedResponse(url, status, {},
+                                        json.dumps(body).encode('utf-8')))
+    return responses
+
+
+class Fixtures:
+    """
+    Synthetic inputs for one scale, built on first use. With fixture_dir
+    they are recorded there as parquet the first time and read back on
+    later runs, so large scales are only generated once.
+
+    Parameters
+    ----------
+    rows : int
+        scale of the fixtures: rows of publications and of OJS ISSNs
+    fixture_dir : str, optional
+        directory recorded fixtures are kept in
+    http_rows : int
+        ISSNs harvested over HTTP, which is far slower than the rest
+
+    """
+
+    def __init__(self, rows, fixture_dir=None, http_rows=2000):
+        self.rows = rows
+        self.fixture_dir = fixture_dir
+        self.http_rows = http_rows
+
+    def recorded(self, name, make):
+        """
+        Helper function to read a recorded fixture, or make and record it.
+        DataFrames are read back as DataFrames, Tables as Tables.
+        """
+        if self.fixture_dir is None:
+            return make()
+        path = os.path.join(self.fixture_dir, f'{name}_{self.rows}.parquet')
+        if not os.path.exists(path):
+            os.makedirs(self.fixture_dir, exist_ok=True)
+            fixture = make()
+            if isinstance(fixture, pd.DataFrame):
+                fixture.to_parquet(path, index=False)
+                return fixture
+            pq.write_table(fixture, path)
+            return fixture
+        table = pq.read_table(path)
+        if table.schema.pandas_metadata is not None:
+            return table.to_pandas()
+        return table
+
+    @cached_property
+    def issn_pairs(self):
+        # about one ISSN-L per three OJS rows, capped by the ISSN space
+        issn_ls = min(max(self.rows // 3, 10), 2_000_000)
+        return self.recorded('issn_pairs', lambda: make_issn_pairs(issn_ls))
+
+    @cached_property
+    def issns(self):
+        return self.issn_pairs['ISSN'].to_numpy(object)
+
+    @cached_property
+    def issn_inputs(self):
+        return self.recorded('issn_inputs',
+                             lambda: make_issn_inputs(self.rows, self.issns))
+
+    @cached_property
+    def publications(self):
+        return self.recorded('publications',
+                             lambda: make_publications(self.rows, self.issns))
+
+    @cached_property
+    def legacy_pubs(self):
+        return self.recorded('legacy_pubs', lambda: make_pub_frame(self.rows))
+
+    def issn_to_issn_l_file(self, directory):
+        path = os.path.join(directory, 'ISSN-to-ISSN-L.txt')
+        if not os.path.exists(path):
+            self.issn_pairs.to_csv(path, sep='\t', index=False)
+        return path
+
+    def publications_dataset(self, directory):
+        path = os.path.join(directory, 'pubs_from_all_issns.parquet')
+        if not os.path.exists(path):
+            ds.write_dataset([conform_batch(batch) for batch in
+                              self.publications.to_batches(100_000)],
+                             path, format='parquet',
+                             partitioning=YEAR_PARTITIONING)
+        return path
+
+
+# Every stage builds its inputs up front and returns a function of a fresh
+# working directory, timed on its own, and the number of items it handles
+
+def stage_refs(fixtures, shared):
+    pubs = fixtures.legacy_pubs
+    return lambda workdir: get_all_refs(pubs), len(pubs)
+
+
+def stage_citations(fixtures, shared):
+    pubs = fixtures.legacy_pubs
+    return lambda workdir: get_all_citations(pubs), len(pubs)
+
+
+def stage_issn_index(fixtures, shared):
+    path = fixtures.issn_to_issn_l_file(shared)
+    return (lambda workdir: load_or_build_issn_index(
+        os.path.join(workdir, 'index'), path), len(fixtures.issn_pairs))
+
+
+def stage_build_spine(fixtures, shared):
+    index = load_or_build_issn_index(os.path.join(shared, 'index'),
+                                     fixtures.issn_to_issn_l_file(shared))
+    issn_inputs = fixtures.issn_inputs
+    return (lambda workdir: build_spine(
+        issn_inputs, index, os.path.join(workdir, 'merged_OJS_spine.csv')),
+            len(issn_inputs))
+
+
+def stage_save_file(fixtures, shared):
+    frame = fixtures.publications.to_pandas()
+    return (lambda workdir: save_file(frame, os.path.join(workdir, 'pubs.csv')),
+            fixtures.rows)
+
+
+def stage_get_all_data(fixtures, shared):
+    client = FakeBigQueryClient(fixtures.publications)
+    issns = fixtures.issn_inputs['issn_ojs'].dropna().astype(str).tolist()
+    return (lambda workdir: get_all_data(
+        None, os.path.join(workdir, 'pubs.parquet'), client, issns, 'issn',
+        output_format='parquet'), fixtures.rows)
+
+
+def stage_expand_server_side(fixtures, shared):
+    client = FakeBigQueryClient(fixtures.publications)
+    issns = fixtures.issn_inputs['issn_ojs'].dropna().astype(str).tolist()
+    return (lambda workdir: get_refs_and_cites_server_side(
+        issns, workdir, client, 'benchmark.scratch', 'parquet'),
+            fixtures.rows)
+
+
+def stage_coverage(fixtures, shared):
+    path = fixtures.publications_dataset(shared)
+    issn_inputs = fixtures.issn_inputs
+    return lambda workdir: coverage_report(issn_inputs, path), fixtures.rows
+
+
+def stage_citation_graph(fixtures, shared):
+    publications = fixtures.publications
+    return (lambda workdir: CitationGraph.from_publications(
+        [publications]).save(os.path.join(workdir, 'graph')),
+            publications.num_rows)
+
+
+def stage_scopus_parse_write(fixtures, shared):
+    stand_in = ScopusStandIn()
+    issns = fixtures.issns[:fixtures.rows]
+    responses = [scopus_responses(issn, stand_in) for issn in issns]
+
+    def run(workdir):
+        with make_sink(os.path.join(workdir, 'scopus_counts.csv'),
+                       SCOPUS_COLUMNS) as sink:
+            for issn, api_returns in zip(issns, responses):
+                sink.write(parse_scopus_returns(issn, *api_returns), item=issn)
+    return run, len(issns)
+
+
+def stage_scopus_harvest(fixtures, shared, keys=2):
+    issns = fixtures.issns[:fixtures.http_rows].tolist()
+
+    def run(workdir):
+        csv_file_path = os.path.join(workdir, 'scopus_counts.csv')
+        checkpoint = Checkpoint(os.path.join(workdir, 'checkpoint.sqlite'))
+        scheduler = KeyScheduler([f'benchmark-key-{n}' for n in range(keys)],
+                                 call=call_scopus_search_api, rate=1000)
+        with ScopusStandIn(quota=1000) as stand_in, \
+                make_sink(csv_file_path, SCOPUS_COLUMNS,
+                          on_flush=checkpoint.mark_done) as sink:
+            run_harvest(issns, scheduler, checkpoint, sink,
+                        base_url=stand_in.base_url)
+        checkpoint.close()
+    return run, len(issns)
+
+
+STAGES = {
+    'refs': stage_refs,
+    'citations': stage_citations,
+    'issn_index': stage_issn_index,
+    'build_spine': stage_build_spine,
+    'save_file': stage_save_file,
+    'get_all_data': stage_get_all_data,
+    'expand_server_side': stage_expand_server_side,
+    'coverage': stage_coverage,
+    'citation_graph': stage_citation_graph,
+    'scopus_parse_write': stage_scopus_parse_write,
+    'scopus_harvest': stage_scopus_harvest,
+}
+
+
+def peak_growth(run, workdir, connection):
+    """
+    Helper function to run a stage in a forked process and send back how
+    far the process's peak resident set grew, in bytes, or the error
+    """
+    try:
+        gc.collect()
+        start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        run(workdir)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        connection.send((peak - start) * MAXRSS_BYTES)
+    except BaseException:
+        connection.send(traceback.format_exc())
+    finally:
+        connection.close()
+
+
+def measure(run, items, root, memory=True):
+    """
+    Time a stage, then run it again in a forked process for its peak
+    memory: the growth of the process's peak resident set, which counts
+    Arrow's memory pool and every other native allocation along with
+    Python's. The fork starts with the fixtures already in memory, and a
+    fresh peak, so stages measured earlier do not mask later ones.
+
+    :param run: function taking a fresh working directory
+    :param items: number of items the stage processes
+    :return: dict of seconds, items per second and peak MiB
+    """
+    # the stages count into the global registry, which would otherwise
+    # grow with every stage measured
+    metrics.reset()
+    gc.collect()
+    workdir = tempfile.mkdtemp(dir=root)
+    start = time.perf_counter()
+    run(workdir)
+    seconds = time.perf_counter() - start
+    result = {'items': items,
+              'seconds': round(seconds, 4),
+              'items_per_second': round(items / seconds, 1)}
+    if memory:
+        workdir = tempfile.mkdtemp(dir=root)
+        context = multiprocessing.get_context('fork')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=peak_growth,
+                                  args=(run, workdir, sender))
+        process.start()
+        sender.close()
+        peak = receiver.recv()
+        process.join()
+        if isinstance(peak, str):
+            raise RuntimeError(f'Stage failed in the memory run:\n{peak}')
+        result['peak_mib'] = round(peak / 1024 ** 2, 1)
+    return result
+
+
+def run_benchmarks(scales, stages=None, fixture_dir=None, memory=True,
+                   http_rows=2000):
+    """
+    Run every stage at every scale against synthetic fixtures and fakes.
+
+    :return: list of result dicts with stage and rows
+    """
+    results = []
+    for rows in scales:
+        fixtures = Fixtures(rows, fixture_dir, http_rows)
+        with tempfile.TemporaryDirectory() as root:
+            shared = tempfile.mkdtemp(dir=root)
+            for name in stages or STAGES:
+                run, items = STAGES[name](fixtures, shared)
+                result = {'stage': name, 'rows': rows,
+                          **measure(run, items, root, memory)}
+                print(f'{name:>20} {rows:>9} rows: {result["seconds"]:9.3f}s '
+                      f'{result["items_per_second"]:>12.1f}/s '
+                      f'peak {result.get("peak_mib", "-")} MiB',
+                      flush=True)
+                results.append(result)
+    return results
+
+
+def find_regressions(results, baseline, tolerance=0.2):
+    """
+    Compare results with a baseline run of the same stages and scales.
+
+    :return: list of (stage, rows, baseline seconds, seconds) for stages
+             slower than the baseline by more than tolerance
+    """
+    previous = {(result['stage'], result['rows']): result['seconds']
+                for result in baseline}
+    regressions = []
+    for result in results:
+        key = (result['stage'], result['rows'])
+        if key in previous and \
+                result['seconds'] > previous[key] * (1 + tolerance):
+            regressions.append((*key, previous[key], result['seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline '
+                                                 'stages offline')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000],
+                        help='scales to run, e.g. 10000 1000000 10000000')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES),
+                        help='stages to run, by default all')
+    parser.add_argument('--fixtures',
+                        help='directory to record and reuse fixtures in')
+    parser.add_argument('--http-rows', type=int, default=2000,
+                        help='ISSNs harvested from the local Scopus stand-in')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the forked peak memory run of every stage')
+    parser.add_argument('--legacy', action='store_true',
+                        help='also compare pub id extraction with the '
+                             'legacy implementation')
+    parser.add_argument('--output', help='write the results to a json file')
+    parser.add_argument('--baseline', help='json results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown over the baseline reported as a '
+                             'regression')
+    args = parser.parse_args()
+    logger.disable('scopus_counter')
+    logger.disable('key_scheduler')
+    if args.legacy:
+        for rows in args.rows:
+            bench_extraction(rows)
+    results = run_benchmarks(args.rows, args.stages, args.fixtures,
+                             not args.no_memory, args.http_rows)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file),
+                                           args.tolerance)
+        for stage, rows, before, after in regressions:
+            print(f'Regression: {stage} at {rows} rows took {after:.3f}s, '
+                  f'{before:.3f}s in the baseline')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
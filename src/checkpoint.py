@@ -0,0 +1,93 @@
+import time
+import sqlite3
+
+
+class Checkpoint:
+    """
+    Small SQLite log of which items of a long run are done or have failed.
+
+    Every item is either 'done' or 'failed'; failed items form a retry
+    queue together with the number of attempts made on them, so that a
+    restarted run skips completed work and only retries what failed.
+
+    Parameters
+    ----------
+    path : str
+        location of the SQLite file, created if it does not exist
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                item TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL NOT NULL)""")
+        self.connection.commit()
+
+    def completed(self):
+        """Return the set of items which have been marked done."""
+        rows = self.connection.execute(
+            "SELECT item FROM items WHERE status = 'done'")
+        return {row[0] for row in rows}
+
+    def retry_queue(self, max_attempts=None):
+        """
+        Return the failed items in the order they first failed.
+
+        :param max_attempts: leave out items which have already been
+                             tried this many times
+        :return: a list of items
+        """
+        query = "SELECT item FROM items WHERE status = 'failed'"
+        parameters = ()
+        if max_attempts is not None:
+            query += ' AND attempts < ?'
+            parameters = (max_attempts,)
+        rows = self.connection.execute(query + ' ORDER BY rowid', parameters)
+        return [row[0] for row in rows]
+
+    def given_up(self, max_attempts):
+        """Return the set of failed items tried at least max_attempts times."""
+        rows = self.connection.execute(
+            "SELECT item FROM items WHERE status = 'failed' AND attempts >= ?",
+            (max_attempts,))
+        return {row[0] for row in rows}
+
+    def mark_done(self, items):
+        """Record items as done, clearing any earlier failure."""
+        now = time.time()
+        self.connection.executemany("""
+            INSERT INTO items (item, status, attempts, updated)
+            VALUES (?, 'done', 1, ?)
+            ON CONFLICT (item) DO UPDATE SET
+                status = 'done', error = NULL,
+                attempts = attempts + 1, updated = excluded.updated""",
+                                    [(str(item), now) for item in items])
+        self.connection.commit()
+
+    def mark_failed(self, item, error=None):
+        """Put an item on the retry queue, counting the attempt."""
+        self.connection.execute("""
+            INSERT INTO items (item, status, attempts, error, updated)
+            VALUES (?, 'failed', 1, ?, ?)
+            ON CONFLICT (item) DO UPDATE SET
+                status = 'failed', error = excluded.error,
+                attempts = attempts + 1, updated = excluded.updated""",
+                                (str(item), error, time.time()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,274 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from coverage import returns_batches, column_or_nulls, journal_keys
+from issn_index import encode_issns, decode_issns, MISSING
+from pub_ids import CITATION_ID
+
+GRAPH_FIELDS = ['id', 'reference_ids', 'citations', 'issn', 'eissn']
+# Legacy csv dumps hold reference_ids as the repr of a numpy array
+REFERENCE_ID = r"'([^']+)'"
+
+
+def hash_ids(ids):
+    """ Helper function to hash pub id strings to 64-bit integers"""
+    return pd.util.hash_array(np.asarray(ids, dtype=object))
+
+
+def linked_ids(column, field=None, pattern=REFERENCE_ID):
+    """
+    Explode a reference_ids or citations column into (row, pub id) pairs.
+
+    :param column: native list column, or legacy stringified column
+    :param field: struct field holding the id in list<struct> columns
+    :param pattern: regex pulling the ids out of legacy strings
+    :return: (row of every id, pyarrow array of ids)
+    """
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        column = column.combine_chunks() \
+            if isinstance(column, pa.ChunkedArray) else column
+        rows = pc.list_parent_indices(column)
+        ids = pc.list_flatten(column)
+        if field is not None:
+            ids = pc.struct_field(ids, field)
+        keep = pc.is_valid(ids)
+        return (pc.filter(rows, keep).to_numpy(),
+                pc.filter(ids, keep).cast(pa.string()))
+    if pa.types.is_null(column.type):
+        return np.array([], dtype=np.int64), pa.array([], pa.string())
+    found = column.to_pandas().astype('string').str.extractall(pattern)[0]
+    return (found.index.get_level_values(0).to_numpy(np.int64),
+            pa.array(found.to_numpy(object), pa.string()))
+
+
+class CitationGraph:
+    """
+    Citing -> cited graph of publications in compressed sparse row form.
+
+    Pub ids are interned as the positions of their 64-bit hashes in the
+    sorted hash array, so edges are pairs of int32 node numbers: the
+    references of node i are indices[indptr[i]:indptr[i + 1]]. Every node
+    also has the journal key of its ISSN-L (or ISSN), MISSING for pubs
+    only known as a reference or citation. The arrays are saved as .npy
+    files and load memory mapped, so aggregates over tens of millions of
+    edges run as numpy operations without any per-id Python objects.
+
+    Parameters
+    ----------
+    ids : pyarrow.Array
+        pub id of every node
+    hashes : numpy.ndarray
+        sorted hash of every node's id
+    indptr : numpy.ndarray
+        offset of every node's references in indices, int64
+    indices : numpy.ndarray
+        cited node of every edge, int32
+    journal : numpy.ndarray
+        journal key of every node, int64
+
+    """
+
+    FILES = ('hashes', 'indptr', 'indices', 'journal')
+
+    def __init__(self, ids, hashes, indptr, indices, journal):
+        self.ids = ids
+        self.hashes = hashes
+        self.indptr = indptr
+        self.indices = indices
+        self.journal = journal
+
+    @classmethod
+    def from_publications(cls, sources, index=None, csv_names=None,
+                          batch_size=250000):
+        """
+        Build the graph from collected publications in one pass.
+
+        A publication's reference_ids give edges from it, and its
+        citations give edges to it, so the graph joins the ISSN, reference
+        and citation outputs without duplicate edges.
+
+        :param sources: list of parquet dataset or csv paths, DataFrames
+                        or pyarrow Tables of publications
+        :param index: IssnIndex to key journals by ISSN-L
+        :param csv_names: column names of headerless csv sources
+        :param batch_size: rows per batch
+        """
+        node_hashes, node_ids = [], []
+        sources_of, targets_of = [], []
+        journal_hashes, journal_of = [], []
+        for source in sources:
+            for table in returns_batches(source, csv_names, batch_size,
+                                         fields=GRAPH_FIELDS):
+                ids = column_or_nulls(table, 'id').cast(pa.string())
+                ids = ids.combine_chunks() \
+                    if isinstance(ids, pa.ChunkedArray) else ids
+                id_hashes = hash_ids(ids.to_numpy(zero_copy_only=False))
+                known = ids.is_valid().to_numpy(zero_copy_only=False)
+                rows, references = linked_ids(
+                    column_or_nulls(table, 'reference_ids'))
+                keep = known[rows]
+                sources_of.append(id_hashes[rows[keep]])
+                targets_of.append(hash_ids(
+                    references.to_numpy(zero_copy_only=False))[keep])
+                rows, citations = linked_ids(
+                    column_or_nulls(table, 'citations'), field='id',
+                    pattern=CITATION_ID.pattern)
+                keep = known[rows]
+                sources_of.append(hash_ids(
+                    citations.to_numpy(zero_copy_only=False))[keep])
+                targets_of.append(id_hashes[rows[keep]])
+
+                batch_ids = pc.unique(pa.concat_arrays(
+                    [pc.drop_null(ids), references, citations]))
+                node_hashes.append(hash_ids(
+                    batch_ids.to_numpy(zero_copy_only=False)))
+                node_ids.append(batch_ids)
+                issn = encode_issns(column_or_nulls(table, 'issn').to_pandas())
+                eissn = encode_issns(column_or_nulls(table,
+                                                     'eissn').to_pandas())
+                journal = np.where(issn != MISSING, journal_keys(issn, index),
+                                   journal_keys(eissn, index))
+                has_journal = known & (journal != MISSING)
+                journal_hashes.append(id_hashes[has_journal])
+                journal_of.append(journal[has_journal])
+
+        hashes, first = np.unique(np.concatenate(
+            node_hashes or [np.array([], np.uint64)]), return_index=True)
+        ids = pa.concat_arrays(node_ids or [pa.array([], pa.string())]) \
+            .take(pa.array(first))
+        nodes = len(hashes)
+        if nodes >= np.iinfo(np.int32).max:
+            raise ValueError(f'Too many publications for int32 nodes: {nodes}')
+        citing = np.searchsorted(hashes, np.concatenate(
+            sources_of or [np.array([], np.uint64)]))
+        cited = np.searchsorted(hashes, np.concatenate(
+            targets_of or [np.array([], np.uint64)]))
+        edges = np.sort(citing.astype(np.int64) * nodes + cited)
+        edges = edges[np.concatenate([[True], edges[1:] != edges[:-1]])] \
+            if len(edges) else edges
+        citing, cited = edges // max(nodes, 1), edges % max(nodes, 1)
+        indptr = np.zeros(nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(citing, minlength=nodes), out=indptr[1:])
+
+        journal = np.full(nodes, MISSING, dtype=np.int64)
+        journal[np.searchsorted(hashes, np.concatenate(
+            journal_hashes or [np.array([], np.uint64)]))] = \
+            np.concatenate(journal_of or [np.array([], np.int64)])
+        return cls(ids, hashes, indptr, cited.astype(np.int32), journal)
+
+    def save(self, graph_dir):
+        os.makedirs(graph_dir, exist_ok=True)
+        for name in self.FILES:
+            np.save(os.path.join(graph_dir, f'{name}.npy'), getattr(self, name))
+        pq.write_table(pa.table({'id': self.ids}),
+                       os.path.join(graph_dir, 'ids.parquet'))
+
+    @classmethod
+    def load(cls, graph_dir, mmap=True):
+        mode = 'r' if mmap else None
+        ids = pq.read_table(os.path.join(graph_dir, 'ids.parquet'))['id']
+        return cls(ids.combine_chunks(),
+                   *[np.load(os.path.join(graph_dir, f'{name}.npy'),
+                             mmap_mode=mode)
+                     for name in cls.FILES])
+
+    @property
+    def nodes(self):
+        return len(self.hashes)
+
+    @property
+    def edges(self):
+        return len(self.indices)
+
+    def nodes_of(self, pub_ids):
+        """
+        Look up the node numbers of pub ids.
+
+        :return: an int64 array, -1 where an id is not in the graph
+        """
+        wanted = hash_ids(pub_ids)
+        position = np.minimum(np.searchsorted(self.hashes, wanted),
+                              max(self.nodes - 1, 0))
+        found = (self.hashes[position] == wanted) if self.nodes else \
+            np.zeros(len(wanted), dtype=bool)
+        return np.where(found, position, -1)
+
+    def references_of(self, pub_id):
+        """Return the pub ids a publication cites."""
+        node = self.nodes_of([pub_id])[0]
+        if node < 0:
+            return []
+        cited = self.indices[self.indptr[node]:self.indptr[node + 1]]
+        return self.ids.take(pa.array(cited)).to_pylist()
+
+    def out_degree(self):
+        """Number of references made by every node."""
+        return np.diff(self.indptr)
+
+    def in_degree(self):
+        """Number of citations received by every node."""
+        return np.bincount(self.indices, minlength=self.nodes)
+
+    def journal_codes(self):
+        """
+        Helper function to number the journals.
+
+        :return: (sorted journal keys, journal number of every node)
+        """
+        return np.unique(self.journal, return_inverse=True)
+
+    def edge_journals(self, node_journal):
+        """ Helper function to get the (citing, cited) journal of every edge"""
+        return (np.repeat(node_journal, self.out_degree()),
+                node_journal[self.indices])
+
+    def journal_degrees(self):
+        """
+        Aggregate degrees and self-citation per journal.
+
+        :return: DataFrame with one row per ISSN-L: its publications, the
+                 references they make and citations they receive, and
+                 the share of references made to the journal itself
+        """
+        journals, node_journal = self.journal_codes()
+        out_degree = np.bincount(node_journal, weights=self.out_degree(),
+                                 minlength=len(journals))
+        in_degree = np.bincount(node_journal, weights=self.in_degree(),
+                                minlength=len(journals))
+        citing, cited = self.edge_journals(node_journal)
+        self_citations = np.bincount(citing[citing == cited],
+                                     minlength=len(journals))
+        degrees = pd.DataFrame({
+            'ISSN-L': decode_issns(journals),
+            'publications': np.bincount(node_journal, minlength=len(journals)),
+            'references': out_degree.astype(np.int64),
+            'citations': in_degree.astype(np.int64),
+            'self_citations': self_citations})
+        degrees['self_citation_rate'] = (degrees['self_citations'] /
+                                         degrees['references'].where(
+                                             degrees['references'] > 0))
+        return degrees[journals != MISSING].reset_index(drop=True)
+
+    def journal_matrix(self):
+        """
+        Count citations between journals, as a sparse matrix in COO form.
+
+        :return: DataFrame of citing ISSN-L, cited ISSN-L and the number
+                 of citations, for every pair citing at least once
+        """
+        journals, node_journal = self.journal_codes()
+        citing, cited = self.edge_journals(node_journal)
+        known = (journals[citing] != MISSING) & (journals[cited] != MISSING)
+        pairs, counts = np.unique(citing[known].astype(np.int64) *
+                                  len(journals) + cited[known],
+                                  return_counts=True)
+        return pd.DataFrame({
+            'citing': decode_issns(journals[pairs // max(len(journals), 1)]),
+            'cited': decode_issns(journals[pairs % max(len(journals), 1)]),
+            'citations': counts})
+
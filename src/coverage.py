@@ -0,0 +1,293 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from issn_index import encode_issns, check_digits_valid, MISSING
+
+# Publication fields a coverage report reads; nothing else is scanned
+COVERAGE_FIELDS = ['id', 'issn', 'eissn', 'date_normal',
+                   'research_org_country_names']
+# DataFrames and legacy csv dumps name the journal fields as queried
+FIELD_ALIASES = {'journal.issn': 'issn', 'journal.eissn': 'eissn'}
+# Legacy csv dumps hold country lists as the repr of numpy arrays
+COUNTRY = r"'([^']*)'"
+NO_YEAR = -1
+YEAR_FACTOR = 10000
+
+
+def returns_batches(returns, csv_names=None, batch_size=250000,
+                    fields=COVERAGE_FIELDS):
+    """
+    Stream publications as pyarrow Tables holding only the given fields.
+
+    :param returns: a parquet dataset or csv path, a DataFrame or a
+                    pyarrow Table
+    :param csv_names: column names of a csv without a header, including
+                      the leading index column
+    :param batch_size: rows per batch
+    :param fields: fields to read, where present
+    """
+    if isinstance(returns, pd.DataFrame):
+        returns = returns.rename(columns=FIELD_ALIASES)
+        returns = returns[[field for field in fields
+                           if field in returns.columns]]
+        for position in range(0, len(returns), batch_size):
+            yield pa.Table.from_pandas(returns.iloc[position:position +
+                                                    batch_size],
+                                       preserve_index=False)
+    elif isinstance(returns, pa.Table):
+        returns = returns.rename_columns([FIELD_ALIASES.get(name, name)
+                                          for name in returns.column_names])
+        returns = returns.select([field for field in fields
+                                  if field in returns.column_names])
+        for batch in returns.to_batches(max_chunksize=batch_size):
+            yield pa.Table.from_batches([batch])
+    elif os.path.isdir(returns) or str(returns).endswith('.parquet'):
+        dataset = ds.dataset(returns, format='parquet', partitioning='hive')
+        fields = [field for field in fields
+                  if field in dataset.schema.names]
+        for batch in dataset.to_batches(columns=fields, batch_size=batch_size):
+            yield pa.Table.from_batches([batch])
+    else:
+        names = [FIELD_ALIASES.get(name, name) for name in csv_names]
+        for chunk in pd.read_csv(returns, names=names,
+                                 usecols=lambda name: name in fields,
+                                 dtype=str, chunksize=batch_size):
+            yield pa.Table.from_pandas(chunk, preserve_index=False)
+
+
+def column_or_nulls(table, field):
+    """ Helper function to get a column, or nulls when it was not collected"""
+    if field in table.column_names:
+        return table[field]
+    return pa.nulls(table.num_rows)
+
+
+def _years(column):
+    """ Helper function to get the publication year of every row"""
+    if pa.types.is_temporal(column.type):
+        years = pc.year(column).to_pandas()
+    else:
+        years = pd.to_numeric(column.to_pandas().astype('string').str.slice(0, 4),
+                              errors='coerce')
+    return years.fillna(NO_YEAR).to_numpy(np.int64)
+
+
+def _countries(column):
+    """
+    Helper function to explode country lists.
+
+    :return: (row of every country, country names)
+    """
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        column = column.combine_chunks() \
+            if isinstance(column, pa.ChunkedArray) else column
+        rows = pc.list_parent_indices(column).to_numpy()
+        names = pc.list_flatten(column).to_numpy(zero_copy_only=False)
+        keep = pd.notna(names)
+        return rows[keep], names[keep]
+    if pa.types.is_null(column.type):
+        return np.array([], dtype=np.int64), np.array([], dtype=object)
+    found = column.to_pandas().astype('string').str.extractall(COUNTRY)[0]
+    return (found.index.get_level_values(0).to_numpy(np.int64),
+            found.to_numpy(object))
+
+
+def journal_keys(keys, index):
+    """ Helper function to key ISSNs by their ISSN-L, where one is known"""
+    if index is None:
+        return keys
+    issn_l = index.to_issn_l(keys)
+    return np.where(issn_l == MISSING, keys, issn_l)
+
+
+class CoverageScan:
+    """
+    Accumulates everything a coverage report needs in one pass over the
+    publications, keeping only compact arrays: a 64-bit hash and the year
+    of every row, the distinct ISSNs, EISSNs and (journal, year) pairs,
+    and the rows of every country, with countries interned to integers.
+    Duplicate publications are resolved on their id at the end, so
+    memory grows by about a dozen bytes per row rather than by the data.
+
+    Parameters
+    ----------
+    index : IssnIndex, optional
+        ISSN-L lookup; without it every ISSN counts as its own journal
+
+    """
+
+    def __init__(self, index=None):
+        self.index = index
+        self.rows = 0
+        self.hashes = []
+        self.years = []
+        self.issns = []
+        self.eissns = []
+        self.journal_years = []
+        self.country_rows = []
+        self.country_codes = []
+        self.countries = {}
+
+    def add(self, table):
+        """Fold a Table of COVERAGE_FIELDS into the scan."""
+        ids = column_or_nulls(table, 'id').to_pandas().to_numpy(object)
+        self.hashes.append(pd.util.hash_array(ids.astype(str)))
+        years = _years(column_or_nulls(table, 'date_normal'))
+        self.years.append(years.astype(np.int16))
+        issn = encode_issns(column_or_nulls(table, 'issn').to_pandas())
+        eissn = encode_issns(column_or_nulls(table, 'eissn').to_pandas())
+        self.issns.append(np.unique(issn[issn != MISSING]))
+        self.eissns.append(np.unique(eissn[eissn != MISSING]))
+        # (journal, year) pairs packed into one integer, year 0 if unknown
+        packed_years = np.maximum(years, 0)
+        pairs = np.concatenate([
+            journal_keys(issn, self.index) * YEAR_FACTOR + packed_years,
+            journal_keys(eissn, self.index) * YEAR_FACTOR + packed_years])
+        self.journal_years.append(np.unique(pairs[pairs >= 0]))
+        rows, names = _countries(column_or_nulls(table, 'research_org_country_names'))
+        codes, uniques = pd.factorize(names)
+        lookup = np.array([self.countries.setdefault(name, len(self.countries))
+                           for name in uniques], dtype=np.int32)
+        self.country_rows.append(rows + self.rows)
+        self.country_codes.append(lookup[codes] if len(codes) else
+                                  np.array([], dtype=np.int32))
+        self.rows += table.num_rows
+
+    def report(self, issns, year=None):
+        """
+        Compute the coverage report of the OJS ISSNs.
+
+        :param issns: DataFrame with an issn_ojs column
+        :param year: year of the OJS ISSN list, recorded in the report
+        :return: a nested dict of counts and percentages
+        """
+        hashes = np.concatenate(self.hashes or [np.array([], np.uint64)])
+        years = np.concatenate(self.years or [np.array([], np.int16)])
+        _, first = np.unique(hashes, return_index=True)
+        is_first = np.zeros(len(hashes), dtype=bool)
+        is_first[first] = True
+        issn = np.unique(np.concatenate(self.issns or [np.array([], np.int64)]))
+        eissn = np.unique(np.concatenate(self.eissns or [np.array([], np.int64)]))
+        returned = np.union1d(issn, eissn)
+        journal_years = np.unique(np.concatenate(self.journal_years or
+                                                 [np.array([], np.int64)]))
+
+        ojs_keys = encode_issns(issns['issn_ojs'])
+        valid = check_digits_valid(ojs_keys)
+        ojs_issns = np.unique(ojs_keys[ojs_keys != MISSING])
+        ojs_journals = np.unique(journal_keys(ojs_issns, self.index))
+        returned_journals = np.unique(journal_keys(returned, self.index))
+        issns_matched = int(np.isin(ojs_issns, returned).sum())
+        journals_matched = int(np.isin(ojs_journals, returned_journals).sum())
+
+        by_year = {}
+        article_years, articles = np.unique(years[is_first], return_counts=True)
+        for article_year, count in zip(article_years, articles):
+            by_year[int(article_year)] = {'articles': int(count), 'journals': 0}
+        journal_years = journal_years[np.isin(journal_years // YEAR_FACTOR,
+                                              ojs_journals)]
+        pair_years, journals = np.unique(journal_years % YEAR_FACTOR,
+                                         return_counts=True)
+        for pair_year, count in zip(pair_years, journals):
+            pair_year = NO_YEAR if pair_year == 0 else int(pair_year)
+            by_year.setdefault(pair_year, {'articles': 0})['journals'] = \
+                int(count)
+        by_year = {(None if key in (NO_YEAR, 0) else key): by_year[key]
+                   for key in sorted(by_year)}
+
+        country_rows = np.concatenate(self.country_rows or
+                                      [np.array([], np.int64)])
+        country_codes = np.concatenate(self.country_codes or
+                                       [np.array([], np.int32)])
+        counts = np.bincount(country_codes[is_first[country_rows]],
+                             minlength=len(self.countries))
+        names = np.array(list(self.countries), dtype=object)
+        order = np.argsort(-counts, kind='stable')
+        by_country = {names[position]: int(counts[position])
+                      for position in order if counts[position] > 0}
+
+        return {
+            'year': year,
+            'ojs': {'rows': len(issns),
+                    'unique_issns': len(ojs_issns),
+                    'unique_issn_ls': len(ojs_journals),
+                    'invalid_issns': int((ojs_keys == MISSING).sum()),
+                    'bad_check_digits': int(((ojs_keys != MISSING) &
+                                             ~valid).sum())},
+            'returns': {'rows': self.rows,
+                        'articles': len(first),
+                        'duplicates': self.rows - len(first),
+                        'unique_issns': len(issn),
+                        'unique_eissns': len(eissn),
+                        'unique_issn_eissns': len(returned),
+                        'unique_issn_ls': len(returned_journals)},
+            'coverage': {'issns_matched': issns_matched,
+                         'issn_percent': percent(issns_matched,
+                                                 len(ojs_issns)),
+                         'issn_ls_matched': journals_matched,
+                         'issn_l_percent': percent(journals_matched,
+                                                   len(ojs_journals))},
+            'by_year': by_year,
+            'by_country': by_country,
+        }
+
+
+def percent(part, whole):
+    """ Helper function to get a rounded percentage, or None of nothing"""
+    return round(100 * part / whole, 2) if whole else None
+
+
+def coverage_report(issns, returns, year=None, index=None, csv_names=None,
+                    batch_size=250000):
+    """
+    Measure how much of the OJS ISSN list the collected publications
+    cover, in a single streaming pass over them.
+
+    Parquet datasets are scanned batch by batch reading only the
+    coverage fields, and csv files are read in chunks, so the returns
+    never need to fit in memory.
+
+    :param issns: DataFrame with an issn_ojs column
+    :param returns: a parquet dataset or csv path, a DataFrame or a
+                    pyarrow Table of publications
+    :param year: year of the OJS ISSN list
+    :param index: IssnIndex for ISSN-L aware coverage
+    :param csv_names: column names of a headerless csv, index column first
+    :param batch_size: rows per batch
+    :return: the report, as made by CoverageScan.report
+    """
+    scan = CoverageScan(index)
+    for table in returns_batches(returns, csv_names, batch_size):
+        scan.add(table)
+    return scan.report(issns, year)
+
+
+def print_report(report, countries=10):
+    """Print a coverage report, with its top countries."""
+    year, ojs, returns, coverage = (report['year'], report['ojs'],
+                                    report['returns'], report['coverage'])
+    print(f'Length of {year} ISSNs from the OJS: ', ojs['rows'])
+    print(f'Length of unique {year} ISSNs from the OJS: ', ojs['unique_issns'])
+    print(f'Invalid ISSNs: {ojs["invalid_issns"]}, '
+          f'bad check digits: {ojs["bad_check_digits"]}')
+    print(f'Number of articles returned from {year} across issns or eissns: ',
+          returns['articles'], f'({returns["duplicates"]} duplicate rows)')
+    print('Number of unique issns returned: ', returns['unique_issns'])
+    print('Number of unique eissns returned: ', returns['unique_eissns'])
+    print('Number of unique issn+eissns: ', returns['unique_issn_eissns'])
+    print(f'ISSN coverage: {coverage["issns_matched"]} of '
+          f'{ojs["unique_issns"]} ({coverage["issn_percent"]}%)')
+    print(f'ISSN-L coverage: {coverage["issn_ls_matched"]} of '
+          f'{ojs["unique_issn_ls"]} ({coverage["issn_l_percent"]}%)')
+    print('Articles and OJS journals by publication year:')
+    for article_year, counts in report['by_year'].items():
+        print(f'  {article_year}: {counts["articles"]} articles, '
+              f'{counts["journals"]} journals')
+    print(f'Articles by country (top {countries}):')
+    for country, count in list(report['by_country'].items())[:countries]:
+        print(f'  {country}: {count}')
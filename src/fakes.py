@@ -0,0 +1,304 @@
+import re
+import json
+import time
+import zlib
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Stand-ins for BigQuery and the Elsevier API, so that every stage of the
+# pipeline can be run and benchmarked offline
+
+SELECTED_COLUMNS = re.compile(r'SELECT\s+(.*?)\s+FROM', re.DOTALL)
+EXPANSION = re.compile(r'WITH\s+seeds\s+AS')
+
+
+class FakeRowIterator:
+    """Stand-in for bigquery.table.RowIterator over an Arrow Table."""
+
+    def __init__(self, table, page_size=None):
+        self.table = table
+        self.page_size = page_size or 10000
+        self.total_rows = table.num_rows
+
+    def to_dataframe(self):
+        return self.table.to_pandas()
+
+    def to_arrow(self, bqstorage_client=None):
+        return self.table
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        return iter(self.table.to_batches(max_chunksize=self.page_size))
+
+
+class FakeQueryJob:
+    """Stand-in for bigquery.QueryJob, holding its result or error."""
+
+    def __init__(self, table, total_bytes_processed, seconds=0.0, error=None):
+        self.table = table
+        self.total_bytes_processed = total_bytes_processed
+        self.error = error
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.ended = self.started + datetime.timedelta(seconds=seconds)
+
+    def result(self, page_size=None):
+        if self.error is not None:
+            raise self.error
+        return FakeRowIterator(self.table, page_size)
+
+    def done(self):
+        return True
+
+
+class FakeBigQueryClient:
+    """
+    Stand-in for bigquery.Client answering the queries of query_builder
+    from an in-memory publications Table.
+
+    The selected columns are read from the query text and the items from
+    its issns or pubids array parameter; columns the table lacks are left
+    out. Expansion queries, from build_expansion_query, return the
+    articles referenced by or citing the articles of the ISSNs. Like
+    BigQuery, every job is billed for the whole of each column it reads.
+
+    Parameters
+    ----------
+    publications : pyarrow.Table
+        publications with at least id, issn and eissn columns
+    latency : float
+        seconds every job takes to run
+    max_result_rows : int, optional
+        results larger than this fail as too large, to exercise splitting
+
+    """
+
+    def __init__(self, publications, latency=0.0, max_result_rows=None):
+        self.publications = publications
+        self.latency = latency
+        self.max_result_rows = max_result_rows
+        self.jobs = 0
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def query(self, query, job_config=None):
+        # the outer SELECT of an expansion query is its last one
+        columns = [column.strip().split('.')[-1] for column in
+                   SELECTED_COLUMNS.findall(query)[-1].split(',')]
+        columns = [column for column in columns
+                   if column in self.publications.column_names]
+        parameters = {parameter.name: parameter.values for parameter in
+                      getattr(job_config, 'query_parameters', None) or []}
+        articles = pc.equal(self.publications['type'], 'article') \
+            if 'type' in self.publications.column_names else None
+        mask = articles
+        if 'issns' in parameters:
+            issns = pa.array(parameters['issns'], pa.string())
+            matched = pc.or_(pc.is_in(self.publications['issn'], issns),
+                             pc.is_in(self.publications['eissn'], issns))
+            mask = matched if mask is None else pc.and_(mask, matched)
+        if 'pubids' in parameters:
+            matched = pc.is_in(self.publications['id'],
+                               pa.array(parameters['pubids'], pa.string()))
+            mask = matched if mask is None else pc.and_(mask, matched)
+        billed = sum(self.publications[column].nbytes for column in columns)
+        if EXPANSION.search(query):
+            mask, linked_bytes = self.expansion_mask(query, mask, articles)
+            billed += linked_bytes
+        with self.lock:
+            self.jobs += 1
+        if getattr(job_config, 'dry_run', False):
+            return FakeQueryJob(None, billed)
+        time.sleep(self.latency)
+        table = self.publications.select(columns)
+        if mask is not None:
+            table = table.filter(pc.fill_null(mask, False))
+        error = None
+        if self.max_result_rows is not None and \
+                table.num_rows > self.max_result_rows:
+            error = RuntimeError('Response too large to return')
+        destination = getattr(job_config, 'destination', None)
+        if destination is not None and error is None:
+            self.tables[str(destination)] = table
+        return FakeQueryJob(table, billed, self.latency, error)
+
+    def expansion_mask(self, query, seeds, articles):
+        """
+        Helper function to select the articles referenced by, or citing,
+        the seed articles of a build_expansion_query query.
+
+        :return: (mask of the linked articles, bytes of the array read)
+        """
+        field = 'reference_ids' if 'UNNEST(seeds.reference_ids)' in query \
+            else 'citations'
+        links = self.publications[field].filter(pc.fill_null(seeds, False))
+        linked = pc.list_flatten(links)
+        if field == 'citations':
+            linked = pc.struct_field(linked, 'id')
+        mask = pc.is_in(self.publications['id'], pc.unique(pc.drop_null(linked)))
+        if articles is not None:
+            mask = pc.and_(mask, articles)
+        return mask, self.publications[field].nbytes
+
+    def list_rows(self, table):
+        return FakeRowIterator(self.tables[str(table)])
+
+
+class StandInServer(ThreadingHTTPServer):
+    # a backlog deep enough for a harvest's burst of fresh connections
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def fake_issn_count(issn):
+    """ Helper function to give every ISSN a stable, arbitrary article count"""
+    return zlib.crc32(issn.encode('utf-8')) % 5000
+
+
+class ScopusStandIn:
+    """
+    Local HTTP server answering the Elsevier search and serial title
+    endpoints used by scopus_counter, with X-RateLimit-* headers.
+
+    Every key has quota calls per window seconds. Each response carries
+    the key's limit, remaining calls and the epoch second the window
+    resets at; once the quota is spent the server answers 429 until the
+    reset. ISSNs whose count is a multiple of not_found_every are
+    answered 404, as unknown serials are.
+
+    Use as a context manager; base_url then points at the server.
+
+    Parameters
+    ----------
+    quota : int
+        calls allowed per key and window
+    window : float
+        seconds after which quotas reset
+    latency : float
+        seconds every request takes to answer
+    not_found_every : int
+        share of ISSNs without a serial record, as one in this many
+    faults : dict, optional
+        statuses some keys answer, in order, before answering normally,
+        e.g. {key: [401]} for a revoked key or [503, 429] for transient
+        errors; faults count against the quota like any call
+
+    """
+
+    def __init__(self, quota=20000, window=1.0, latency=0.0,
+                 not_found_every=7, faults=None):
+        self.quota = quota
+        self.window = window
+        self.latency = latency
+        self.not_found_every = not_found_every
+        self.faults = {key: list(statuses)
+                       for key, statuses in (faults or {}).items()}
+        self.calls = {}
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/content/'
+
+    def take_call(self, key):
+        """
+        Count a call against a key's quota.
+
+        :return: (allowed, remaining, reset)
+        """
+        with self.lock:
+            now = time.time()
+            reset, used = self.calls.get(key, (now + self.window, 0))
+            if now >= reset:
+                reset, used = now + self.window, 0
+            allowed = used < self.quota
+            used += allowed
+            self.calls[key] = (reset, used)
+            self.rejected += not allowed
+            return allowed, self.quota - used, reset
+
+    def take_fault(self, key):
+        """
+        Take the next scripted fault of a key.
+
+        :return: a status, or None once the key answers normally
+        """
+        with self.lock:
+            statuses = self.faults.get(key)
+            return statuses.pop(0) if statuses else None
+
+    def answer(self, path, query):
+        """
+        Build the JSON body for a request.
+
+        :return: (status, body)
+        """
+        if path.endswith('/search/scopus'):
+            issn = query['query'][0].split('(')[1].rstrip(')')
+            return 200, {'search-results': {
+                'opensearch:totalResults': str(fake_issn_count(issn))}}
+        issn = path.rsplit('/', 1)[-1]
+        if fake_issn_count(issn) % self.not_found_every == 0:
+            return 404, {'service-error': {'status': {
+                'statusCode': 'RESOURCE_NOT_FOUND',
+                'statusText': 'The resource specified cannot be found.'}}}
+        return 200, {'serial-metadata-response': {'entry': [{
+            'prism:issn': issn.replace('-', ''),
+            'prism:eIssn': issn.replace('-', ''),
+            'dc:title': f'Journal {issn}'}]}}
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                key = self.headers.get('X-ELS-APIKey', '')
+                allowed, remaining, reset = stand_in.take_call(key)
+                fault = stand_in.take_fault(key) if allowed else None
+                if fault is not None:
+                    status, body = fault, {'error-response': {
+                        'error-code': f'STATUS_{fault}'}}
+                elif allowed:
+                    time.sleep(stand_in.latency)
+                    status, body = stand_in.answer(url.path,
+                                                   parse_qs(url.query))
+                else:
+                    status, body = 429, {'error-response': {
+                        'error-code': 'TOO_MANY_REQUESTS'}}
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.send_header('X-RateLimit-Limit', str(stand_in.quota))
+                self.send_header('X-RateLimit-Remaining', str(max(remaining, 0)))
+                self.send_header('X-RateLimit-Reset', str(int(reset) + 1))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.server = StandInServer(('127.0.0.1', 0), self.handler())
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
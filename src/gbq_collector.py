@@ -1,26 +1,60 @@
 import os
-import re
-import ast
-import traceback
+import uuid
+import shutil
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from itertools import chain
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from google.cloud import bigquery
 
+from adaptive_chunker import AdaptiveChunker, is_too_large
+from citation_graph import CitationGraph
+from coverage import coverage_report, print_report
+from instrumentation import metrics
+from pub_ids import get_all_refs, get_all_citations
+from pubid_index import PubIdIndex
+from query_builder import build_query, build_expansion_query, \
+    make_job_config, dry_run, estimate_cost, resolve_columns
+
 #article_headers = ['id', 'title.preferred', 'doi', 'journal.issn',
 #                   'journal.eissn', 'type', 'date_normal',
 #                   'category_for', 'citations_count', 'research_org_cities',
 #                   'research_org_country_names', 'altmetrics',
 #                   'reference_ids', 'citations']
 
+# Types pinned for the columns downstream code relies on; every other
+# column keeps the type BigQuery returns it with.
+PUBLICATION_FIELDS = {
+    'id': pa.string(),
+    'reference_ids': pa.list_(pa.string()),
+    'citations': pa.list_(pa.struct([('id', pa.string()),
+                                     ('year', pa.int64())])),
+    'doi': pa.string(),
+    'issn': pa.string(),
+    'eissn': pa.string(),
+    'type': pa.string(),
+    'date_normal': pa.date32(),
+}
+DATA_ROOT = os.path.join('..', 'data')
+DOI_FILE = 'ojs-DOIs-2022-12-01.txt'
+YEAR_PARTITIONING = ds.partitioning(pa.schema([('year', pa.int32())]),
+                                    flavor='hive')
+
 
 def load_issns(path, year):
     return pd.read_csv(os.path.join(path, str(year),
                                     f'full_ojs_issn_list_{year}.csv'))
 
 
-def get_raw_doi_list(raw_path):
-    doi_path = os.path.join(raw_path, 'dois')
-    doi_file = os.path.join(os.path.join(doi_path, 'ojs-DOIs-2022-12-01.txt'))
+def get_raw_doi_list(raw_path, doi_file=None):
+    """ Helper function to load the OJS DOIs, by default from raw_path/dois"""
+    if doi_file is None:
+        doi_file = os.path.join(raw_path, 'dois', DOI_FILE)
     doi_df = pd.read_csv(doi_file, header=None, names=['doi'])
     doi_list = doi_df['doi'].tolist()
     return doi_list
@@ -34,6 +68,200 @@ def save_file(results, file_path):
         results.to_csv(file_path, mode='a', header=False)
 
 
+def output_name(name, output_format):
+    """ Helper function to name an output: a csv file or a parquet directory"""
+    return f'{name}.{output_format}'
+
+
+def remove_output(file_path):
+    """ Helper function to delete an output file or parquet directory"""
+    if os.path.isdir(file_path):
+        shutil.rmtree(file_path)
+    elif os.path.exists(file_path):
+        os.remove(file_path)
+    if os.path.exists(committed_size_path(file_path)):
+        os.remove(committed_size_path(file_path))
+
+
+def committed_size_path(file_path):
+    """ Helper function to name the record of a csv output's committed size"""
+    return f'{file_path}.committed'
+
+
+def staging_path(file_path, chunk_number):
+    """
+    Helper function to name the directory a chunk's parquet files are
+    written to before being committed; dataset readers skip it, as they
+    skip every path starting with an underscore
+    """
+    return os.path.join(file_path, '_staging', f'chunk{chunk_number:05d}')
+
+
+def discard_uncommitted(file_path, output_format):
+    """
+    Helper function to drop what an interrupted run wrote of a chunk it
+    did not commit: parquet files still being staged, or csv rows past
+    the last committed size.
+    """
+    if output_format == 'parquet':
+        shutil.rmtree(os.path.join(file_path, '_staging'), ignore_errors=True)
+        return
+    size_path = committed_size_path(file_path)
+    if not os.path.exists(size_path):
+        # a new output starts with nothing committed, so a crash within
+        # its first chunk is rolled back too; an output written before
+        # sizes were recorded is kept whole
+        record_committed_size(file_path)
+        return
+    if os.path.exists(file_path):
+        with open(size_path) as size_file:
+            size = int(size_file.read())
+        if os.path.getsize(file_path) > size:
+            print(f'Discarding the rows of an uncommitted chunk of {file_path}')
+            os.truncate(file_path, size)
+
+
+def has_committed_rows(file_path, output_format):
+    """
+    Helper function to tell whether an output holds any committed chunk,
+    rather than only what an interrupted run staged or left uncommitted
+    """
+    if output_format == 'parquet':
+        for root, dirs, files in os.walk(file_path):
+            dirs[:] = [name for name in dirs if not name.startswith('_')]
+            if any(not name.startswith(('_', '.')) for name in files):
+                return True
+        return False
+    if not os.path.exists(file_path):
+        return False
+    size_path = committed_size_path(file_path)
+    if not os.path.exists(size_path):
+        return os.path.getsize(file_path) > 0
+    with open(size_path) as size_file:
+        return int(size_file.read()) > 0
+
+
+def commit_chunk(file_path, output_format, chunk_number):
+    """
+    Helper function to commit a chunk once all its rows are written:
+    its staged parquet files are renamed into the dataset, or the csv's
+    size is recorded.
+    """
+    if output_format == 'parquet':
+        staging = staging_path(file_path, chunk_number)
+        for root, dirs, files in os.walk(staging):
+            target = os.path.join(file_path, os.path.relpath(root, staging))
+            os.makedirs(target, exist_ok=True)
+            for name in files:
+                os.replace(os.path.join(root, name), os.path.join(target, name))
+        shutil.rmtree(os.path.dirname(staging), ignore_errors=True)
+        return
+    record_committed_size(file_path)
+
+
+def record_committed_size(file_path):
+    """ Helper function to record a csv output's current size as committed"""
+    size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    temporary = f'{committed_size_path(file_path)}.tmp'
+    with open(temporary, 'w') as size_file:
+        size_file.write(str(size))
+    os.replace(temporary, committed_size_path(file_path))
+
+
+def conform_batch(batch):
+    """
+    Helper function to cast a record batch to the publication schema and
+    add the year it is partitioned by.
+
+    :param batch: pyarrow RecordBatch as returned by BigQuery
+    :return: a pyarrow Table
+    """
+    table = pa.Table.from_batches([batch])
+    schema = pa.schema([pa.field(field.name,
+                                 PUBLICATION_FIELDS.get(field.name, field.type))
+                        for field in table.schema])
+    table = table.cast(schema)
+    if 'date_normal' in table.column_names:
+        year = pc.year(table['date_normal']).cast(pa.int32())
+    else:
+        year = pa.nulls(table.num_rows, pa.int32())
+    return table.append_column('year', year)
+
+
+def save_parquet(batch, dir_path, chunk_number, batch_number, prefix='run'):
+    """
+    Helper function to write a record batch into a parquet dataset,
+    partitioned as year=YYYY/prefix-chunkNNNNN-batchNNNNN-i.parquet;
+    a unique prefix per save_batches call keeps saves, however close
+    together, from overwriting each other's files
+    """
+    ds.write_dataset(conform_batch(batch),
+                     dir_path,
+                     format='parquet',
+                     partitioning=YEAR_PARTITIONING,
+                     basename_template=f'{prefix}-chunk{chunk_number:05d}-'
+                                       f'batch{batch_number:05d}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore')
+
+
+def read_publications(path, columns=None, ids=None):
+    """
+    Helper function to read a parquet publication dataset, or only
+    some of its columns and, if ids is given, only those pubs, as a
+    pyarrow Table.
+    """
+    filters = None if ids is None else [('id', 'in', list(ids))]
+    return pq.read_table(path, columns=columns, filters=filters,
+                         partitioning=YEAR_PARTITIONING)
+
+
+def read_links(path, output_format, ids=None):
+    """
+    Helper function to read the id, reference_ids and citations columns
+    of a publication output, optionally only for the given pub ids.
+    """
+    if output_format == 'parquet':
+        return read_publications(path,
+                                 columns=['id', 'reference_ids', 'citations'],
+                                 ids=ids)
+    links = pd.read_csv(path,
+                        usecols=[1, 2, 3],
+                        names=['id',
+                               'reference_ids',
+                               'citations'])
+    if ids is not None:
+        links = links[links['id'].isin(ids)]
+    return links
+
+
+def link_ids(links):
+    """ Helper function to list the pub ids of read_links output"""
+    if isinstance(links, pa.Table):
+        return links['id'].to_pylist()
+    return links['id'].tolist()
+
+
+def fill_index(index, issn_out, output_format):
+    """
+    Helper function to record the pub ids of reference and citation
+    outputs written before there was an index, as fetched by the first hop
+    """
+    for kind, name in [('reference', 'references_of_all_pubs'),
+                       ('citation', 'citations_of_all_pubs')]:
+        path = os.path.join(issn_out, output_name(name, output_format))
+        if os.path.exists(path):
+            discard_uncommitted(path, output_format)
+            index.mark_fetched(kind, link_ids(read_links(path, output_format)),
+                               1)
+
+
+def csv_output_names(columns='full'):
+    """ Helper function to name the columns of a headerless csv output"""
+    return ['index'] + [column.split('.')[-1]
+                        for column in resolve_columns(columns)]
+
+
 def chunker(seq, size):
     """ Helper function to chunk a list into parts"""
     return (seq[pos:pos + size] for pos in range(0,
@@ -41,88 +269,289 @@ def chunker(seq, size):
                                                  size))
 
 
-def get_data_from_lists(query_list, client, query_type):
+def submit_query(query_list, client, query_type, columns='full'):
     """
-    A helper function to get rows of data
-    from an input list of ISSNs.
+    A helper function to start a query job for an input
+    list of ISSNs or pub ids without waiting for it.
 
     :param query_list: list of items to query
     :param client: google query client
     :param query_type: object type to query
-    :return: a GBC iterator containing all data
+    :param columns: a query_builder column profile or list of columns
+    :return: the running QueryJob
+    """
+    QUERY, parameters = build_query(query_list, query_type, columns)
+    return client.query(QUERY, job_config=make_job_config(parameters))
+
+
+def try_submit(query_list, client, query_type, columns='full'):
+    """ Helper function to submit a query, returning rather than raising errors"""
+    try:
+        return submit_query(query_list, client, query_type, columns)
+    except Exception as e:
+        return e
+
+
+def record_job(query_job, query_type, rows=None, sizer=None):
+    """
+    Helper function to record a finished job's runtime, bytes processed
+    and, when known, rows, and to feed it to the chunk sizer.
+    """
+    if sizer is not None:
+        sizer.record_job(query_job)
+    metrics.inc('bigquery_jobs', query_type=query_type)
+    if getattr(query_job, 'started', None) and getattr(query_job, 'ended', None):
+        metrics.observe('bigquery_job_seconds',
+                        (query_job.ended - query_job.started).total_seconds(),
+                        query_type=query_type)
+    metrics.inc('bigquery_bytes_processed',
+                getattr(query_job, 'total_bytes_processed', None) or 0,
+                query_type=query_type)
+    if rows is not None:
+        metrics.inc('bigquery_rows', rows, query_type=query_type)
+
+
+def fetch_dataframe(query_job, chunk=None, client=None, query_type=None,
+                    sizer=None, columns='full'):
+    """
+    Helper function to wait on a job and download its rows. If the job
+    failed as too large and a sizer is given, the chunk is split in half
+    and the halves are queried in turn.
     """
     try:
-        if query_type == 'issn':
-            QUERY = """
-                    SELECT id, reference_ids, citations, doi, journal.issn,
-                    journal.eissn, type, date_normal, category_for, metrics,
-                    research_orgs, researcher_ids, journal, research_org_country_names,
-                    altmetrics, title, abstract, concepts, funder_orgs
-                    FROM `dimensions-ai.data_analytics.publications`
-                    WHERE type='article' AND (journal.issn IN UNNEST(%s) OR journal.eissn IN UNNEST(%s))""" %(query_list, query_list)
-            query_job = client.query(QUERY)
-        elif query_type == 'article':
-            job_config = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ArrayQueryParameter("pubids", "STRING", query_list),
-                ]
-            )
-            QUERY = """
-                    SELECT id, reference_ids, citations, doi, journal.issn,
-                    journal.eissn, type, date_normal, category_for, metrics,
-                    research_orgs, researcher_ids, journal, research_org_country_names,
-                    altmetrics, title, abstract, concepts, funder_orgs
-                    FROM `dimensions-ai.data_analytics.publications` p
-                    WHERE type='article' AND p.id IN UNNEST(@pubids)""" %(query_list)
-            query_job = client.query(QUERY, job_config=job_config)
-        rows = query_job.result()
-        return rows
+        if isinstance(query_job, Exception):
+            raise query_job
+        results = query_job.result().to_dataframe()
     except Exception as e:
-        print(traceback.format_exc())
+        if sizer is None or not is_too_large(e) or len(chunk) < 2:
+            raise
+        print(f'Splitting a chunk of {len(chunk)} {query_type}s: {e}')
+        metrics.inc('bigquery_splits', query_type=query_type)
+        return pd.concat([fetch_dataframe(try_submit(half, client, query_type,
+                                                     columns),
+                                          half, client, query_type, sizer,
+                                          columns)
+                          for half in sizer.split(chunk)])
+    record_job(query_job, query_type, len(results), sizer)
+    return results
+
+
+def run_pipelined(chunks, client, query_type, max_in_flight=4, sizer=None,
+                  columns='full'):
+    """
+    A generator to run one query per chunk with several jobs in flight.
+
+    Jobs are submitted up to max_in_flight ahead of the chunk being
+    consumed, and their results are downloaded on worker threads, so
+    BigQuery execution, result download and writing all overlap.
+
+    :param chunks: iterable of lists of items to query
+    :param client: google query client
+    :param query_type: object type to query
+    :param max_in_flight: cap on submitted but unconsumed jobs
+    :param sizer: optional AdaptiveChunker fed with every finished job
+    :param columns: a query_builder column profile or list of columns
+    :return: (chunk, DataFrame) tuples, in chunk order
+    """
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        pending = deque()
+        for chunk in chunks:
+            query_job = try_submit(chunk, client, query_type, columns)
+            pending.append((chunk, pool.submit(fetch_dataframe, query_job, chunk,
+                                               client, query_type, sizer,
+                                               columns)))
+            if len(pending) >= max_in_flight:
+                chunk, future = pending.popleft()
+                yield chunk, future.result()
+        while pending:
+            chunk, future = pending.popleft()
+            yield chunk, future.result()
 
 
-def get_all_data(chunk_size, file_path, client, query_list, query_type):
-    """ Helper function to get all data from iterative queries"""
-    if chunk_size < len(query_list):
-        print(f'We have {len(query_list)} {query_type}s with chunksize {chunk_size}')
-        for chunk in tqdm(chunker(query_list, chunk_size)):
-            results = get_data_from_lists(chunk,
-                                          client,
-                                          query_type).to_dataframe()
+def stream_chunk(query_job, chunk, client, query_type, page_size=10000,
+                 bqstorage_client=None, sizer=None, columns='full'):
+    """
+    A generator of the Arrow record batches of one chunk's job, splitting
+    the chunk and streaming the halves in turn if it failed as too large.
+    """
+    try:
+        if isinstance(query_job, Exception):
+            raise query_job
+        rows = query_job.result(page_size=page_size)
+    except Exception as e:
+        if sizer is None or not is_too_large(e) or len(chunk) < 2:
+            raise
+        print(f'Splitting a chunk of {len(chunk)} {query_type}s: {e}')
+        metrics.inc('bigquery_splits', query_type=query_type)
+        for half in sizer.split(chunk):
+            yield from stream_chunk(try_submit(half, client, query_type,
+                                               columns),
+                                    half, client, query_type, page_size,
+                                    bqstorage_client, sizer, columns)
+        return
+    record_job(query_job, query_type, sizer=sizer)
+    for batch in rows.to_arrow_iterable(bqstorage_client=bqstorage_client):
+        metrics.inc('bigquery_rows', batch.num_rows, query_type=query_type)
+        yield batch
+
+
+def run_streaming(chunks, client, query_type, max_in_flight=4,
+                  page_size=10000, bqstorage_client=None, sizer=None,
+                  columns='full'):
+    """
+    A generator to run one query per chunk and stream the rows back
+    as Arrow record batches.
+
+    Jobs are still submitted up to max_in_flight ahead so that they
+    execute while earlier chunks download, but only one batch at a
+    time is held in memory, however large the chunk.
+
+    :param chunks: iterable of lists of items to query
+    :param client: google query client
+    :param query_type: object type to query
+    :param max_in_flight: cap on submitted but unconsumed jobs
+    :param page_size: rows per page when reading through the REST API
+    :param bqstorage_client: optional BigQuery Storage Read API client,
+                             used for the download when given
+    :param sizer: optional AdaptiveChunker fed with every finished job
+    :param columns: a query_builder column profile or list of columns
+    :return: (chunk number, chunk, pyarrow.RecordBatch) tuples, in chunk
+             order, with a (chunk number, chunk, None) marker once a
+             chunk is complete
+    """
+    chunks = enumerate(chunks)
+    pending = deque()
+
+    def fill():
+        while len(pending) < max_in_flight:
+            numbered = next(chunks, None)
+            if numbered is None:
+                return
+            number, chunk = numbered
+            pending.append((number, chunk,
+                            try_submit(chunk, client, query_type, columns)))
+
+    fill()
+    while pending:
+        number, chunk, query_job = pending.popleft()
+        fill()
+        for batch in stream_chunk(query_job, chunk, client, query_type,
+                                  page_size, bqstorage_client, sizer, columns):
+            yield number, chunk, batch
+        yield number, chunk, None
+
+
+def save_batches(numbered_batches, file_path, output_format='csv',
+                 on_chunk=None):
+    """
+    Helper function to append record batches as they arrive. Row
+    numbers restart with every chunk, as they do for whole chunks.
+    A chunk only becomes part of the output once its end marker arrives,
+    and on_chunk is then called with its items, so a rerun after a crash
+    neither keeps nor repeats the rows of a half-saved chunk.
+    """
+    current, offset, batch_number = None, 0, 0
+    prefix = f'run{uuid.uuid4().hex}'
+    discard_uncommitted(file_path, output_format)
+    for number, chunk, batch in numbered_batches:
+        if batch is None:
+            commit_chunk(file_path, output_format, number)
+            if on_chunk is not None:
+                on_chunk(chunk)
+            continue
+        if number != current:
+            current, offset, batch_number = number, 0, 0
+        with metrics.span('output_write', output_format=output_format):
+            if output_format == 'parquet':
+                save_parquet(batch, staging_path(file_path, number), number,
+                             batch_number, prefix)
+                batch_number += 1
+                continue
+            results = batch.to_pandas()
+            results.index += offset
+            offset += len(results)
             save_file(results, file_path)
-    elif chunk_size == len(query_list):
-        results = get_data_from_lists(query_list,
-                                      client,
-                                      query_type).to_dataframe()
-        save_file(results, file_path)
+
+
+def get_all_data(chunk_size, file_path, client, query_list, query_type,
+                 max_in_flight=4, stream=False, bqstorage_client=None,
+                 output_format='csv', on_chunk=None, target_seconds=120,
+                 columns='full', dry_run_only=False):
+    """
+    Helper function to get all data from pipelined queries
+
+    Chunks are sized adaptively: chunk_size is only the starting point,
+    capped by what fits in a query's byte limits, after which chunks
+    grow while jobs run fast, shrink when they run slow, and are split
+    when BigQuery rejects them as too large. Lists of any length work.
+
+    :param chunk_size: starting chunk size, or None to start from the
+                       byte limit
+    :param stream: write results batch by batch instead of whole chunk
+                   DataFrames, bounding memory by the batch size
+    :param bqstorage_client: optional Storage Read API client for streaming
+    :param output_format: 'csv' for a headerless csv file or 'parquet' for
+                          a year-partitioned dataset keeping nested types;
+                          parquet output is always streamed
+    :param on_chunk: called with each chunk's query list once its results
+                     are saved
+    :param target_seconds: job runtime chunks are sized towards
+    :param columns: a query_builder column profile or list of columns
+    :param dry_run_only: only estimate what the queries would scan and cost
+    :return: the chunk sizer's statistics, or the cost estimate on a dry run
+    """
+    sizer = AdaptiveChunker(query_list, chunk_size,
+                            target_seconds=target_seconds)
+    print(f'We have {len(query_list)} {query_type}s with starting chunksize {sizer.size}')
+    if dry_run_only:
+        # each chunk scans the selected columns of the whole table, so the
+        # first chunk's estimate holds for every job
+        per_job = dry_run(query_list[:sizer.size], client, query_type, columns)
+        number_jobs = -(-len(query_list) // sizer.size)
+        estimate = estimate_cost(per_job['bytes_processed'] * number_jobs)
+        estimate['jobs'] = number_jobs
+        metrics.set('bigquery_dry_run_bytes', estimate['bytes_processed'],
+                    query_type=query_type)
+        print(f'Dry run: {per_job} per job, {estimate} in total')
+        return estimate
+    with metrics.span('bigquery_collect', query_type=query_type):
+        collect(sizer, file_path, client, query_type, max_in_flight, stream,
+                bqstorage_client, output_format, on_chunk, columns)
+    print(f'Chunking: {sizer.stats()}')
+    return sizer.stats()
+
+
+def collect(sizer, file_path, client, query_type, max_in_flight=4,
+            stream=False, bqstorage_client=None, output_format='csv',
+            on_chunk=None, columns='full'):
+    """ Helper function to run and save the chunks of get_all_data"""
+    if stream or output_format == 'parquet':
+        save_batches(tqdm(run_streaming(sizer.chunks(),
+                                        client,
+                                        query_type,
+                                        max_in_flight,
+                                        bqstorage_client=bqstorage_client,
+                                        sizer=sizer,
+                                        columns=columns),
+                          unit='batch'),
+                     file_path,
+                     output_format,
+                     on_chunk=on_chunk)
     else:
-        print('Bad Chunksize')
-
-
-def get_all_refs(df):
-    """ Get all references from a pubid dataframe"""
-    all_refs = []
-    for element in df['reference_ids'].to_list():
-        element = element.replace('\n','')
-        element = element.replace('[', '')
-        element = element.replace(']', '')
-        element = element.replace("'", '')
-        element = element.split(' ')
-        for ele in element:
-            if len(ele) > 0:
-                all_refs.append(ele)
-    return list(set(all_refs))
-
-
-def get_all_citations(df):
-    """ Get all citations from a pubid dataframe"""
-    all_citations = []
-    for element in df['citations'].to_list():
-        if len(element) > 2:
-            for ele in element.split('\n'):
-                x = ast.literal_eval(re.search('({.+})', ele).group(0))
-                all_citations.append(x['id'])
-    return list(set(all_citations))
+        discard_uncommitted(file_path, output_format)
+        chunks = tqdm(run_pipelined(sizer.chunks(),
+                                    client,
+                                    query_type,
+                                    max_in_flight,
+                                    sizer=sizer,
+                                    columns=columns),
+                      unit='chunk')
+        for number, (chunk, results) in enumerate(chunks):
+            with metrics.span('output_write', output_format=output_format):
+                save_file(results, file_path)
+            commit_chunk(file_path, output_format, number)
+            if on_chunk is not None:
+                on_chunk(chunk)
 
 
 #def load_dimensions_returns(path):
@@ -132,81 +561,244 @@ def get_all_citations(df):
 #                       low_memory=False)
 
 
-def basic_coverage(issns, returns, year):
-    print(f'Length of {year} ISSNs from the OJS: ',
-          len(issns))
-    unique_issns = len(issns)
-    print(f'Length of unique {year} ISSNs from OJS: ',
-          unique_issns)
-    print(f'Number articles returned from {year} across issns or eissns: ',
-          len(returns))
-    unique_issn_returns = len(returns['journal.issn'].unique())
-    print('Number of unique issns returned: ', unique_issn_returns)
-    unique_eissn_returns = len(returns['journal.eissn'].unique())
-    print('Number of unique eissns returned: ', unique_eissn_returns)
-    returns = returns.drop_duplicates()
-    all_issn = list(set(returns['journal.issn'].unique().tolist() +
-                        returns['journal.eissn'].unique().tolist()))
-    is_in_dim = issns[issns["issn_ojs"].isin(all_issn)]
-    print('Number of unique issn+eissns: ', len(all_issn))
-    print(round(len(is_in_dim)/len(issns)*100, 2))
-
-
-def get_refs_and_cites(issn_out, client):
-    all_pubs_from_issn = pd.read_csv(os.path.join(issn_out, 'pubs_from_all_issns.csv'),
-                                     usecols=[1, 2, 3],
-                                     names=['id',
-                                            'reference_ids',
-                                            'citations'])
-    print('Total number of papers', len(all_pubs_from_issn))
-    all_refs = get_all_refs(all_pubs_from_issn)
-    print('Total references to query: ', len(all_refs))
-    all_citations = get_all_citations(all_pubs_from_issn)
-    print('Total citations to query: ', len(all_citations))
-    file_name = 'references_of_all_pubs.csv'
-
-    file_path = os.path.join(issn_out, file_name)
-    num_pubids = 225000 # hardcoded to circumvent limits
-    get_all_data(num_pubids, file_path, client, all_refs, 'article')
-    file_name = 'citations_of_all_pubs.csv'
-    file_path = os.path.join(issn_out, file_name)
-    get_all_data(num_pubids, file_path, client, all_citations, 'article')
-
-
-def main():
+def basic_coverage(issns, returns, year, index=None, columns='full'):
+    """
+    Print and return the coverage report of a year's ISSN query.
+
+    :param returns: DataFrame of returns, or the path of a parquet or csv
+                    output of get_all_data, which is streamed
+    :param index: IssnIndex for ISSN-L aware coverage
+    :param columns: column profile or list the csv output was queried with
+    """
+    report = coverage_report(issns, returns, year, index,
+                             csv_names=csv_output_names(columns))
+    print_report(report)
+    return report
+
+
+def expand_hop(sources, issn_out, client, index, hop, output_format='csv',
+               columns='full'):
+    """
+    Query the references and citations of a set of publications which
+    the index has not seen yet, as either kind, recording each chunk once
+    it is saved.
+
+    :param sources: DataFrame or Table with reference_ids and citations
+    :param issn_out: directory holding the outputs
+    :param client: google query client
+    :param index: PubIdIndex of already fetched pub ids
+    :param hop: expansion depth being fetched, starting at 1
+    :param output_format: 'csv' or 'parquet'
+    :param columns: a query_builder column profile or list of columns
+    """
+    for kind, extract, name in [('reference', get_all_refs,
+                                 'references_of_all_pubs'),
+                                ('citation', get_all_citations,
+                                 'citations_of_all_pubs')]:
+        all_ids = extract(sources)
+        new_ids = index.unseen(all_ids)
+        print(f'Hop {hop}: {len(all_ids)} {kind}s, '
+              f'{len(new_ids)} not fetched before')
+        if len(new_ids) == 0:
+            continue
+        file_path = os.path.join(issn_out, output_name(name, output_format))
+        get_all_data(None, file_path, client, new_ids, 'article',
+                     stream=True, output_format=output_format,
+                     columns=columns,
+                     on_chunk=lambda chunk, kind=kind:
+                     index.mark_fetched(kind, chunk, hop))
+
+
+def get_refs_and_cites(issn_out, client, output_format='csv', hops=1,
+                       columns='full'):
+    """
+    Expand the ISSN publications by their references and citations,
+    querying only pub ids which no earlier run has fetched, nor the ISSN
+    publications themselves. With hops > 1 the publications added by one
+    hop are expanded again in the next.
+    """
+    index = PubIdIndex(os.path.join(issn_out, 'fetched_pub_ids.sqlite'))
+    if len(index) == 0:
+        fill_index(index, issn_out, output_format)
+    pubs_path = os.path.join(issn_out,
+                             output_name('pubs_from_all_issns', output_format))
+    sources = read_links(pubs_path, output_format)
+    index.mark_fetched('seed', link_ids(sources), 0)
+    print('Total number of papers', len(sources))
+    for hop in range(1, hops + 1):
+        if hop > 1:
+            fetched = index.fetched_at(hop - 1)
+            paths = [os.path.join(issn_out, output_name(name, output_format))
+                     for name in ['references_of_all_pubs',
+                                  'citations_of_all_pubs']]
+            sources = [read_links(path, output_format, ids=fetched)
+                       for path in paths if os.path.exists(path)]
+            if len(fetched) == 0 or len(sources) == 0:
+                print(f'Nothing new to expand at hop {hop}')
+                break
+            if output_format == 'parquet':
+                sources = pa.concat_tables(sources)
+            else:
+                sources = pd.concat(sources)
+            print(f'Hop {hop}: expanding {len(sources)} papers')
+        expand_hop(sources, issn_out, client, index, hop, output_format,
+                   columns)
+    print(f'Fetched pub ids so far: {index.counts()}')
+    index.close()
+
+
+def expand_server_side(issns, client, kind, destination, file_path,
+                       output_format='csv', columns='full',
+                       bqstorage_client=None):
+    """
+    Fetch the publications referenced by, or citing, the articles of a
+    set of ISSNs in a single job, unnesting reference_ids and citations
+    inside BigQuery and writing the result to a destination table. Only
+    the final rows are then streamed down from that table.
+
+    :param issns: list of ISSNs whose articles are expanded
+    :param client: google query client
+    :param kind: 'reference' or 'citation'
+    :param destination: table id the job writes to, replacing its contents
+    :param file_path: output csv file or parquet directory
+    :param output_format: 'csv' or 'parquet'
+    :param columns: a query_builder column profile or list of columns
+    :param bqstorage_client: optional Storage Read API client for the download
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("issns", "STRING",
+                                                       list(issns))],
+        destination=destination,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    query_job = client.query(build_expansion_query(kind, columns),
+                             job_config=job_config)
+    with metrics.span('bigquery_expansion', query_type=kind):
+        query_job.result()
+    record_job(query_job, kind)
+    print(f'{kind}s written to {destination}: '
+          f'{estimate_cost(query_job.total_bytes_processed or 0)}')
+    # the destination table was truncated, so the local copy is replaced too
+    remove_output(file_path)
+    rows = client.list_rows(destination)
+    save_batches(chain(((0, None, batch) for batch in
+                        tqdm(rows.to_arrow_iterable(
+                            bqstorage_client=bqstorage_client),
+                             unit='batch')),
+                       [(0, None, None)]),
+                 file_path,
+                 output_format)
+
+
+def get_refs_and_cites_server_side(issns, issn_out, client, dataset,
+                                   output_format='csv', columns='full'):
+    """
+    Server-side counterpart of get_refs_and_cites: nothing but the final
+    reference and citation rows leaves BigQuery.
+
+    :param dataset: dataset id, e.g. 'project.scratch', to hold the
+                    intermediate tables
+    """
+    for kind, name in [('reference', 'references_of_all_pubs'),
+                       ('citation', 'citations_of_all_pubs')]:
+        expand_server_side(issns, client, kind, f'{dataset}.{name}',
+                           os.path.join(issn_out,
+                                        output_name(name, output_format)),
+                           output_format,
+                           columns)
+
+
+def build_citation_graph(issn_out, output_format='csv', index=None,
+                         columns='full'):
+    """
+    Build the citation graph of everything collected for a year, from the
+    ISSN, reference and citation outputs, and save it to
+    issn_out/citation_graph.
+
+    :param index: IssnIndex to key journals by ISSN-L
+    :return: the CitationGraph
+    """
+    sources = [os.path.join(issn_out, output_name(name, output_format))
+               for name in ['pubs_from_all_issns', 'references_of_all_pubs',
+                            'citations_of_all_pubs']]
+    graph = CitationGraph.from_publications(
+        [source for source in sources if os.path.exists(source)],
+        index, csv_output_names(columns))
+    graph.save(os.path.join(issn_out, 'citation_graph'))
+    print(f'Citation graph: {graph.nodes} pubs, {graph.edges} citations')
+    return graph
+
+
+def issn_output_dir(year, data_root=DATA_ROOT):
+    """ Helper function to get the directory of a year's BigQuery outputs"""
+    return os.path.join(data_root, 'raw', 'from_dimensions', 'issn', str(year))
+
+
+def collect_issns(issns, issn_out, client, output_format='parquet',
+                  columns='full'):
+    """
+    Query the articles of a list of ISSNs into issn_out.
+
+    :return: path of the pubs_from_all_issns output
+    """
+    os.makedirs(issn_out, exist_ok=True)
+    file_path = os.path.join(issn_out, output_name('pubs_from_all_issns',
+                                                   output_format))
+    get_all_data(None,
+                 file_path,
+                 client,
+                 issns,
+                 'issn',
+                 stream=True,
+                 output_format=output_format,
+                 columns=columns)
+    return file_path
+
+
+def expand_issns(issns, issn_out, client, output_format='parquet',
+                 columns='full', server_side_dataset=None):
+    """
+    Fetch the references and citations of the articles collected for a
+    list of ISSNs, server-side when given a dataset to expand them in.
+    """
+    if server_side_dataset is not None:
+        get_refs_and_cites_server_side(issns, issn_out, client,
+                                       server_side_dataset, output_format,
+                                       columns)
+    else:
+        get_refs_and_cites(issn_out, client, output_format, columns=columns)
+
+
+def main(year=2022, data_root=DATA_ROOT, output_format='parquet',
+         columns='full', server_side_dataset=None, metrics_path=None):
+    """
+    :param year: year of the OJS ISSN list
+    :param data_root: data directory holding the raw inputs and outputs
+    :param server_side_dataset: if given, a BigQuery dataset id in which
+                                references and citations are expanded
+                                server-side instead of via the client
+    :param metrics_path: if given, a Prometheus textfile the run's
+                         metrics are written to
+    """
+    metrics.reset()
     MY_PROJECT_ID = "dimensionsv3"
-    year = 2022
     print('Initializing GBQ')
     client = bigquery.Client(project=MY_PROJECT_ID)
-    issn_out = os.path.join('..',
-                            'data',
-                            'raw',
-                            'from_dimensions',
-                            'issn',
-                            str(year))
-    doi_out = os.path.join('..',
-                           'data',
-                           'raw',
-                           'from_dimensions',
-                           'doi'
-                           )
-    issn_file_name = 'pubs_from_all_issns.csv'
+    issn_out = issn_output_dir(year, data_root)
+    issn_file_name = output_name('pubs_from_all_issns', output_format)
     dim_issn_out_path = os.path.join(issn_out, issn_file_name)
-    number_issns = 3000 # hardcoded to circumvent limits: why needed?
-    raw_path = os.path.join("..", "data", "raw")
     print('Loading raw ISSN data')
-    raw_issn = load_issns(os.path.join(raw_path,
-                                       'issn_inputs'),
-                          year)
-    issns_to_query = raw_issn["issn_ojs"].tolist()
-    # Get all ISSN data here
-    if os.path.exists(dim_issn_out_path) is False:
-        get_all_data(number_issns,
-                     dim_issn_out_path,
-                      client,
-                      issns_to_query,
-                      'issn')
-    get_refs_and_cites(issn_out, client)
+    raw_issn = load_issns(os.path.join(data_root, 'raw', 'issn_inputs'), year)
+    issns_to_query = raw_issn["issn_ojs"].dropna().astype(str).tolist()
+    # Get all ISSN data here, unless an earlier run committed it
+    if not has_committed_rows(dim_issn_out_path, output_format):
+        collect_issns(issns_to_query, issn_out, client, output_format, columns)
+    expand_issns(issns_to_query, issn_out, client, output_format, columns,
+                 server_side_dataset)
+    build_citation_graph(issn_out, output_format, columns=columns)
+    metrics.write_summary(os.path.join(data_root, '..', 'logging',
+                                       f'gbq_collector_{year}_summary.json'))
+    if metrics_path is not None:
+        metrics.write_textfile(metrics_path)
 
 
 if __name__ == '__main__':
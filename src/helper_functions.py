@@ -1,6 +1,11 @@
 import pandas as pd
+import numpy as np
 import os
 
+from issn_index import load_or_build_issn_index, encode_issns, \
+    decode_issns, check_digits_valid, MISSING
+from coverage import coverage_report, print_report
+
 article_headers = ['id', 'title.preferred', 'doi', 'journal.issn', 'journal.eissn',
                    'type', 'date_normal', 'category_for',
                    'citations_count', 'research_org_cities',
@@ -8,71 +13,145 @@ article_headers = ['id', 'title.preferred', 'doi', 'journal.issn', 'journal.eiss
                    'altmetrics', 'reference_ids',
                    'citations']
 
+# BigQuery names the selected journal.issn and journal.eissn fields
+# issn and eissn, which is how they are stored in the parquet outputs
+parquet_columns = {'journal.issn': 'issn', 'journal.eissn': 'eissn'}
+coverage_columns = ['journal.issn', 'journal.eissn']
+DATA_ROOT = os.path.join('..', 'data')
+ISSN_L_DUMP = '20230427.ISSN-to-ISSN-L.txt'
+
+
+def validate_issns(issns):
+    """
+    Normalise and validate ISSNs in one vectorised pass.
+
+    :param issns: iterable of raw ISSN strings
+    :return: (encoded keys, status) where status is 'ok', 'bad_format'
+             or 'bad_check_digit' for every ISSN
+    """
+    keys = encode_issns(issns)
+    status = np.where(keys == MISSING, 'bad_format',
+                      np.where(check_digits_valid(keys), 'ok',
+                               'bad_check_digit'))
+    return keys, status
+
+
+def spine_rows(issn_inputs, index):
+    """
+    Join OJS ISSNs to their ISSN-L and every ISSN of that ISSN-L, in long
+    format: one row per (input row, ISSN) pair. Input rows whose ISSN is
+    invalid or has no ISSN-L are kept once, with empty ISSN-L and ISSN.
+
+    :return: (spine DataFrame, status of every input row)
+    """
+    keys, status = validate_issns(issn_inputs['issn_ojs'])
+    issn_l = index.to_issn_l(np.where(status == 'ok', keys, MISSING))
+    status = np.where((status == 'ok') & (issn_l == MISSING), 'no_issn_l',
+                      status)
+    start, stop = index.group_bounds(issn_l)
+    counts = np.maximum(stop - start, 1)
+    row = np.repeat(np.arange(len(issn_inputs)), counts)
+    member = np.repeat(start, counts) + np.arange(len(row)) - \
+        np.repeat(np.cumsum(counts) - counts, counts)
+    grouped = np.repeat(stop > start, counts)
+    member = np.minimum(member, max(len(index.group_issn) - 1, 0))
+    issn = np.full(len(row), MISSING, dtype=np.int64)
+    if len(index.group_issn) > 0:
+        issn = np.where(grouped, index.group_issn[member], MISSING)
+    spine = issn_inputs.iloc[row].reset_index(drop=True)
+    spine['issn_normalised'] = decode_issns(keys[row])
+    spine['issn_status'] = status[row]
+    spine['ISSN-L'] = decode_issns(issn_l[row])
+    spine['ISSN'] = decode_issns(issn)
+    return spine, status
+
+
+def build_spine(issn_inputs, index, merged_spine_path=None, chunk_size=100000):
+    """
+    Build the OJS spine from an IssnIndex, streaming it to csv in chunks.
 
-def build_spine(issn_inputs_2021, issn_to_issn_L, issn_l_to_issn):
-    merged_spine = pd.merge(issn_inputs_2021, issn_to_issn_L,
-                            how='left',
-                            left_on='issn_ojs',
-                            right_on='ISSN')
-    merged_spine = pd.merge(merged_spine,
-                           issn_l_to_issn,
-                           how='left',
-                           left_on='ISSN-L',
-                           right_on = 'ISSN-L')
-    merged_spine = merged_spine.drop('ISSN', axis=1)
-    merged_spine_path = os.path.join(os.getcwd(),
-                                     '..',
-                                     'data',
-                                     'merged_spine',
-                                     'merged_OJS_spine.csv')
-    number_null = len(merged_spine[~merged_spine['ISSN-L'].notnull()])
-    print(f'Number of unmerged ISSNs: {number_null}')
-    unique_issn_l = merged_spine['ISSN-L'].unique()
+    :param issn_inputs: DataFrame with an issn_ojs column
+    :param index: IssnIndex, e.g. from prepare_issn_l(as_index=True)
+    :param merged_spine_path: output csv, by default
+                              data/merged_spine/merged_OJS_spine.csv
+    :param chunk_size: input rows joined and written at a time
+    :return: number of input rows of every status
+    """
+    if merged_spine_path is None:
+        merged_spine_path = os.path.join(DATA_ROOT,
+                                         'merged_spine',
+                                         'merged_OJS_spine.csv')
+    os.makedirs(os.path.dirname(merged_spine_path) or '.', exist_ok=True)
+    status_counts = {}
+    unique_issn_l = set()
+    for position in range(0, max(len(issn_inputs), 1), chunk_size):
+        spine, status = spine_rows(issn_inputs.iloc[position:position + chunk_size],
+                                   index)
+        for value, count in zip(*np.unique(status, return_counts=True)):
+            status_counts[str(value)] = status_counts.get(str(value), 0) + int(count)
+        unique_issn_l.update(spine['ISSN-L'].dropna().unique().tolist())
+        spine.to_csv(merged_spine_path, index=False,
+                     mode='w' if position == 0 else 'a',
+                     header=position == 0)
+    number_null = sum(count for status, count in status_counts.items()
+                      if status != 'ok')
+    print(f'Number of unmerged ISSNs: {number_null} {status_counts}')
     print(f'Number of unique ISSN-Ls: {len(unique_issn_l)}')
-    merged_spine.to_csv(merged_spine_path, index=False)
-
-
-def prepare_issn_l():
-    issn_l_path = os.path.join(os.getcwd(), '..', 'data', 'issn_l_lookup')
-    issn_to_issn_l = os.path.join(issn_l_path, '20230427.ISSN-to-ISSN-L.txt')
-    issn_to_issn_l = pd.read_csv(issn_to_issn_l, sep='\t', index_col=False)
-    issn_l_to_issn_filepath = os.path.join(issn_l_path,
-                                           '20230427.ISSN-L-to-ISSN.txt')
-    index = pd.read_csv(issn_l_to_issn_filepath, sep='\t',
-                        usecols = ['ISSN-L'], index_col=False)
-    issn_l_to_issn = pd.DataFrame(index = index['ISSN-L'],
-                                  columns = ['All ISSN'])
-    file1 = open(issn_l_to_issn_filepath, 'r')
-    Lines = file1.readlines()
-    count = 0
-    for line in Lines:
-        count += 1
-        if count>1:
-            split_line = line.strip().split('\t')
-            issn_l = split_line[0]
-            issns = split_line[1:]
-            issn_l_to_issn.at[issn_l, 'All ISSN'] = issns
-    issn_l_to_issn = issn_l_to_issn.reset_index()
+    return status_counts
+
+
+def issn_l_paths(data_root=DATA_ROOT, dump_path=None):
+    """
+    Helper function to locate the ISSN-to-ISSN-L dump and its index.
+
+    :return: (dump path, index directory)
+    """
+    issn_l_path = os.path.join(data_root, 'issn_l_lookup')
+    if dump_path is None:
+        dump_path = os.path.join(issn_l_path, ISSN_L_DUMP)
+    return dump_path, os.path.join(issn_l_path, 'index')
+
+
+def prepare_issn_l(as_index=False, data_root=DATA_ROOT, dump_path=None):
+    """
+    Load the ISSN <-> ISSN-L lookup from its persisted index, building the
+    index from the ISSN-to-ISSN-L dump the first time round.
+
+    :param as_index: return the IssnIndex itself rather than the two
+                     DataFrames the index can be expanded into
+    :param data_root: data directory holding issn_l_lookup
+    :param dump_path: ISSN-to-ISSN-L dump, by default the one in
+                      issn_l_lookup
+    """
+    dump_path, index_dir = issn_l_paths(data_root, dump_path)
+    index = load_or_build_issn_index(index_dir, dump_path)
+    if as_index:
+        return index
+    issn_to_issn_l = pd.DataFrame({'ISSN': decode_issns(index.issn),
+                                   'ISSN-L': decode_issns(index.issn_l)})
+    issn_l_keys, starts = np.unique(index.group_issn_l, return_index=True)
+    groups = np.split(decode_issns(index.group_issn), starts[1:])
+    issn_l_to_issn = pd.DataFrame({'ISSN-L': decode_issns(issn_l_keys),
+                                   'All ISSN': [group.tolist()
+                                                for group in groups]})
     return issn_to_issn_l, issn_l_to_issn
 
 
+def basic_coverage(issns, returns, year, index=None, **kwargs):
+    """
+    Print and return the coverage report of a year's OJS ISSNs.
 
-def basic_coverage(issns, returns, year):
-    print('Length of ISSNs in the raw file: ',
-          len(issns))
-    unique_issns = len(issns['issn_ojs'].unique())
-    print(f'Length of unique {year} ISSNs from Saurabh: ',
-          unique_issns)
-    print(f'Number of articles returned from Dimensions {year} across all p-issns or e-issns: ',
-          len(returns))
-    unique_issn_returns = len(returns['journal.issn'].unique())
-    print('Number of unique issns returned: ', unique_issn_returns)
-    unique_eissn_returns = len(returns['journal.eissn'].unique())
-    print('Number of unique eissns returned: ', unique_eissn_returns)
-    all_issn = list(set(returns['journal.issn'].unique().tolist() +
-                        returns['journal.eissn'].unique().tolist()))
-    print('Number of unique issn+eissns: ', len(all_issn))
-    print(100*len(all_issn)/unique_issns)
+    :param returns: DataFrame of returns, or the path of a year's parquet
+                    dataset or csv, as from dimensions_returns_path,
+                    which is then streamed rather than loaded
+    :param index: IssnIndex, e.g. from prepare_issn_l(as_index=True), for
+                  ISSN-L aware coverage
+    """
+    if isinstance(returns, str) and not returns.endswith('.parquet'):
+        kwargs.setdefault('csv_names', ['index'] + article_headers)
+    report = coverage_report(issns, returns, year, index, **kwargs)
+    print_report(report)
+    return report
 
 
 def load_issns(path, year):
@@ -80,10 +159,33 @@ def load_issns(path, year):
                                     f'full_ojs_issn_list_{year}.csv'))
 
 
-def load_dimensions_returns(path, year):
-    return pd.read_csv(os.path.join(path, year,
-                                    'pubs_from_all_issns.csv'),
-                       index_col=0,
-                       names=article_headers,
-                       low_memory=False
-                      )
\ No newline at end of file
+def dimensions_returns_path(path, year):
+    """ Helper function to locate a year's returns, preferring parquet"""
+    parquet_path = os.path.join(path, year, 'pubs_from_all_issns.parquet')
+    if os.path.exists(parquet_path):
+        return parquet_path
+    return os.path.join(path, year, 'pubs_from_all_issns.csv')
+
+
+def load_dimensions_returns(path, year, columns=None):
+    """
+    Load the publications collected for a year. A parquet dataset is
+    preferred over the legacy csv, and only the requested columns are
+    read from it; the csv is always read whole and then subset.
+    """
+    returns_path = dimensions_returns_path(path, year)
+    if returns_path.endswith('.parquet'):
+        if columns is not None:
+            columns = [parquet_columns.get(column, column)
+                       for column in columns]
+        returns = pd.read_parquet(returns_path, columns=columns)
+        return returns.rename(columns={value: key for key, value
+                                       in parquet_columns.items()})
+    returns = pd.read_csv(returns_path,
+                          index_col=0,
+                          names=article_headers,
+                          low_memory=False
+                         )
+    if columns is not None:
+        returns = returns[columns]
+    return returns
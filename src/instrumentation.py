@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the latency histogram buckets: from a
+# cached API response up to a long BigQuery job
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600)
+
+
+def redact_key(key):
+    """ Helper function to show an API key by its last four characters only"""
+    key = str(key)
+    return '****' + key[-4:] if len(key) > 4 else '****'
+
+
+class Histogram:
+    """Bucketed distribution of observations, with count, sum, min and max."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating within its bucket."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[position - 1] if position > 0 else 0.0
+                upper = self.buckets[position] \
+                    if position < len(self.buckets) else self.max
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'sum': round(self.sum, 6),
+                'mean': round(self.sum / self.count, 6) if self.count else None,
+                'min': self.min,
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'max': self.max}
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and histograms for a run.
+
+    Every metric is identified by a name and a set of labels, such as
+    the query type of a BigQuery job or the endpoint of an API call.
+    Labels naming an API key must be passed through redact_key. The
+    registry is written out as a JSON run summary and, optionally, as a
+    Prometheus textfile for a node exporter to pick up. It holds the
+    metrics of one run: reset it before each run in the same process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((label, str(value))
+                                  for label, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter."""
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Record an observation in a histogram."""
+        key = self._key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Time a block into the histogram name_seconds, counting the blocks
+        which raise in name_errors.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(f'{name}_errors', **labels)
+            raise
+        finally:
+            self.observe(f'{name}_seconds', time.perf_counter() - start,
+                         **labels)
+
+    def summary(self):
+        """
+        Summarise the run.
+
+        :return: a dict of the run's start, end and duration and of every
+                 metric, with histograms reduced to count, sum, mean,
+                 min, median, 95th percentile and max
+        """
+        with self.lock:
+            finished = time.time()
+
+            def entries(metrics, value):
+                return [{'name': name, 'labels': dict(labels),
+                         **value(metric)}
+                        for (name, labels), metric in sorted(metrics.items())]
+
+            return {'started': self.started,
+                    'finished': finished,
+                    'seconds': round(finished - self.started, 3),
+                    'counters': entries(self.counters,
+                                        lambda value: {'value': value}),
+                    'gauges': entries(self.gauges,
+                                      lambda value: {'value': value}),
+                    'histograms': entries(self.histograms,
+                                          lambda histogram:
+                                          histogram.summary())}
+
+    def prometheus_text(self):
+        """
+        Render every metric in the Prometheus text exposition format
+        0.0.4, which the node exporter's textfile collector parses.
+        Counters are exposed as name_total, the name on their TYPE line.
+        """
+        lines = []
+        with self.lock:
+            for kind, metrics in (('counter', self.counters),
+                                  ('gauge', self.gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    exposed = f'{name}_total' if kind == 'counter' and \
+                        not name.endswith('_total') else name
+                    lines.append(f'# TYPE {exposed} {kind}')
+                    for (metric, labels), value in sorted(metrics.items()):
+                        if metric == name:
+                            lines.append(f'{exposed}'
+                                         f'{format_labels(labels)} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE {name} histogram')
+                for (metric, labels), histogram in \
+                        sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    bounds = [str(bound) for bound in histogram.buckets]
+                    for bound, count in zip(bounds + ['+Inf'],
+                                            histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket'
+                                     f'{format_labels(labels, le=bound)} '
+                                     f'{cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} '
+                                 f'{histogram.sum}')
+                    lines.append(f'{name}_count{format_labels(labels)} '
+                                 f'{histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_summary(self, path):
+        """Write the run summary as JSON."""
+        write_atomically(path, json.dumps(self.summary(), indent=1))
+
+    def write_textfile(self, path):
+        """
+        Write the Prometheus textfile, replacing it in one step so that
+        a collector never reads it half written.
+        """
+        write_atomically(path, self.prometheus_text())
+
+
+def format_labels(labels, **extra):
+    """ Helper function to render labels, escaped, as {name="value",...}"""
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    escaped = [(label, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n')) for label, value in labels]
+    return '{' + ','.join(f'{label}="{value}"'
+                          for label, value in escaped) + '}'
+
+
+def write_atomically(path, text):
+    """ Helper function to write a file via a temporary file and a rename"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as file:
+        file.write(text)
+    os.replace(temporary, path)
+
+
+# Registry shared by the collectors of a run
+metrics = Metrics()
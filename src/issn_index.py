@@ -0,0 +1,196 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+MISSING = -1
+ISSN_PATTERN = r'\d{7}[\dX]'
+
+
+def normalise_issns(values):
+    """
+    Normalise ISSNs to their eight bare characters: upper case, with
+    hyphens, whitespace and any other separators removed.
+
+    :param values: iterable of ISSN strings, possibly with missing values
+    :return: a pandas string Series
+    """
+    values = pd.Series(values, dtype='string')
+    return values.str.upper().str.replace(r'[^0-9X]', '', regex=True)
+
+
+def encode_issns(values):
+    """
+    Encode ISSNs as integers: the first seven digits times eleven plus
+    the check character, where X counts as 10. The encoding is compact,
+    order preserving and exactly reversible.
+
+    :param values: iterable of ISSN strings, possibly with missing values
+    :return: an int64 array, MISSING where a value is not an ISSN
+    """
+    issns = normalise_issns(values)
+    valid = issns.str.fullmatch(ISSN_PATTERN).fillna(False).to_numpy(bool)
+    keys = np.full(len(issns), MISSING, dtype=np.int64)
+    if valid.any():
+        issns = issns[valid]
+        digits = issns.str.slice(0, 7).astype('int64').to_numpy()
+        check = issns.str.slice(7).replace('X', '10').astype('int64').to_numpy()
+        keys[valid] = digits * 11 + check
+    return keys
+
+
+def check_digits_valid(keys):
+    """
+    Validate the ISSN check character of encoded ISSNs: the seven digits
+    weighted 8 down to 2 plus the check value must be divisible by 11.
+
+    :param keys: array of keys as made by encode_issns
+    :return: a boolean array, False for MISSING keys
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    digits = keys // 11
+    total = np.zeros(len(keys), dtype=np.int64)
+    for weight in range(2, 9):
+        total += (digits % 10) * weight
+        digits //= 10
+    return (keys != MISSING) & ((total + keys % 11) % 11 == 0)
+
+
+def decode_issns(keys):
+    """
+    Turn encoded ISSNs back into hyphenated strings.
+
+    :param keys: array of keys as made by encode_issns
+    :return: an object array of ISSNs, None where a key is MISSING
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    valid = keys != MISSING
+    digits = pd.Series(keys[valid] // 11).astype(str).str.zfill(7)
+    check = pd.Series(keys[valid] % 11).astype(str).replace('10', 'X')
+    issns = np.full(len(keys), None, dtype=object)
+    issns[valid] = (digits.str.slice(0, 4) + '-' + digits.str.slice(4) +
+                    check).to_numpy()
+    return issns
+
+
+class IssnIndex:
+    """
+    Two-way ISSN <-> ISSN-L lookup held in sorted integer arrays.
+
+    issn/issn_l map every ISSN to its ISSN-L and are sorted by ISSN;
+    group_issn_l/group_issn hold the same pairs sorted by ISSN-L, so all
+    ISSNs of an ISSN-L form one contiguous run. Lookups are binary
+    searches, and the arrays are saved as .npy files which load memory
+    mapped in well under a second.
+    """
+
+    FILES = ('issn', 'issn_l', 'group_issn_l', 'group_issn')
+
+    def __init__(self, issn, issn_l, group_issn_l, group_issn):
+        self.issn = issn
+        self.issn_l = issn_l
+        self.group_issn_l = group_issn_l
+        self.group_issn = group_issn
+
+    @classmethod
+    def from_pairs(cls, issn_keys, issn_l_keys):
+        """Build an index from aligned arrays of encoded ISSNs and ISSN-Ls."""
+        keep = (issn_keys != MISSING) & (issn_l_keys != MISSING)
+        issn_keys, issn_l_keys = issn_keys[keep], issn_l_keys[keep]
+        by_issn = np.argsort(issn_keys, kind='stable')
+        by_issn_l = np.lexsort((issn_keys, issn_l_keys))
+        return cls(issn_keys[by_issn], issn_l_keys[by_issn],
+                   issn_l_keys[by_issn_l], issn_keys[by_issn_l])
+
+    @classmethod
+    def from_issn_to_issn_l_file(cls, path):
+        """Build an index from an ISSN-to-ISSN-L.txt dump of issn.org."""
+        pairs = pd.read_csv(path, sep='\t', usecols=['ISSN', 'ISSN-L'],
+                            dtype=str, index_col=False)
+        return cls.from_pairs(encode_issns(pairs['ISSN']),
+                              encode_issns(pairs['ISSN-L']))
+
+    def save(self, index_dir, source=None):
+        """
+        Save the arrays, plus a manifest recording the source file's size
+        and modification time so that load_or_build can spot a new dump.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        for name in self.FILES:
+            np.save(os.path.join(index_dir, f'{name}.npy'), getattr(self, name))
+        manifest = {} if source is None else source_signature(source)
+        with open(os.path.join(index_dir, 'manifest.json'), 'w') as file:
+            json.dump(manifest, file)
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        mode = 'r' if mmap else None
+        return cls(*[np.load(os.path.join(index_dir, f'{name}.npy'),
+                             mmap_mode=mode)
+                     for name in cls.FILES])
+
+    def to_issn_l(self, issns):
+        """
+        Look up the ISSN-L of each ISSN.
+
+        :param issns: ISSN strings or encoded keys
+        :return: an array of encoded ISSN-Ls, MISSING where unknown
+        """
+        keys = as_keys(issns)
+        if len(self.issn) == 0:
+            return np.full(len(keys), MISSING, dtype=np.int64)
+        position = np.searchsorted(self.issn, keys)
+        position = np.minimum(position, len(self.issn) - 1)
+        found = (self.issn[position] == keys) & (keys != MISSING)
+        return np.where(found, self.issn_l[position], MISSING)
+
+    def group_bounds(self, issn_ls):
+        """
+        Locate the run of ISSNs belonging to each ISSN-L.
+
+        :param issn_ls: ISSN-L strings or encoded keys
+        :return: (start, stop) arrays indexing group_issn; empty runs
+                 where an ISSN-L is unknown
+        """
+        keys = as_keys(issn_ls)
+        start = np.searchsorted(self.group_issn_l, keys, side='left')
+        stop = np.searchsorted(self.group_issn_l, keys, side='right')
+        stop = np.where(keys == MISSING, start, stop)
+        return start, stop
+
+    def issns_of(self, issn_l):
+        """Return every ISSN sharing an ISSN-L, as strings."""
+        start, stop = self.group_bounds([issn_l])
+        return decode_issns(self.group_issn[start[0]:stop[0]]).tolist()
+
+
+def as_keys(issns):
+    """ Helper function to accept either ISSN strings or encoded keys"""
+    issns = np.asarray(issns)
+    if np.issubdtype(issns.dtype, np.integer):
+        return issns.astype(np.int64)
+    return encode_issns(issns)
+
+
+def source_signature(path):
+    status = os.stat(path)
+    return {'source': os.path.basename(path),
+            'size': status.st_size,
+            'mtime': status.st_mtime}
+
+
+def load_or_build_issn_index(index_dir, issn_to_issn_l_path):
+    """
+    Load the persisted index, rebuilding it first if it is missing or
+    was built from a different ISSN-to-ISSN-L dump.
+    """
+    manifest_path = os.path.join(index_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            if json.load(file) == source_signature(issn_to_issn_l_path):
+                return IssnIndex.load(index_dir)
+    print('Building ISSN-L index')
+    index = IssnIndex.from_issn_to_issn_l_file(issn_to_issn_l_path)
+    index.save(index_dir, source=issn_to_issn_l_path)
+    return IssnIndex.load(index_dir)
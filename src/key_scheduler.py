@@ -0,0 +1,305 @@
+import time
+import random
+import threading
+
+import requests
+from loguru import logger
+
+from instrumentation import metrics, redact_key
+from response_cache import endpoint_of
+
+CALLS_PER_SECOND = 8  # max of 8 requests per 1 second, per key
+SUCCESS_STATUSES = (200, 404)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETIRE_STATUSES = (401,)
+
+
+class KeysExhaustedError(RuntimeError):
+    """Raised when every API key has been retired."""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket which limits the request rate of one API key.
+
+    Parameters
+    ----------
+    rate : float
+        number of tokens added to the bucket per second
+    capacity : int
+        maximum number of tokens the bucket can hold, i.e. the burst size
+
+    """
+
+    def __init__(self, rate=CALLS_PER_SECOND, capacity=CALLS_PER_SECOND):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and then consume it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class KeyState:
+    """
+    Quota and health bookkeeping for a single API key.
+
+    remaining, limit and reset mirror the X-RateLimit-* response headers
+    and stay None until the key has answered its first request.
+    """
+
+    def __init__(self, key, rate=CALLS_PER_SECOND):
+        self.key = key
+        self.bucket = TokenBucket(rate, rate)
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.parked_until = 0.0
+        self.failures = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.retired = False
+
+    def headroom(self):
+        """Calls we can still make on this key, net of those in flight."""
+        if self.remaining is None:
+            return float('inf')
+        return self.remaining - self.in_flight
+
+
+def parse_rate_limit_headers(headers):
+    """
+    Helper function to read the Elsevier quota headers of a response.
+
+    Returns
+    -------
+    (limit, remaining, reset) with None for any header which is missing
+    or unparseable; reset is an epoch timestamp in seconds
+
+    """
+    parsed = []
+    for name in ('X-RateLimit-Limit', 'X-RateLimit-Remaining',
+                 'X-RateLimit-Reset'):
+        try:
+            parsed.append(int(float(headers.get(name))))
+        except (TypeError, ValueError):
+            parsed.append(None)
+    return tuple(parsed)
+
+
+class KeyScheduler:
+    """
+    Header-driven scheduler which hands out API keys to concurrent requests.
+
+    Every response is fed back into the scheduler, which tracks remaining
+    quota and reset time per key from the X-RateLimit-* headers. acquire()
+    always picks the live key with the most headroom. Exhausted keys are
+    parked until their quota resets, or retired for the rest of the run
+    if that is further away than max_park seconds; keys answering 401 are
+    retired straight away. 429 and 5xx responses park only the key that
+    received them, with exponential backoff and full jitter.
+
+    Parameters
+    ----------
+    keys : list
+        API keys as returned by make_apikey_list()
+    call : callable
+        function taking (url, key) and returning a response object
+    rate : float
+        requests per second allowed on each key
+    max_park : float
+        longest wait, in seconds, for a key's quota to reset before the
+        key is retired instead
+    backoff_base : float
+        first backoff interval, in seconds
+    backoff_cap : float
+        longest backoff interval, in seconds
+    max_attempts : int
+        attempts per url before request() gives up
+
+    """
+
+    def __init__(self, keys, call, rate=CALLS_PER_SECOND, max_park=3600,
+                 backoff_base=1, backoff_cap=60, max_attempts=10):
+        if len(keys) == 0:
+            raise ValueError('No API keys to schedule')
+        self.states = [KeyState(key, rate) for key in keys]
+        self.call = call
+        self.max_park = max_park
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_attempts = max_attempts
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Block until a key is usable and reserve one call on it.
+
+        Raises
+        ------
+        KeysExhaustedError
+            if every key has been retired
+
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                live = [state for state in self.states if not state.retired]
+                for state in live:
+                    if state.remaining == 0 and state.parked_until <= now:
+                        # quota has reset, the next response will tell us by how much
+                        state.remaining = None
+                if len(live) == 0:
+                    raise KeysExhaustedError('All API keys are retired')
+                ready = [state for state in live
+                         if state.parked_until <= now and state.headroom() > 0]
+                if ready:
+                    state = max(ready, key=lambda s: (s.headroom(),
+                                                      -s.in_flight))
+                    state.in_flight += 1
+                    state.calls += 1
+                    return state
+                parked = [state.parked_until for state in live
+                          if state.parked_until > now]
+                timeout = min(parked) - now if parked else None
+                self.condition.wait(timeout=timeout)
+
+    def _park(self, state, until, reason):
+        if until - time.time() > self.max_park:
+            state.retired = True
+            metrics.inc('scopus_key_retirements', key=redact_key(state.key))
+            logger.warning(f'Retiring key {redact_key(state.key)}: {reason}')
+        else:
+            state.parked_until = max(state.parked_until, until)
+            metrics.inc('scopus_key_parks', key=redact_key(state.key))
+            logger.info(f'Parking key {redact_key(state.key)} for '
+                        f'{until - time.time():.1f}s: {reason}')
+
+    def _backoff(self, state, reason):
+        state.failures += 1
+        state.errors += 1
+        interval = min(self.backoff_cap,
+                       self.backoff_base * 2 ** (state.failures - 1))
+        self._park(state, time.time() + random.uniform(0, interval), reason)
+
+    def record(self, state, response):
+        """
+        Update the key's quota from a response and release its reservation.
+
+        Returns
+        -------
+        True if the response is final (200 or 404), False if the url
+        should be retried
+
+        """
+        limit, remaining, reset = parse_rate_limit_headers(response.headers)
+        status = response.status_code
+        with self.condition:
+            state.in_flight -= 1
+            if limit is not None:
+                state.limit = limit
+            if remaining is not None:
+                state.remaining = remaining
+                metrics.set('scopus_key_remaining', remaining,
+                            key=redact_key(state.key))
+            if reset is not None:
+                state.reset = reset
+            if status in RETIRE_STATUSES:
+                state.retired = True
+                metrics.inc('scopus_key_retirements', key=redact_key(state.key))
+                logger.warning(f'Retiring key {redact_key(state.key)}: '
+                               f'status {status}')
+            elif remaining == 0:
+                until = reset if reset is not None else \
+                    time.time() + self.backoff_cap
+                self._park(state, until, 'quota exhausted')
+            elif status in RETRY_STATUSES:
+                self._backoff(state, f'status {status}')
+            elif status in SUCCESS_STATUSES:
+                state.failures = 0
+            self.condition.notify_all()
+        # a response exhausting the quota is still a usable response
+        return status in SUCCESS_STATUSES
+
+    def record_error(self, state, reason):
+        """Release a reservation whose request raised before returning."""
+        with self.condition:
+            state.in_flight -= 1
+            self._backoff(state, reason)
+            self.condition.notify_all()
+
+    def request(self, url):
+        """
+        Function to fetch a url on whichever key currently has most headroom.
+
+        Returns
+        -------
+        response object with status 200 or 404
+
+        Raises
+        ------
+        KeysExhaustedError
+            if every key has been retired
+        requests.exceptions.RetryError
+            if the url still fails after max_attempts
+
+        """
+        endpoint = endpoint_of(url)
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                metrics.inc('scopus_retries', endpoint=endpoint)
+            with metrics.span('scopus_key_wait', endpoint=endpoint):
+                state = self.acquire()
+                state.bucket.acquire()
+            key = redact_key(state.key)
+            try:
+                with metrics.span('scopus_call', endpoint=endpoint):
+                    response = self.call(url, state.key)
+            except requests.exceptions.RequestException as e:
+                metrics.inc('scopus_calls', endpoint=endpoint,
+                            status='error', key=key)
+                self.record_error(state, repr(e))
+                continue
+            metrics.inc('scopus_calls', endpoint=endpoint,
+                        status=response.status_code, key=key)
+            if self.record(state, response):
+                return response
+        metrics.inc('scopus_failures', endpoint=endpoint)
+        raise requests.exceptions.RetryError(
+            f'Giving up on {url} after {self.max_attempts} attempts')
+
+    def metrics(self):
+        """
+        Per-key quota metrics.
+
+        Returns
+        -------
+        a list of dicts, one per key, with the key redacted to its
+        last four characters
+
+        """
+        with self.condition:
+            return [{'key': redact_key(state.key),
+                     'limit': state.limit,
+                     'remaining': state.remaining,
+                     'reset': state.reset,
+                     'parked_until': state.parked_until,
+                     'in_flight': state.in_flight,
+                     'calls': state.calls,
+                     'errors': state.errors,
+                     'retired': state.retired}
+                    for state in self.states]
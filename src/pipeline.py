@@ -0,0 +1,524 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import functools
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+from loguru import logger
+from google.cloud import bigquery
+
+from coverage import coverage_report, print_report
+from gbq_collector import DATA_ROOT, issn_output_dir, output_name, \
+    collect_issns, expand_issns, build_citation_graph, csv_output_names, \
+    remove_output
+from helper_functions import build_spine, issn_l_paths, load_issns
+from instrumentation import metrics, write_atomically
+from issn_index import IssnIndex, load_or_build_issn_index
+from response_cache import ResponseCache
+from scopus_counter import SCOPUS_BASE_URL, count_issns, get_csv_filename, \
+    get_cache_filename, get_log_filename, get_summary_filename
+
+# One runner for the whole pipeline: for every year the OJS ISSN list is
+# turned into a query list and a spine, its articles are collected from
+# BigQuery and expanded by their references and citations into a citation
+# graph and a coverage report, while Scopus counts run alongside.
+STAGE_KINDS = ('issn_index', 'issns', 'spine', 'collect', 'expand', 'graph',
+               'coverage', 'scopus')
+MY_PROJECT_ID = "dimensionsv3"
+BLOCK_BYTES = 1024 ** 2
+
+
+class ContentHasher:
+    """
+    SHA-256 digests of files and directories.
+
+    A file is only read when its size or modification time differs from
+    the memo, which is kept in the pipeline state, so a rerun re-hashes
+    just the files which were written since.
+
+    Parameters
+    ----------
+    memo : dict, optional
+        absolute path -> [size, mtime_ns, digest] of files hashed before
+
+    """
+
+    def __init__(self, memo=None):
+        self.memo = {} if memo is None else memo
+        self.lock = threading.Lock()
+
+    def file_digest(self, path):
+        path = os.path.abspath(path)
+        status = os.stat(path)
+        stamp = [status.st_size, status.st_mtime_ns]
+        with self.lock:
+            known = self.memo.get(path)
+        if known is not None and known[:2] == stamp:
+            return known[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(BLOCK_BYTES), b''):
+                digest.update(block)
+        with self.lock:
+            self.memo[path] = stamp + [digest.hexdigest()]
+        return digest.hexdigest()
+
+    def digest(self, path):
+        """
+        Digest a file, or every file of a directory along with its
+        relative path.
+
+        :return: a hex digest, None if the path does not exist
+        """
+        if os.path.isfile(path):
+            return self.file_digest(path)
+        if not os.path.isdir(path):
+            return None
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(os.path.relpath(file_path, path).encode('utf-8'))
+                digest.update(self.file_digest(file_path).encode('utf-8'))
+        return digest.hexdigest()
+
+    def prune(self):
+        """Forget files which no longer exist."""
+        with self.lock:
+            for path in [path for path in self.memo
+                         if not os.path.exists(path)]:
+                del self.memo[path]
+
+
+class Incomplete(dict):
+    """
+    Counts of the items a stage left unfinished, returned by its run; a
+    stage leaving any unfinished is not recorded as current.
+    """
+
+
+class Stage:
+    """
+    A step of the pipeline, run again only when its inputs change.
+
+    Parameters
+    ----------
+    name : str
+        unique name, its kind and year, e.g. 'collect/2022'
+    run : callable
+        does the work, called without arguments; it may return an
+        Incomplete
+    inputs : list
+        files or directories the outputs are made from
+    outputs : list
+        files or directories the stage makes
+    params : dict, optional
+        settings the outputs depend on, fingerprinted with the inputs
+    after : list
+        names of stages which have to finish first
+    resource : str, optional
+        stages sharing a resource, such as an API quota, run one at a time
+
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=(), params=None,
+                 after=(), resource=None):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.after = list(after)
+        self.resource = resource
+
+    @property
+    def kind(self):
+        return self.name.split('/')[0]
+
+
+class Pipeline:
+    """
+    Runs stages as a DAG, skipping those whose inputs are unchanged.
+
+    A stage's fingerprint hashes its parameters and the content of its
+    inputs, which include the outputs of the stages it comes after. The
+    fingerprint of every finished stage is kept in a JSON state file; a
+    stage whose fingerprint matches and whose outputs all exist is
+    skipped. Stages whose dependencies are done run in parallel, one at
+    a time per resource, so Scopus counting goes on alongside BigQuery
+    collection and the years of a run overlap.
+
+    Parameters
+    ----------
+    stages : list
+        Stages, each listed after the stages it depends on
+    state_path : str
+        location of the state file, created if it does not exist
+
+    """
+
+    def __init__(self, stages, state_path):
+        self.stages = stages
+        self.state_path = state_path
+        seen = set()
+        for stage in stages:
+            if stage.name in seen:
+                raise ValueError(f'Duplicate stage: {stage.name}')
+            later = [name for name in stage.after if name not in seen and
+                     name in {other.name for other in stages}]
+            if later:
+                raise ValueError(f'{stage.name} comes before {later}')
+            seen.add(stage.name)
+        self.state = {'stages': {}, 'digests': {}}
+        if os.path.exists(state_path):
+            with open(state_path) as file:
+                self.state = json.load(file)
+        self.hasher = ContentHasher(self.state['digests'])
+        self.lock = threading.Lock()
+
+    def fingerprint(self, stage):
+        inputs = {path: self.hasher.digest(path) for path in stage.inputs}
+        payload = json.dumps({'name': stage.name, 'params': stage.params,
+                              'inputs': inputs}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def is_current(self, stage, fingerprint):
+        recorded = self.state['stages'].get(stage.name, {})
+        return recorded.get('fingerprint') == fingerprint and \
+            all(os.path.exists(path) for path in stage.outputs)
+
+    def save_state(self):
+        with self.lock:
+            self.hasher.prune()
+            with self.hasher.lock:
+                text = json.dumps(self.state, indent=1, sort_keys=True)
+            write_atomically(self.state_path, text)
+
+    def execute(self, stage, force=False):
+        """
+        Run a stage unless it is current.
+
+        :return: 'ran', 'skipped' or 'incomplete'
+        """
+        fingerprint = self.fingerprint(stage)
+        if not force and self.is_current(stage, fingerprint):
+            logger.info(f'{stage.name}: inputs unchanged, skipping')
+            metrics.inc('pipeline_stages', kind=stage.kind, result='skipped')
+            return 'skipped'
+        logger.info(f'{stage.name}: running')
+        with self.lock:
+            self.state['stages'].pop(stage.name, None)
+        self.save_state()
+        start = time.time()
+        with metrics.span('pipeline_stage', kind=stage.kind):
+            result = stage.run()
+        if isinstance(result, Incomplete) and any(result.values()):
+            # without a fingerprint the stage runs again next time
+            with self.lock:
+                self.state['stages'][stage.name] = {
+                    'unfinished': dict(result),
+                    'finished': time.time(),
+                    'seconds': round(time.time() - start, 3)}
+            self.save_state()
+            metrics.inc('pipeline_stages', kind=stage.kind,
+                        result='incomplete')
+            logger.warning(f'{stage.name}: incomplete after '
+                           f'{time.time() - start:.1f}s, unfinished: '
+                           f'{dict(result)}')
+            return 'incomplete'
+        with self.lock:
+            self.state['stages'][stage.name] = {
+                'fingerprint': fingerprint,
+                'finished': time.time(),
+                'seconds': round(time.time() - start, 3)}
+        self.save_state()
+        metrics.inc('pipeline_stages', kind=stage.kind, result='ran')
+        logger.info(f'{stage.name}: done in {time.time() - start:.1f}s')
+        return 'ran'
+
+    def run(self, force=()):
+        """
+        Run the stages in dependency order, in parallel where they can be.
+
+        A failed stage does not stop the others; only the stages after it
+        are left out.
+
+        The metrics registry is reset, so it holds this run's metrics.
+
+        :param force: names or kinds of stages to run even if current
+        :return: dict of stage name -> 'ran', 'skipped', 'incomplete',
+                 'failed' or 'blocked'
+        """
+        metrics.reset()
+        names = {stage.name for stage in self.stages}
+        status = {}
+        pending = list(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as pool:
+            while pending or running:
+                busy = {stage.resource for stage in running.values()}
+                for stage in list(pending):
+                    after = [name for name in stage.after if name in names]
+                    if any(status.get(name) in ('failed', 'blocked')
+                           for name in after):
+                        logger.warning(f'{stage.name}: blocked by a failure')
+                        status[stage.name] = 'blocked'
+                        pending.remove(stage)
+                    elif all(status.get(name) in ('ran', 'skipped',
+                                                  'incomplete')
+                             for name in after) and \
+                            (stage.resource is None or
+                             stage.resource not in busy):
+                        busy.add(stage.resource)
+                        forced = stage.name in force or stage.kind in force
+                        running[pool.submit(self.execute, stage,
+                                            forced)] = stage
+                        pending.remove(stage)
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        status[stage.name] = future.result()
+                    except Exception:
+                        logger.error(f'{stage.name}: failed\n'
+                                     f'{traceback.format_exc()}')
+                        metrics.inc('pipeline_stages', kind=stage.kind,
+                                    result='failed')
+                        status[stage.name] = 'failed'
+        return status
+
+
+def issn_list_path(year, data_root=DATA_ROOT):
+    """ Helper function to locate a year's list of ISSNs to query"""
+    return os.path.join(data_root, 'issn_lists', str(year), 'issns_to_query.csv')
+
+
+def write_issn_list(year, data_root=DATA_ROOT):
+    """
+    Write the distinct ISSNs of a year's OJS list, so that the stages
+    querying them only depend on the ISSNs and not the rest of the list.
+    """
+    raw_issn = load_issns(os.path.join(data_root, 'raw', 'issn_inputs'), year)
+    issns = raw_issn['issn_ojs'].dropna().astype(str).drop_duplicates()
+    write_atomically(issn_list_path(year, data_root),
+                     issns.to_csv(index=False))
+
+
+def read_issn_list(year, data_root=DATA_ROOT):
+    return pd.read_csv(issn_list_path(year, data_root),
+                       dtype=str)['issn_ojs'].tolist()
+
+
+def load_index(index_dir):
+    """ Helper function to load the ISSN-L index, or None if not built"""
+    if os.path.exists(os.path.join(index_dir, 'manifest.json')):
+        return IssnIndex.load(index_dir)
+    return None
+
+
+def write_coverage(year, data_root, output_format='parquet', columns='full',
+                   index_dir=None):
+    """ Helper function to save a year's coverage report as JSON"""
+    issn_out = issn_output_dir(year, data_root)
+    report = coverage_report(
+        load_issns(os.path.join(data_root, 'raw', 'issn_inputs'), year),
+        os.path.join(issn_out, output_name('pubs_from_all_issns',
+                                           output_format)),
+        year, None if index_dir is None else load_index(index_dir),
+        csv_names=csv_output_names(columns))
+    print_report(report)
+    write_atomically(os.path.join(issn_out, 'coverage.json'),
+                     json.dumps(report, indent=1, default=str))
+
+
+def build_stages(years, data_root=DATA_ROOT, kinds=STAGE_KINDS, client=None,
+                 project=MY_PROJECT_ID, output_format='parquet',
+                 columns='full', server_side_dataset=None, issn_l_dump=None,
+                 keys_path=None, cache=None, max_attempts=3,
+                 scopus_base_url=SCOPUS_BASE_URL):
+    """
+    Lay out the stages of a run over one or more years.
+
+    :param years: years of the OJS ISSN lists to process
+    :param data_root: data directory holding the raw inputs and outputs
+    :param kinds: STAGE_KINDS to include; the outputs of stages left out
+                  are used as they are
+    :param client: google query client, by default made for project when
+                   first needed
+    :param issn_l_dump: ISSN-to-ISSN-L dump; without one the spine is
+                        skipped and journals are not merged by ISSN-L
+    :param keys_path: directory of Elsevier API keys; without it Scopus
+                      counts are only answered from the cache
+    :param cache: ResponseCache of Scopus responses
+    :return: list of Stages
+    """
+    @functools.lru_cache(maxsize=None)
+    def bigquery_client():
+        return client if client is not None else \
+            bigquery.Client(project=project)
+
+    issn_inputs = os.path.join(data_root, 'raw', 'issn_inputs')
+    dump_path, index_dir = issn_l_paths(data_root, issn_l_dump)
+    has_index = os.path.exists(dump_path)
+    if not has_index:
+        logger.warning(f'No ISSN-L dump at {dump_path}: skipping the spine '
+                       f'and merging journals by ISSN only')
+    index_inputs = [index_dir] if has_index else []
+    index_after = ['issn_index'] if has_index else []
+    settings = {'output_format': output_format, 'columns': columns}
+
+    stages = []
+    if has_index:
+        stages.append(Stage('issn_index',
+                            lambda: load_or_build_issn_index(index_dir,
+                                                             dump_path),
+                            inputs=[dump_path], outputs=[index_dir],
+                            resource='local'))
+    for year in years:
+        raw_list = os.path.join(issn_inputs, str(year),
+                                f'full_ojs_issn_list_{year}.csv')
+        issn_list = issn_list_path(year, data_root)
+        issn_out = issn_output_dir(year, data_root)
+        pubs, references, citations = [
+            os.path.join(issn_out, output_name(name, output_format))
+            for name in ['pubs_from_all_issns', 'references_of_all_pubs',
+                         'citations_of_all_pubs']]
+        spine = os.path.join(data_root, 'merged_spine', str(year),
+                             'merged_OJS_spine.csv')
+
+        def collect(year=year, issn_out=issn_out, pubs=pubs):
+            # an earlier, different ISSN list's articles are replaced
+            remove_output(pubs)
+            collect_issns(read_issn_list(year, data_root), issn_out,
+                          bigquery_client(), output_format, columns)
+
+        stages += [
+            Stage(f'issns/{year}',
+                  functools.partial(write_issn_list, year, data_root),
+                  inputs=[raw_list], outputs=[issn_list], resource='local'),
+            Stage(f'spine/{year}',
+                  lambda year=year, spine=spine: build_spine(
+                      load_issns(issn_inputs, year), IssnIndex.load(index_dir),
+                      spine),
+                  inputs=[raw_list] + index_inputs, outputs=[spine],
+                  after=index_after, resource='local'),
+            Stage(f'collect/{year}', collect,
+                  inputs=[issn_list], outputs=[pubs], params=settings,
+                  after=[f'issns/{year}'], resource='bigquery'),
+            Stage(f'expand/{year}',
+                  lambda year=year, issn_out=issn_out: expand_issns(
+                      read_issn_list(year, data_root), issn_out,
+                      bigquery_client(), output_format, columns,
+                      server_side_dataset),
+                  inputs=[pubs], outputs=[references, citations],
+                  params={**settings, 'server_side_dataset':
+                          server_side_dataset},
+                  after=[f'collect/{year}'], resource='bigquery'),
+            Stage(f'graph/{year}',
+                  lambda issn_out=issn_out: build_citation_graph(
+                      issn_out, output_format,
+                      load_index(index_dir) if has_index else None, columns),
+                  inputs=[pubs, references, citations] + index_inputs,
+                  outputs=[os.path.join(issn_out, 'citation_graph')],
+                  params=settings, after=[f'expand/{year}'] + index_after,
+                  resource='local'),
+            Stage(f'coverage/{year}',
+                  functools.partial(write_coverage, year, data_root,
+                                    output_format, columns,
+                                    index_dir if has_index else None),
+                  inputs=[raw_list, pubs] + index_inputs,
+                  outputs=[os.path.join(issn_out, 'coverage.json')],
+                  params=settings, after=[f'collect/{year}'] + index_after,
+                  resource='local'),
+            Stage(f'scopus/{year}',
+                  lambda year=year: Incomplete(count_issns(
+                      read_issn_list(year, data_root),
+                      get_csv_filename(year, data_root), keys_path, cache,
+                      max_attempts, scopus_base_url)),
+                  inputs=[issn_list], outputs=[get_csv_filename(year,
+                                                                data_root)],
+                  params={'keys': keys_path is not None},
+                  after=[f'issns/{year}'], resource='scopus'),
+        ]
+    return [stage for stage in stages if stage.kind in kinds and
+            (has_index or stage.kind != 'spine')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the ISSN, BigQuery '
+                                                 'and Scopus pipeline')
+    parser.add_argument('--years', type=int, nargs='+', default=[2022],
+                        help='years of the OJS ISSN lists to process')
+    parser.add_argument('--data-root', default=DATA_ROOT,
+                        help='data directory holding the raw inputs and '
+                             'outputs')
+    parser.add_argument('--stages', nargs='+', choices=STAGE_KINDS,
+                        default=list(STAGE_KINDS),
+                        help='kinds of stage to run, by default all')
+    parser.add_argument('--force', nargs='+', default=[],
+                        help='stage kinds or names, e.g. scopus/2022, to '
+                             'run even if their inputs are unchanged')
+    parser.add_argument('--output-format', choices=['parquet', 'csv'],
+                        default='parquet')
+    parser.add_argument('--columns', default='full',
+                        help='query_builder column profile')
+    parser.add_argument('--server-side-dataset',
+                        help='BigQuery dataset to expand references and '
+                             'citations in')
+    parser.add_argument('--project', default=MY_PROJECT_ID,
+                        help='Google Cloud project to bill')
+    parser.add_argument('--issn-l-dump',
+                        help='ISSN-to-ISSN-L dump, by default the one in '
+                             'data-root/issn_l_lookup')
+    parser.add_argument('--keys', help='directory of Elsevier API keys, by '
+                                       'default keys next to data-root')
+    parser.add_argument('--offline', action='store_true',
+                        help='answer Scopus counts from the cache only')
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='Scopus attempts per ISSN')
+    parser.add_argument('--metrics-path',
+                        help='Prometheus textfile to write the metrics to')
+    args = parser.parse_args()
+
+    log_file = os.path.join(args.data_root, '..', 'logging',
+                            get_log_filename())
+    logger.add(log_file)
+    keys_path = None if args.offline else \
+        args.keys or os.path.join(args.data_root, '..', 'keys')
+    cache_path = get_cache_filename(args.data_root)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    cache = ResponseCache(cache_path, offline=args.offline)
+    stages = build_stages(args.years, args.data_root, args.stages,
+                          project=args.project,
+                          output_format=args.output_format,
+                          columns=args.columns,
+                          server_side_dataset=args.server_side_dataset,
+                          issn_l_dump=args.issn_l_dump, keys_path=keys_path,
+                          cache=cache, max_attempts=args.max_attempts)
+    pipeline = Pipeline(stages, os.path.join(args.data_root,
+                                             'pipeline_state.json'))
+    status = pipeline.run(force=set(args.force))
+    cache.close()
+    for name, result in status.items():
+        if result == 'incomplete':
+            unfinished = pipeline.state['stages'][name]['unfinished']
+            logger.warning(f'{name}: {result}, unfinished: {unfinished}')
+        else:
+            logger.info(f'{name}: {result}')
+    metrics.write_summary(get_summary_filename(log_file))
+    if args.metrics_path is not None:
+        metrics.write_textfile(args.metrics_path)
+    if any(result in ('failed', 'blocked') for result in status.values()):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import re
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Legacy csv dumps hold the repr of numpy arrays, e.g.
+#   reference_ids: "['pub.1000000001' 'pub.1000000002'\n 'pub.1000000003']"
+#   citations:     "[{'id': 'pub.1000000004', 'year': 2019}\n {'id': ...}]"
+REFERENCE_DELIMITERS = str.maketrans("[]'", '   ')
+CITATION_ID = re.compile(r"'id': '([^']+)'")
+
+
+def parse_legacy_reference_ids(text):
+    """ Split stringified reference_ids into ids"""
+    return text.translate(REFERENCE_DELIMITERS).split()
+
+
+def parse_legacy_citation_ids(text):
+    """ Pull the ids out of stringified citation structs"""
+    return CITATION_ID.findall(text)
+
+
+def _extract_arrow(column, field=None):
+    values = pc.list_flatten(column)
+    if field is not None:
+        values = pc.struct_field(values, field)
+    return pc.unique(values).drop_null().to_pylist()
+
+
+def extract_pub_ids(column, parse_legacy, field=None):
+    """
+    Extract the unique pub ids held in a reference_ids or citations column.
+
+    Both storage formats are handled in one vectorised pass: native list
+    columns are flattened with pyarrow compute, and legacy stringified
+    columns are joined into a single string which parse_legacy splits in
+    one call.
+
+    :param column: pandas Series or pyarrow (Chunked)Array
+    :param parse_legacy: function turning joined legacy strings into ids
+    :param field: struct field holding the id in native list<struct> columns
+    :return: a list of unique ids
+    """
+    if isinstance(column, (pa.Array, pa.ChunkedArray)):
+        return _extract_arrow(column, field)
+    column = column.dropna()
+    if len(column) == 0:
+        return []
+    if not isinstance(column.iloc[0], str):
+        return _extract_arrow(pa.Array.from_pandas(column), field)
+    return list(set(parse_legacy('\n'.join(column.tolist()))))
+
+
+def get_all_refs(df):
+    """ Get all references from a pubid dataframe or table"""
+    return extract_pub_ids(df['reference_ids'], parse_legacy_reference_ids)
+
+
+def get_all_citations(df):
+    """ Get all citations from a pubid dataframe or table"""
+    return extract_pub_ids(df['citations'], parse_legacy_citation_ids,
+                           field='id')
@@ -0,0 +1,83 @@
+import sqlite3
+
+
+class PubIdIndex:
+    """
+    Persistent record of which pub ids have already been queried.
+
+    An id is fetched once, whichever way it is reached: it is stored with
+    the kind it was first fetched as ('seed' for the ISSN publications,
+    'reference' or 'citation' for the output file it was written to) and
+    the expansion hop which fetched it, so reruns only query ids never
+    seen before and multi-hop expansion can find the pubs a previous hop
+    added.
+
+    Parameters
+    ----------
+    path : str
+        location of the SQLite file, created if it does not exist
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS pub_ids (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                hop INTEGER NOT NULL) WITHOUT ROWID""")
+        self.connection.execute("""
+            CREATE INDEX IF NOT EXISTS pub_ids_hop ON pub_ids (hop)""")
+        self.connection.execute("""
+            CREATE TEMP TABLE candidates (id TEXT PRIMARY KEY) WITHOUT ROWID""")
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM pub_ids').fetchone()[0]
+
+    def unseen(self, ids):
+        """
+        Filter ids down to those never fetched, as any kind.
+
+        :param ids: iterable of pub ids
+        :return: a sorted list of the ids not in the index
+        """
+        self.connection.execute('DELETE FROM candidates')
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO candidates VALUES (?)',
+            ((pub_id,) for pub_id in ids))
+        rows = self.connection.execute("""
+            SELECT c.id FROM candidates c
+            WHERE NOT EXISTS (SELECT 1 FROM pub_ids f WHERE f.id = c.id)
+            ORDER BY c.id""")
+        unseen = [row[0] for row in rows]
+        self.connection.execute('DELETE FROM candidates')
+        return unseen
+
+    def mark_fetched(self, kind, ids, hop):
+        """
+        Record ids as fetched; ids already present keep their first kind
+        and hop.
+        """
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO pub_ids VALUES (?, ?, ?)',
+            ((pub_id, kind, hop) for pub_id in ids))
+        self.connection.commit()
+
+    def fetched_at(self, hop):
+        """Return the set of ids, of any kind, first fetched at a hop."""
+        rows = self.connection.execute(
+            'SELECT id FROM pub_ids WHERE hop = ?', (hop,))
+        return {row[0] for row in rows}
+
+    def counts(self):
+        """Return the number of fetched ids by kind."""
+        rows = self.connection.execute(
+            'SELECT kind, COUNT(*) FROM pub_ids GROUP BY kind')
+        return dict(rows.fetchall())
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,141 @@
+from google.cloud import bigquery
+
+PUBLICATIONS_TABLE = '`dimensions-ai.data_analytics.publications`'
+ON_DEMAND_USD_PER_TIB = 6.25
+TIB = 1024 ** 4
+
+# Named column selections, so that callers only pay to scan what they use
+COLUMN_PROFILES = {
+    'full': ['id', 'reference_ids', 'citations', 'doi', 'journal.issn',
+             'journal.eissn', 'type', 'date_normal', 'category_for', 'metrics',
+             'research_orgs', 'researcher_ids', 'journal',
+             'research_org_country_names', 'altmetrics', 'title', 'abstract',
+             'concepts', 'funder_orgs'],
+    'links': ['id', 'reference_ids', 'citations'],
+    'coverage': ['id', 'journal.issn', 'journal.eissn', 'type', 'date_normal',
+                 'research_org_country_names'],
+}
+# The publications linked to a seed set: those it references, or those
+# citing it, as listed in the seeds' reference_ids and citations arrays
+LINKED_IDS = {
+    'reference': {'bigquery': 'SELECT DISTINCT ref_id AS id FROM seeds, '
+                              'UNNEST(seeds.reference_ids) AS ref_id',
+                  'duckdb': 'SELECT DISTINCT ref_id AS id FROM seeds, '
+                            'UNNEST(seeds.reference_ids) AS linked(ref_id)'},
+    'citation': {'bigquery': 'SELECT DISTINCT citation.id AS id FROM seeds, '
+                             'UNNEST(seeds.citations) AS citation',
+                 'duckdb': 'SELECT DISTINCT citation.id AS id FROM seeds, '
+                           'UNNEST(seeds.citations) AS linked(citation)'},
+}
+ISSN_CONDITIONS = {
+    'bigquery': 'journal.issn IN UNNEST(@issns) OR '
+                'journal.eissn IN UNNEST(@issns)',
+    'duckdb': 'list_contains($issns, journal.issn) OR '
+              'list_contains($issns, journal.eissn)',
+}
+FILTERS = {
+    'issn': ('issns', ISSN_CONDITIONS['bigquery']),
+    'article': ('pubids', 'p.id IN UNNEST(@pubids)'),
+}
+
+
+def resolve_columns(columns):
+    """ Helper function to turn a profile name or a column list into columns"""
+    if isinstance(columns, str):
+        return COLUMN_PROFILES[columns]
+    return list(columns)
+
+
+def build_query(query_list, query_type, columns='full'):
+    """
+    Build the text and parameters of a publication query.
+
+    The items are always passed as an array parameter, so the query text
+    is the same for every chunk and stays small however long the list.
+
+    :param query_list: list of items to query
+    :param query_type: 'issn' or 'article'
+    :param columns: a COLUMN_PROFILES name or a list of columns
+    :return: (query text, list of query parameters)
+    """
+    if query_type not in FILTERS:
+        raise ValueError(f'Unknown query type: {query_type}')
+    parameter, condition = FILTERS[query_type]
+    QUERY = f"""
+            SELECT {', '.join(resolve_columns(columns))}
+            FROM {PUBLICATIONS_TABLE} p
+            WHERE type='article' AND ({condition})"""
+    parameters = [bigquery.ArrayQueryParameter(parameter, "STRING",
+                                               list(query_list))]
+    return QUERY, parameters
+
+
+def make_job_config(parameters, dry_run=False):
+    """ Helper function to build a job config, bypassing the cache on dry runs"""
+    return bigquery.QueryJobConfig(query_parameters=parameters,
+                                   dry_run=dry_run,
+                                   use_query_cache=not dry_run)
+
+
+def estimate_cost(bytes_processed, usd_per_tib=ON_DEMAND_USD_PER_TIB):
+    """ Helper function to price scanned bytes at the on-demand rate"""
+    return {'bytes_processed': bytes_processed,
+            'tib_processed': round(bytes_processed / TIB, 6),
+            'usd': round(bytes_processed / TIB * usd_per_tib, 4)}
+
+
+def dry_run(query_list, client, query_type, columns='full'):
+    """
+    Validate a query without running it and report what it would scan.
+
+    :return: a dict with bytes_processed, tib_processed and usd
+    """
+    QUERY, parameters = build_query(query_list, query_type, columns)
+    query_job = client.query(QUERY,
+                             job_config=make_job_config(parameters,
+                                                        dry_run=True))
+    return estimate_cost(query_job.total_bytes_processed)
+
+
+def build_expansion_query(kind, columns='full', table=PUBLICATIONS_TABLE,
+                          dialect='bigquery'):
+    """
+    Build a query returning the publications linked to the articles of a
+    set of ISSNs, with the reference or citation arrays unnested inside
+    the database rather than downloaded and parsed.
+
+    The ISSNs are the issns parameter. The same logical plan is written
+    for BigQuery and for DuckDB, which stands in for BigQuery locally.
+
+    :param kind: 'reference' or 'citation'
+    :param columns: a COLUMN_PROFILES name or a list of columns
+    :param table: publications table to read
+    :param dialect: 'bigquery' or 'duckdb'
+    :return: query text
+    """
+    QUERY = f"""
+            WITH seeds AS (
+                SELECT reference_ids, citations
+                FROM {table}
+                WHERE type='article' AND ({ISSN_CONDITIONS[dialect]})),
+            linked AS ({LINKED_IDS[kind][dialect]})
+            SELECT {', '.join('p.' + column for column in resolve_columns(columns))}
+            FROM {table} p
+            JOIN linked ON p.id = linked.id
+            WHERE p.type='article'"""
+    return QUERY
+
+
+def expand_locally(connection, issns, kind, columns='full',
+                   table='publications'):
+    """
+    Run the expansion query against a local DuckDB copy of the
+    publications table.
+
+    :param connection: duckdb connection holding the table
+    :param issns: list of ISSNs whose articles are expanded
+    :param kind: 'reference' or 'citation'
+    :return: a pyarrow Table
+    """
+    QUERY = build_expansion_query(kind, columns, table, dialect='duckdb')
+    return connection.execute(QUERY, {'issns': list(issns)}).fetch_arrow_table()
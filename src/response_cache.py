@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import requests
+from requests.exceptions import JSONDecodeError
+from requests.structures import CaseInsensitiveDict
+
+from instrumentation import metrics
+
+DAY = 24 * 60 * 60
+DEFAULT_TTLS = {'search': 30 * DAY,  # article counts move slowly
+                'serial': 180 * DAY}  # serial titles hardly at all
+CACHEABLE_STATUSES = (200, 404)
+
+
+class OfflineCacheMiss(requests.exceptions.RequestException):
+    """Raised in offline mode when a url is not in the cache."""
+
+
+class CachedResponse:
+    """
+    Stand-in for requests.Response rebuilt from a cache entry; it offers
+    the status_code, headers, content, text and json() used downstream.
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.from_cache = True
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        try:
+            return json.loads(self.content)
+        except json.JSONDecodeError as e:
+            raise JSONDecodeError(e.msg, e.doc, e.pos)
+
+
+def endpoint_of(url, ttls=DEFAULT_TTLS):
+    """ Helper function to name the API endpoint a url belongs to"""
+    for endpoint in ttls:
+        if f'/{endpoint}/' in url:
+            return endpoint
+    return 'other'
+
+
+class ResponseCache:
+    """
+    Content-addressed, on-disk cache of API responses.
+
+    Entries are stored in SQLite, keyed by the SHA-256 of the url, and
+    expire after a per-endpoint TTL. Once the cache grows beyond max_bytes
+    the least recently used entries are evicted. In offline mode entries
+    are served regardless of age and misses raise OfflineCacheMiss, which
+    allows outputs to be rebuilt without touching the network.
+
+    Parameters
+    ----------
+    path : str
+        location of the SQLite file, created if it does not exist
+    ttls : dict, optional
+        seconds to keep responses for, by endpoint name
+    max_bytes : int
+        size of stored bodies above which entries are evicted
+    offline : bool
+        serve only from the cache
+
+    """
+
+    def __init__(self, path, ttls=None, max_bytes=2 * 1024 ** 3,
+                 offline=False):
+        self.path = path
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                endpoint TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored REAL NOT NULL,
+                accessed REAL NOT NULL)""")
+        self.connection.execute("""
+            CREATE INDEX IF NOT EXISTS responses_accessed
+            ON responses (accessed)""")
+        self.connection.commit()
+        self.size = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def get(self, url):
+        """
+        Look up a url.
+
+        Returns
+        -------
+        a CachedResponse, or None if the url is missing or has expired
+
+        """
+        key = self.key(url)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT status, headers, body, endpoint, stored '
+                'FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            status, headers, body, endpoint, stored = row
+            ttl = self.ttls.get(endpoint)
+            if (self.offline is False) and (ttl is not None) and \
+                    (now - stored > ttl):
+                self.misses += 1
+                return None
+            self.connection.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.connection.commit()
+            self.hits += 1
+        return CachedResponse(url, status, json.loads(headers), body)
+
+    def put(self, url, response):
+        """Store a response if it is final; other statuses are not cached."""
+        if response.status_code not in CACHEABLE_STATUSES:
+            return
+        if getattr(response, 'from_cache', False):
+            return
+        body = response.content
+        now = time.time()
+        with self.lock:
+            old = self.connection.execute(
+                'SELECT size FROM responses WHERE key = ?',
+                (self.key(url),)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.key(url), url, endpoint_of(url, self.ttls),
+                 response.status_code, json.dumps(dict(response.headers)),
+                 body, len(body), now, now))
+            self.size += len(body) - (old[0] if old else 0)
+            if self.size > self.max_bytes:
+                self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until below 90% of max_bytes."""
+        target = 0.9 * self.max_bytes
+        rows = self.connection.execute(
+            'SELECT key, size FROM responses ORDER BY accessed')
+        evict = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evict.append((key,))
+            self.size -= size
+        self.connection.executemany('DELETE FROM responses WHERE key = ?',
+                                    evict)
+
+    def close(self):
+        self.connection.close()
+
+
+def fetch_url(url, scheduler, cache=None):
+    """
+    Function to fetch a url through the cache, falling back on the key
+    scheduler, and store the response for next time.
+
+    Raises
+    ------
+    OfflineCacheMiss
+        if there is no scheduler, or the cache is offline, and the url is
+        not cached
+
+    """
+    if cache is not None:
+        cached = cache.get(url)
+        metrics.inc('scopus_cache', endpoint=endpoint_of(url),
+                    result='miss' if cached is None else 'hit')
+        if cached is not None:
+            return cached
+    if (scheduler is None) or (cache is not None and cache.offline):
+        raise OfflineCacheMiss(f'{url} is not cached')
+    response = scheduler.request(url)
+    if cache is not None:
+        cache.put(url, response)
+    return response
@@ -0,0 +1,151 @@
+import os
+import csv
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+import pandas as pd
+
+
+class ResultSink(ABC):
+    """
+    Buffered writer for result rows.
+
+    Rows are held in memory and written out in batches, whenever
+    batch_size rows are buffered or flush_interval seconds have passed
+    since the last flush. Every flush is fsynced before on_flush is called
+    with the items whose rows it contained, so a checkpoint driven by
+    on_flush never gets ahead of what is safely on disk.
+
+    Parameters
+    ----------
+    path : str
+        output location
+    columns : list
+        column names of the rows
+    batch_size : int
+        number of buffered rows which triggers a flush
+    flush_interval : float
+        seconds after which buffered rows are flushed regardless
+    on_flush : callable, optional
+        called with the list of items flushed, e.g. Checkpoint.mark_done
+
+    """
+
+    def __init__(self, path, columns, batch_size=1000, flush_interval=10,
+                 on_flush=None):
+        self.path = path
+        self.columns = columns
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self.rows = []
+        self.items = []
+        self.flushed_at = time.monotonic()
+
+    def write(self, row, item=None):
+        """Buffer a row, recording item as complete once it is flushed."""
+        self.rows.append(row)
+        if item is not None:
+            self.items.append(item)
+        if (len(self.rows) >= self.batch_size) or \
+                (time.monotonic() - self.flushed_at >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self._write_rows(self.rows)
+        if self.on_flush is not None and len(self.items) > 0:
+            self.on_flush(self.items)
+        self.rows = []
+        self.items = []
+        self.flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @abstractmethod
+    def _write_rows(self, rows):
+        """Durably write a batch of rows."""
+
+
+class CsvSink(ResultSink):
+    """Appends batches to a single csv, writing the header if it is new."""
+
+    def __init__(self, path, columns, **kwargs):
+        super().__init__(path, columns, **kwargs)
+        new_file = (os.path.exists(path) is False) or \
+                   (os.path.getsize(path) == 0)
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(columns)
+            self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _write_rows(self, rows):
+        self.writer.writerows(rows)
+        self._sync()
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class ParquetSink(ResultSink):
+    """
+    Writes every batch as its own part file inside the directory at path.
+
+    Parquet files cannot be appended to and are unreadable until their
+    footer is written, so a complete file per flush keeps every flushed
+    batch readable after a crash. Each part is written under a name
+    starting with an underscore, which readers skip, and only renamed
+    into place once it is fsynced, so a crash mid-flush leaves no
+    truncated part behind.
+    """
+
+    def __init__(self, path, columns, **kwargs):
+        super().__init__(path, columns, **kwargs)
+        os.makedirs(path, exist_ok=True)
+        self.prefix = f'part_{uuid.uuid4().hex}'
+        self.parts = 0
+
+    def _write_rows(self, rows):
+        part_name = f'{self.prefix}_{self.parts:05d}.parquet'
+        temporary = os.path.join(self.path, f'_{part_name}.tmp')
+        with open(temporary, 'wb') as part_file:
+            pd.DataFrame(rows, columns=self.columns).to_parquet(part_file,
+                                                                index=False)
+            part_file.flush()
+            os.fsync(part_file.fileno())
+        os.replace(temporary, os.path.join(self.path, part_name))
+        # the rename itself is only durable once the directory is synced
+        directory = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.parts += 1
+
+
+def make_sink(path, columns, **kwargs):
+    """ Helper function to pick a sink from the output path's extension"""
+    if path.endswith('.parquet'):
+        return ParquetSink(path, columns, **kwargs)
+    return CsvSink(path, columns, **kwargs)
+
+
+def read_sink(path, columns=None):
+    """ Helper function to read back what a sink has written"""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns, dtype=str)
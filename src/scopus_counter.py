@@ -1,17 +1,27 @@
 import os
-import csv
 import time
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from loguru import logger
-from ratelimit import limits
 from requests.exceptions import JSONDecodeError
 
+from checkpoint import Checkpoint
+from instrumentation import metrics
+from key_scheduler import KeyScheduler, KeysExhaustedError
+from result_sink import make_sink, read_sink
+from response_cache import ResponseCache, OfflineCacheMiss, fetch_url
+
+SCOPUS_BASE_URL = 'http://api.elsevier.com/content/'
+DATA_ROOT = os.path.join('..', 'data')
+SCOPUS_COLUMNS = ['raw_issn', 'search_issn_count', 'search_eissn_count',
+                  'serial_prism:issn', 'serial_prism:eIssn', 'serial_dc:title']
+
 
-@limits(calls=8, period=1)  # max of 8 requests per 1 second
 def call_scopus_search_api(url, key):
     """
 
@@ -75,135 +85,343 @@ def get_log_filename():
     return time.strftime("logs_%S_%M_%H_%d_%m_%Y.log")
 
 
-# Define a function to generate CSV file path with timestamp
-def get_csv_filename():
-    timestamp = time.strftime("%S%M%H%d%m%Y")
-    return os.path.join(os.getcwd(),
-                        '..',
-                        'data',
+def get_csv_filename(year, data_root=DATA_ROOT):
+    """ Output path for a year; stable so that an interrupted run can resume"""
+    return os.path.join(data_root,
                         'scopus_counts',
-                        f'scopus_counts_{timestamp}.csv')
+                        f'scopus_counts_{year}.csv')
 
 
-def main():
-    log_file = os.path.join(os.getcwd(), '..', 'logging', get_log_filename())
-    logger.add(log_file)
-    keys_path = os.path.join(os.getcwd(), '..', 'keys')
-    keys = make_apikey_list(keys_path)
+def get_checkpoint_filename(csv_file_path):
+    return os.path.splitext(csv_file_path)[0] + '_checkpoint.sqlite'
 
-    raw_path = os.path.join("..", "data", "raw")
-    year = 2022
-    logger.info('Loading raw ISSN data')
-    raw_issn = load_issns(os.path.join(raw_path,
-                                       'issn_inputs'),
-                          year)
-    issn_list = raw_issn['issn_ojs'].tolist()
-    csv_file_path = get_csv_filename()
-    csv_header = ['raw_issn', 'search_issn_count', 'search_eissn_count',
-                  'serial_prism:issn', 'serial_prism:eIssn', 'serial_dc:title']
-    with open(csv_file_path, 'w', newline='') as csv_file:
-        csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(csv_header)
-    key_counter = 0
-    base_url = 'http://api.elsevier.com/content/'
-    for issn in tqdm(issn_list):
-        url_search = base_url + f'search/scopus?query=issn({issn})'
-        url_esearch = base_url + f'search/scopus?query=eissn({issn})'
-        url_title = base_url + f'serial/title/issn/{issn}'
-        returned = False
-        while returned is False:
-            api_return_search = call_scopus_search_api(url_search, keys[key_counter])
-            api_return_esearch = call_scopus_search_api(url_esearch, keys[key_counter])
-            api_return_title = call_scopus_search_api(url_title, keys[key_counter])
-            search_remaining = int(api_return_search.headers.get('X-RateLimit-Remaining'))
-            title_remaining = int(api_return_title.headers.get('X-RateLimit-Remaining'))
-            if (search_remaining==0) or (title_remaining==0):
-                key_counter += 1
-                logger.info(f'No keys left. Restarting while condition.')
-            else:
-                logger.info(f'We have {search_remaining} and {title_remaining} calls remaining for key: {keys[key_counter]}')
-                if ((int(api_return_search.status_code == 200) | (int(api_return_search.status_code == 404))) and \
-                        (int(api_return_esearch.status_code == 200) | (int(api_return_esearch.status_code == 404))) and \
-                        ((int(api_return_title.status_code == 200) | (int(api_return_title.status_code == 404))))):
-                    logger.warning(f"API status codes: {api_return_search.status_code}, {api_return_title.status_code}")
-                    logger.info(f'Successful API request for {issn}.')
-                    returned = True
-                else:
-                    logger.warning(f'Problem with API call for {issn}.')
-                    logger.warning(f"API status codes: {api_return_search.status_code},"
-                                   f"{api_return_esearch.status_code}"
-                                   f"{api_return_title.status_code}")
-                    logger.warning(f'Key counter is: {key_counter}')
-                    logger.warning(f'Having a sleep for a few seconds')
-                    time.sleep(20)
-        try:
-            if 'service-error' in api_return_title.json():
-                if api_return_title.json()['service-error']['status']['statusCode'] == 'RESOURCE_NOT_FOUND':
-                    prism_issn = 'Resource Not Found'
-                    prism_eissn = 'Resource Not Found'
-                    dc_title = 'Resource Not Found'
-                    logger.warning(f'Resource not found for {issn}.')
-                else:
-                    prism_issn = 'Other Service Error'
-                    prism_eissn = 'Other Service Error'
-                    dc_title = 'Other Service Error'
-                    logger.warning(f'Other service error for {issn}.')
+
+def load_completed_issns(csv_file_path):
+    """ Get the raw ISSNs which already have a row in an output file"""
+    if os.path.exists(csv_file_path) is False:
+        return set()
+    done = read_sink(csv_file_path, columns=['raw_issn'])
+    return set(done['raw_issn'].dropna().astype(str).tolist())
+
+
+def make_scopus_urls(issn, base_url=SCOPUS_BASE_URL):
+    """ Helper function to build the search, esearch and title urls"""
+    return (base_url + f'search/scopus?query=issn({issn})',
+            base_url + f'search/scopus?query=eissn({issn})',
+            base_url + f'serial/title/issn/{issn}')
+
+
+def parse_scopus_returns(issn, api_return_search, api_return_esearch,
+                         api_return_title):
+    """
+    Function to turn the three API returns for an ISSN into an output row.
+
+    Parameters
+    ----------
+    issn : str
+        the raw ISSN which was queried
+    api_return_search : requests.Response
+        return of the issn() search query
+    api_return_esearch : requests.Response
+        return of the eissn() search query
+    api_return_title : requests.Response
+        return of the serial title query
+
+    Each response body is parsed exactly once.
+
+    Returns
+    -------
+    a list matching the columns of the output csv
+
+    """
+    try:
+        title_json = api_return_title.json()
+        if 'service-error' in title_json:
+            if title_json['service-error']['status']['statusCode'] == 'RESOURCE_NOT_FOUND':
+                prism_issn = 'Resource Not Found'
+                prism_eissn = 'Resource Not Found'
+                dc_title = 'Resource Not Found'
+                logger.warning(f'Resource not found for {issn}.')
             else:
-                results_title = api_return_title.json()['serial-metadata-response']['entry']
-                if len(results_title) == 1:
-                    try:
-                        prism_issn = results_title[0]['prism:issn']
-                    except KeyError:
-                        prism_issn = 'No prism:issn data'
-                        logger.warning(f'No prims:issn data for {issn}.')
-                    try:
-                        prism_eissn = results_title[0]['prism:eIssn']
-                    except KeyError:
-                        prism_eissn = 'No prims:eissn data'
-                        logger.warning(f'No prims:eissn data for {issn}.')
-                    try:
-                        dc_title = results_title[0]['dc:title']
-                    except KeyError:
-                        dc_title = 'No dc:title data'
-                        logger.warning(f'No dc:title data for {issn}.')
-                else:
-                    prism_issn = 'More than 1 return'
-                    prism_eissn = 'More than 1 return'
-                    dc_title = 'More than 1 return'
-                    logger.warning(f'More than one return for {issn}.')
-        except (KeyError, JSONDecodeError, requests.exceptions.RequestException):
-            prism_issn = 'Malformed json return'
-            prism_eissn = 'Malformed json return'
-            dc_title = 'Malformed json return'
-            logger.warning(f'Malformed JSON for {issn}.')
-        try:
-            if 'search-results' in api_return_search.json().keys():
-                results_search = api_return_search.json()['search-results']
-                issn_count = int(results_search['opensearch:totalResults'])
+                prism_issn = 'Other Service Error'
+                prism_eissn = 'Other Service Error'
+                dc_title = 'Other Service Error'
+                logger.warning(f'Other service error for {issn}.')
+        else:
+            results_title = title_json['serial-metadata-response']['entry']
+            if len(results_title) == 1:
+                try:
+                    prism_issn = results_title[0]['prism:issn']
+                except KeyError:
+                    prism_issn = 'No prism:issn data'
+                    logger.warning(f'No prims:issn data for {issn}.')
+                try:
+                    prism_eissn = results_title[0]['prism:eIssn']
+                except KeyError:
+                    prism_eissn = 'No prims:eissn data'
+                    logger.warning(f'No prims:eissn data for {issn}.')
+                try:
+                    dc_title = results_title[0]['dc:title']
+                except KeyError:
+                    dc_title = 'No dc:title data'
+                    logger.warning(f'No dc:title data for {issn}.')
             else:
-                issn_count = np.nan
-                logger.warning(f'No search results for {issn}.')
-        except (KeyError, JSONDecodeError, requests.exceptions.RequestException):
+                prism_issn = 'More than 1 return'
+                prism_eissn = 'More than 1 return'
+                dc_title = 'More than 1 return'
+                logger.warning(f'More than one return for {issn}.')
+    except (KeyError, JSONDecodeError, requests.exceptions.RequestException):
+        prism_issn = 'Malformed json return'
+        prism_eissn = 'Malformed json return'
+        dc_title = 'Malformed json return'
+        logger.warning(f'Malformed JSON for {issn}.')
+    try:
+        search_json = api_return_search.json()
+        if 'search-results' in search_json.keys():
+            results_search = search_json['search-results']
+            issn_count = int(results_search['opensearch:totalResults'])
+        else:
             issn_count = np.nan
-            logger.warning(f'Errors for search-results for {issn}.')
-        try:
-            if 'search-results' in api_return_esearch.json().keys():
-                results_esearch = api_return_esearch.json()['search-results']
-                eissn_count = int(results_esearch['opensearch:totalResults'])
-            else:
-                eissn_count = np.nan
-                logger.warning(f'No esearch results for {issn}.')
-        except (KeyError, JSONDecodeError, requests.exceptions.RequestException):
+            logger.warning(f'No search results for {issn}.')
+    except (KeyError, JSONDecodeError, requests.exceptions.RequestException):
+        issn_count = np.nan
+        logger.warning(f'Errors for search-results for {issn}.')
+    try:
+        esearch_json = api_return_esearch.json()
+        if 'search-results' in esearch_json.keys():
+            results_esearch = esearch_json['search-results']
+            eissn_count = int(results_esearch['opensearch:totalResults'])
+        else:
             eissn_count = np.nan
-            logger.warning(f'Errors for esearch-results for {issn}.')
-        with open(csv_file_path, 'a', newline='') as csv_file:
-            csv_writer = csv.writer(csv_file)
-            csv_writer.writerow([issn,
-                                 issn_count,
-                                 eissn_count,
-                                 prism_issn,
-                                 prism_eissn,
-                                 dc_title])
+            logger.warning(f'No esearch results for {issn}.')
+    except (KeyError, JSONDecodeError, requests.exceptions.RequestException):
+        eissn_count = np.nan
+        logger.warning(f'Errors for esearch-results for {issn}.')
+    return [issn,
+            issn_count,
+            eissn_count,
+            prism_issn,
+            prism_eissn,
+            dc_title]
+
+
+def fetch_issn(issn, scheduler, request_pool, base_url=SCOPUS_BASE_URL,
+               cache=None):
+    """
+    Function to issue the search, esearch and title calls for an ISSN
+    concurrently. Each call is scheduled and retried on its own, so a
+    good response is never thrown away because a sibling call failed.
+    Cached responses are served without using any quota.
+
+    Returns
+    -------
+    a list of the three response objects, in url order
+
+    """
+    futures = [request_pool.submit(fetch_url, url, scheduler, cache)
+               for url in make_scopus_urls(issn, base_url)]
+    return [future.result() for future in futures]
+
+
+def harvest(issn_list, scheduler, issns_per_key=3, base_url=SCOPUS_BASE_URL,
+            cache=None):
+    """
+    Generator which fans ISSNs out across all API keys concurrently.
+
+    Each key is rate limited on its own by the scheduler, so total
+    throughput scales with the number of keys.
+
+    Parameters
+    ----------
+    issn_list : list
+        ISSNs to query
+    scheduler : KeyScheduler
+        scheduler holding the API keys to harvest with, or None to serve
+        only from the cache
+    issns_per_key : int
+        number of ISSNs kept in flight per key
+    base_url : str
+        root of the Elsevier API
+    cache : ResponseCache, optional
+        on-disk cache consulted before any request is made
+
+    Yields
+    ------
+    (issn, [search, esearch, title], error) tuples in the order of
+    issn_list, where error is None on success; on a transient failure
+    the returns are None and error is the exception raised
+
+    """
+    number_keys = 1 if scheduler is None else len(scheduler.states)
+    window = number_keys * issns_per_key
+    with ThreadPoolExecutor(max_workers=window) as issn_pool, \
+            ThreadPoolExecutor(max_workers=window * 3) as request_pool:
+        pending = deque()
+        for issn in issn_list:
+            pending.append((issn, issn_pool.submit(fetch_issn, issn, scheduler,
+                                                   request_pool, base_url,
+                                                   cache)))
+            if len(pending) >= window:
+                yield _harvested(*pending.popleft())
+        while pending:
+            yield _harvested(*pending.popleft())
+
+
+def _harvested(issn, future):
+    try:
+        return issn, future.result(), None
+    except KeysExhaustedError:
+        raise
+    except OfflineCacheMiss as e:
+        return issn, None, e
+    except requests.exceptions.RequestException as e:
+        logger.warning(f'Queueing {issn} for retry: {e!r}')
+        return issn, None, e
+
+
+def run_harvest(issn_list, scheduler, checkpoint, sink, cache=None,
+                base_url=SCOPUS_BASE_URL):
+    """
+    Function to harvest a list of ISSNs, writing a row per success to the
+    result sink and queueing failures in the checkpoint. ISSNs are marked
+    done by the sink once their rows have been flushed to disk. ISSNs
+    missing from an offline cache are left pending, without using up an
+    attempt, for an online run to fetch.
+    """
+    try:
+        for issn, api_returns, error in tqdm(harvest(issn_list, scheduler,
+                                                     base_url=base_url,
+                                                     cache=cache),
+                                             total=len(issn_list)):
+            if isinstance(error, OfflineCacheMiss):
+                metrics.inc('scopus_issns', result='not_cached')
+                continue
+            if error is not None:
+                metrics.inc('scopus_issns', result='failed')
+                checkpoint.mark_failed(issn, repr(error))
+                continue
+            with metrics.span('scopus_parse_write'):
+                sink.write(parse_scopus_returns(issn, *api_returns), item=issn)
+            metrics.inc('scopus_issns', result='harvested')
+    finally:
+        # keep what was harvested before an error or interrupt
+        sink.flush()
+
+
+def get_cache_filename(data_root=DATA_ROOT):
+    return os.path.join(data_root,
+                        'scopus_cache',
+                        'scopus_responses.sqlite')
+
+
+def get_summary_filename(log_file):
+    return os.path.splitext(log_file)[0] + '_summary.json'
+
+
+def count_issns(issn_list, csv_file_path, keys_path=None, cache=None,
+                max_attempts=3, base_url=SCOPUS_BASE_URL):
+    """
+    Count Scopus returns for a list of ISSNs, resuming from the checkpoint
+    kept next to the output and retrying failures.
+
+    Parameters
+    ----------
+    issn_list : list
+        raw ISSNs to count
+    csv_file_path : str
+        output file, appended to by an interrupted run picking up again
+    keys_path : str, optional
+        directory of API key files; without it the ISSNs are only
+        answered from the cache
+    cache : ResponseCache, optional
+        cache of API responses
+    max_attempts : int
+        attempts per ISSN before it is given up on
+    base_url : str
+        root of the Elsevier API
+
+    Returns
+    -------
+    dict
+        numbers of ISSNs left failed: 'given_up' after max_attempts and
+        'retry_queue' still to be retried
+
+    """
+    os.makedirs(os.path.dirname(csv_file_path) or '.', exist_ok=True)
+    if keys_path is None:
+        scheduler = None
+    else:
+        scheduler = KeyScheduler(make_apikey_list(keys_path),
+                                 call=call_scopus_search_api)
+    # the sink is closed first, so rows buffered when the harvest stops,
+    # however it stops, are written and marked done before the checkpoint
+    # is closed
+    with Checkpoint(get_checkpoint_filename(csv_file_path)) as checkpoint, \
+            make_sink(csv_file_path, SCOPUS_COLUMNS,
+                      on_flush=checkpoint.mark_done) as sink:
+        completed = checkpoint.completed() | \
+            load_completed_issns(csv_file_path)
+        given_up = checkpoint.given_up(max_attempts)
+        retry_queue = set(checkpoint.retry_queue(max_attempts))
+        todo = [issn for issn in dict.fromkeys(issn_list)
+                if issn not in completed and issn not in given_up
+                and issn not in retry_queue]
+        logger.info(f'Resuming with {len(completed)} ISSNs done, '
+                    f'{len(todo)} to go and {len(retry_queue)} queued for '
+                    f'retry')
+        with metrics.span('scopus_harvest'):
+            run_harvest(todo, scheduler, checkpoint, sink, cache, base_url)
+        for attempt in range(max_attempts):
+            retry_queue = checkpoint.retry_queue(max_attempts)
+            if len(retry_queue) == 0:
+                break
+            logger.info(f'Retrying {len(retry_queue)} failed ISSNs')
+            with metrics.span('scopus_retry_pass'):
+                run_harvest(retry_queue, scheduler, checkpoint, sink, cache,
+                            base_url)
+        unfinished = {
+            'given_up': len(checkpoint.given_up(max_attempts)),
+            'retry_queue': len(checkpoint.retry_queue(max_attempts))}
+    if any(unfinished.values()):
+        logger.warning(f'{unfinished["given_up"]} ISSNs given up on and '
+                       f'{unfinished["retry_queue"]} left to retry')
+    if cache is not None:
+        logger.info(f'Response cache: {cache.hits} hits, '
+                    f'{cache.misses} misses')
+    if scheduler is not None:
+        for key_metrics in scheduler.metrics():
+            logger.info(f'Key quota: {key_metrics}')
+    return unfinished
+
+
+def main(year=2022, data_root=DATA_ROOT, max_attempts=3, offline=False,
+         metrics_path=None):
+    """
+    Count Scopus returns for every OJS ISSN of a year.
+
+    :param year: year of the OJS ISSN list
+    :param data_root: data directory holding the raw inputs and outputs
+    :param max_attempts: attempts per ISSN before it is given up on
+    :param offline: replay responses from the cache only, e.g. to rebuild
+                    the output without touching the network
+    :param metrics_path: if given, a Prometheus textfile the run's
+                         metrics are written to, e.g. in the textfile
+                         directory of a Prometheus node exporter
+    """
+    metrics.reset()
+    log_file = os.path.join(data_root, '..', 'logging', get_log_filename())
+    logger.add(log_file)
+    cache = ResponseCache(get_cache_filename(data_root), offline=offline)
+    logger.info('Loading raw ISSN data')
+    raw_issn = load_issns(os.path.join(data_root, 'raw', 'issn_inputs'), year)
+    issn_list = raw_issn['issn_ojs'].astype(str).tolist()
+    keys_path = None if offline else os.path.join(data_root, '..', 'keys')
+    count_issns(issn_list, get_csv_filename(year, data_root), keys_path,
+                cache, max_attempts)
+    metrics.write_summary(get_summary_filename(log_file))
+    if metrics_path is not None:
+        metrics.write_textfile(metrics_path)
+    cache.close()
 
 
 if __name__ == '__main__':
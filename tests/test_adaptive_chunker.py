@@ -0,0 +1,19 @@
+import json
+
+from adaptive_chunker import AdaptiveChunker
+from query_builder import build_query
+
+# BigQuery rejects query requests over 10 MB
+REQUEST_LIMIT = 10 * 1000 ** 2
+
+
+def test_largest_pub_id_chunk_fits_in_a_request():
+    pub_ids = [f'pub.{number}' for number in
+               range(1_000_000_000, 1_002_000_000)]
+    chunk = next(AdaptiveChunker(pub_ids).chunks())
+    assert len(chunk) < len(pub_ids)
+    query, parameters = build_query(chunk, 'article', 'full')
+    request = json.dumps({'query': query,
+                          'queryParameters': [parameter.to_api_repr()
+                                              for parameter in parameters]})
+    assert len(request.encode('utf-8')) < REQUEST_LIMIT
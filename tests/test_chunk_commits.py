@@ -0,0 +1,61 @@
+import os
+
+import pyarrow as pa
+import pytest
+
+from gbq_collector import has_committed_rows, save_batches, \
+    read_publications
+
+
+def numbered_batches(chunks, crash_after=None):
+    """
+    Helper function to yield each chunk as two record batches and an end
+    marker, raising once crash_after batches have been yielded
+    """
+    yielded = 0
+    for number, chunk in enumerate(chunks):
+        for half in (chunk[:len(chunk) // 2], chunk[len(chunk) // 2:]):
+            if yielded == crash_after:
+                raise KeyboardInterrupt
+            yield number, chunk, pa.RecordBatch.from_pydict({'id': half})
+            yielded += 1
+        yield number, chunk, None
+
+
+def read_ids(file_path, output_format):
+    """ Helper function to read back the ids of an output"""
+    if output_format == 'parquet':
+        return read_publications(file_path, columns=['id'])['id'].to_pylist()
+    with open(file_path) as file:
+        return [line.strip().split(',')[1] for line in file]
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+@pytest.mark.parametrize('crash_after', [1, 3])
+def test_rerun_after_a_crash_saves_every_row_once(tmp_path, output_format,
+                                                  crash_after):
+    file_path = os.path.join(tmp_path, f'references.{output_format}')
+    chunks = [['a', 'b', 'c', 'd'], ['e', 'f']]
+    committed = []
+    with pytest.raises(KeyboardInterrupt):
+        save_batches(numbered_batches(chunks, crash_after), file_path,
+                     output_format, on_chunk=committed.append)
+    # the rerun queries only the chunks which were not committed
+    todo = [chunk for chunk in chunks if chunk not in committed]
+    save_batches(numbered_batches(todo), file_path, output_format,
+                 on_chunk=committed.append)
+    assert sorted(read_ids(file_path, output_format)) == \
+        ['a', 'b', 'c', 'd', 'e', 'f']
+    assert committed == chunks
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_only_committed_chunks_count_as_output(tmp_path, output_format):
+    file_path = os.path.join(tmp_path, f'pubs.{output_format}')
+    with pytest.raises(KeyboardInterrupt):
+        save_batches(numbered_batches([['a', 'b']], crash_after=1),
+                     file_path, output_format)
+    assert os.path.exists(file_path)
+    assert not has_committed_rows(file_path, output_format)
+    save_batches(numbered_batches([['a', 'b']]), file_path, output_format)
+    assert has_committed_rows(file_path, output_format)
@@ -0,0 +1,68 @@
+import pyarrow as pa
+import pytest
+
+from fakes import FakeBigQueryClient
+from gbq_collector import collect_issns, get_refs_and_cites, read_publications
+from query_builder import expand_locally
+
+duckdb = pytest.importorskip('duckdb')
+
+CITATION = pa.struct([('id', pa.string()), ('year', pa.int64())])
+ISSNS = ['1111-1111', '2222-2222']
+
+
+@pytest.fixture
+def publications():
+    """
+    Two seed articles of the ISSNs, linked to articles, to a pub missing
+    from the table and to a chapter, which expansion leaves out.
+    """
+    return pa.table({
+        'id': ['pub.a', 'pub.b', 'pub.c', 'pub.d', 'pub.e', 'pub.f'],
+        'type': ['article'] * 5 + ['chapter'],
+        'issn': ['1111-1111', None, '9999-9999', None, None, None],
+        'eissn': [None, '2222-2222', None, None, None, None],
+        'reference_ids': pa.array([['pub.c', 'pub.d', 'pub.x'], ['pub.d'],
+                                   [], ['pub.a'], None, None],
+                                  pa.list_(pa.string())),
+        'citations': pa.array([[{'id': 'pub.e', 'year': 2021}],
+                               [{'id': 'pub.f', 'year': 2022},
+                                {'id': 'pub.c', 'year': 2020}],
+                               [], [], None, None], pa.list_(CITATION)),
+    })
+
+
+def local_expansion(publications, kind):
+    """ Helper function to expand the ISSNs in DuckDB, as BigQuery would"""
+    connection = duckdb.connect()
+    journal = pa.StructArray.from_arrays(
+        [publications['issn'].combine_chunks(),
+         publications['eissn'].combine_chunks()], names=['issn', 'eissn'])
+    table = publications.drop_columns(['issn', 'eissn']) \
+        .append_column('journal', journal)
+    connection.register('publications', table)
+    return set(expand_locally(connection, ISSNS, kind,
+                              columns='links')['id'].to_pylist())
+
+
+def client_expansion(publications, tmp_path):
+    """ Helper function to collect and expand the ISSNs on the client"""
+    client = FakeBigQueryClient(publications)
+    collect_issns(ISSNS, str(tmp_path), client, 'parquet', 'links')
+    get_refs_and_cites(str(tmp_path), client, 'parquet', columns='links')
+    return {kind: set(read_publications(
+        str(tmp_path / f'{name}.parquet'), columns=['id'])['id'].to_pylist())
+        for kind, name in [('reference', 'references_of_all_pubs'),
+                           ('citation', 'citations_of_all_pubs')]}
+
+
+def test_local_expansion_matches_client_side_expansion(publications,
+                                                       tmp_path):
+    expected = {'reference': {'pub.c', 'pub.d'},
+                'citation': {'pub.c', 'pub.e'}}
+    for kind in expected:
+        assert local_expansion(publications, kind) == expected[kind]
+    # the client fetches a pub both referenced and citing only once
+    client_side = client_expansion(publications, tmp_path)
+    assert client_side == {'reference': {'pub.c', 'pub.d'},
+                           'citation': {'pub.e'}}
@@ -0,0 +1,35 @@
+import re
+
+from instrumentation import Metrics
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? \S+$')
+
+
+def test_textfile_samples_match_their_type_lines():
+    metrics = Metrics()
+    metrics.inc('bigquery_jobs', query_type='issn')
+    metrics.inc('scopus_issns_total', result='done')
+    metrics.set('key_remaining', 5, key='****abcd')
+    metrics.observe('stage_seconds', 0.2, kind='collect')
+    typed = {}
+    for line in metrics.prometheus_text().splitlines():
+        if line.startswith('#'):
+            _, _, name, kind = line.split()
+            typed[name] = kind
+            continue
+        name = SAMPLE.match(line).group(1)
+        family = re.sub(r'_(bucket|sum|count)$', '', name) \
+            if name not in typed else name
+        assert family in typed, line
+    assert typed == {'bigquery_jobs_total': 'counter',
+                     'scopus_issns_total': 'counter',
+                     'key_remaining': 'gauge',
+                     'stage_seconds': 'histogram'}
+
+
+def test_reset_clears_the_previous_run():
+    metrics = Metrics()
+    metrics.inc('bigquery_jobs', query_type='issn')
+    metrics.reset()
+    assert metrics.prometheus_text() == '\n'
+    assert metrics.summary()['counters'] == []
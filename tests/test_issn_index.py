@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+from helper_functions import spine_rows, validate_issns
+from issn_index import MISSING, IssnIndex, check_digits_valid, \
+    decode_issns, encode_issns, normalise_issns
+
+
+def test_normalise_strips_separators_and_upper_cases():
+    assert normalise_issns([' 0378-5955 ', '1050 124x', '0028–0836']) \
+        .tolist() == ['03785955', '1050124X', '00280836']
+
+
+def test_encoding_round_trips():
+    keys = encode_issns(['0378-5955', '1050-124x', ' 00280836'])
+    assert (keys != MISSING).all()
+    assert decode_issns(keys).tolist() == ['0378-5955', '1050-124X',
+                                           '0028-0836']
+
+
+def test_malformed_values_are_missing():
+    keys = encode_issns(['12345', 'abcd-efgh', None, '0378-59555', ''])
+    assert (keys == MISSING).all()
+    assert decode_issns(keys).tolist() == [None] * 5
+
+
+def test_check_digits():
+    keys = encode_issns(['0378-5955', '1050-124X', '0028-0836', '0378-5954',
+                         '1050-1241', 'junk'])
+    assert check_digits_valid(keys).tolist() == [True, True, True, False,
+                                                 False, False]
+    assert validate_issns(['0378-5955', '0378-5954', 'junk'])[1].tolist() \
+        == ['ok', 'bad_check_digit', 'bad_format']
+
+
+def test_spine_rows_explode_issn_l_groups():
+    index = IssnIndex.from_pairs(
+        encode_issns(['1050-124X', '0378-5955', '0028-0836']),
+        encode_issns(['0378-5955', '0378-5955', '0028-0836']))
+    inputs = pd.DataFrame({'issn_ojs': ['1050-124x', '0378-5954', 'junk',
+                                        '0317-8471', '0028-0836'],
+                           'journal': ['a', 'b', 'c', 'd', 'e']})
+    spine, status = spine_rows(inputs, index)
+    assert status.tolist() == ['ok', 'bad_check_digit', 'bad_format',
+                               'no_issn_l', 'ok']
+    expected = pd.DataFrame(
+        [['a', '1050-124X', 'ok', '0378-5955', '0378-5955'],
+         ['a', '1050-124X', 'ok', '0378-5955', '1050-124X'],
+         ['b', '0378-5954', 'bad_check_digit', None, None],
+         ['c', None, 'bad_format', None, None],
+         ['d', '0317-8471', 'no_issn_l', None, None],
+         ['e', '0028-0836', 'ok', '0028-0836', '0028-0836']],
+        columns=['journal', 'issn_normalised', 'issn_status', 'ISSN-L',
+                 'ISSN'])
+    assert spine[expected.columns].values.tolist() == \
+        expected.values.tolist()
+    assert np.array_equal(spine['issn_ojs'].to_numpy(),
+                          inputs['issn_ojs'].to_numpy()[[0, 0, 1, 2, 3, 4]])
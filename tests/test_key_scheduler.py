@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+from fakes import ScopusStandIn
+from key_scheduler import KeyScheduler, KeysExhaustedError
+from scopus_counter import call_scopus_search_api
+
+
+def search_url(stand_in, issn='0378-5955'):
+    """ Helper function to build a search url on the stand-in"""
+    return stand_in.base_url + f'search/scopus?query=issn({issn})'
+
+
+def states(scheduler):
+    """ Helper function to look up the scheduler's key states by key"""
+    return {state.key: state for state in scheduler.states}
+
+
+def test_acquire_picks_the_key_with_most_headroom():
+    scheduler = KeyScheduler(['key-a', 'key-b', 'key-c'], call=None)
+    for state, remaining in zip(scheduler.states, [5, 40, 12]):
+        state.remaining = remaining
+    picked = scheduler.acquire()
+    assert picked.key == 'key-b'
+    assert picked.in_flight == 1
+    # headroom is net of the calls in flight
+    states(scheduler)['key-b'].in_flight = 30
+    assert scheduler.acquire().key == 'key-c'
+
+
+def test_exhausted_key_is_parked_until_reset_and_rearmed():
+    with ScopusStandIn(quota=2, window=1.0) as stand_in:
+        scheduler = KeyScheduler(['key-a'], call=call_scopus_search_api,
+                                 max_park=10)
+        start = time.time()
+        responses = [scheduler.request(search_url(stand_in))
+                     for _ in range(5)]
+        assert [response.status_code for response in responses] == [200] * 5
+        # two quota windows were waited out rather than answered 429
+        assert time.time() - start >= 1
+        assert stand_in.rejected == 0
+        state = states(scheduler)['key-a']
+        assert not state.retired and state.calls == 5
+
+
+def test_key_whose_reset_is_beyond_max_park_is_retired():
+    with ScopusStandIn(quota=1, window=600) as stand_in:
+        scheduler = KeyScheduler(['key-a', 'key-b'],
+                                 call=call_scopus_search_api, max_park=5)
+        for _ in range(2):
+            assert scheduler.request(search_url(stand_in)).status_code == 200
+        assert all(state.retired for state in scheduler.states)
+        with pytest.raises(KeysExhaustedError):
+            scheduler.request(search_url(stand_in))
+
+
+def test_key_answering_401_is_retired():
+    with ScopusStandIn(faults={'key-a': [401] * 10}) as stand_in:
+        scheduler = KeyScheduler(['key-a', 'key-b'],
+                                 call=call_scopus_search_api)
+        for _ in range(3):
+            assert scheduler.request(search_url(stand_in)).status_code == 200
+        key_a, key_b = states(scheduler)['key-a'], states(scheduler)['key-b']
+        assert key_a.retired and key_a.calls == 1
+        assert not key_b.retired
+
+
+@pytest.mark.parametrize('statuses', [[429, 429], [503, 500], [429, 502]])
+def test_transient_errors_back_off_the_key_and_are_retried(statuses):
+    with ScopusStandIn(faults={'key-a': statuses}) as stand_in:
+        scheduler = KeyScheduler(['key-a'], call=call_scopus_search_api,
+                                 backoff_base=0.05, backoff_cap=0.2)
+        assert scheduler.request(search_url(stand_in)).status_code == 200
+        state = states(scheduler)['key-a']
+        assert state.calls == 3 and state.errors == 2
+        assert state.failures == 0 and not state.retired
+
+
+def test_backoff_parks_only_the_failing_key(monkeypatch):
+    # full jitter, pinned to the longest interval
+    monkeypatch.setattr('key_scheduler.random.uniform',
+                        lambda low, high: high)
+    with ScopusStandIn(faults={'key-a': [503]}) as stand_in:
+        scheduler = KeyScheduler(['key-a', 'key-b'],
+                                 call=call_scopus_search_api,
+                                 backoff_base=30, backoff_cap=30)
+        # key-a is picked first on equal headroom, then parked
+        before = time.time()
+        scheduler.request(search_url(stand_in))
+        key_a, key_b = states(scheduler)['key-a'], states(scheduler)['key-b']
+        assert key_a.errors == 1 and key_a.parked_until >= before + 30
+        assert key_b.calls == 1
+        start = time.time()
+        for _ in range(3):
+            scheduler.request(search_url(stand_in))
+        assert time.time() - start < 5
+        assert key_a.calls == 1
+
+
+def test_all_keys_retired_raises_keys_exhausted():
+    with ScopusStandIn(faults={'key-a': [401], 'key-b': [401]}) as stand_in:
+        scheduler = KeyScheduler(['key-a', 'key-b'],
+                                 call=call_scopus_search_api)
+        with pytest.raises(KeysExhaustedError):
+            scheduler.request(search_url(stand_in))
+        assert all(state.retired for state in scheduler.states)
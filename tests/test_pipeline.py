@@ -0,0 +1,113 @@
+import os
+
+import pandas as pd
+import pytest
+
+from benchmarks import make_issn_inputs, make_issn_pairs, make_publications
+from fakes import FakeBigQueryClient, ScopusStandIn
+from pipeline import Incomplete, Pipeline, Stage, build_stages
+
+YEARS = [2021, 2022]
+
+
+class BrokenClient(FakeBigQueryClient):
+    """Fake client whose every query fails."""
+
+    def query(self, query, job_config=None):
+        raise RuntimeError('BigQuery is down')
+
+
+@pytest.fixture
+def data_root(tmp_path):
+    """
+    Raw inputs of two years, an ISSN-L dump and Elsevier keys in the
+    layout the pipeline expects.
+    """
+    root = tmp_path / 'data'
+    pairs = make_issn_pairs(60)
+    (root / 'issn_l_lookup').mkdir(parents=True)
+    pairs.to_csv(root / 'issn_l_lookup' / '20230427.ISSN-to-ISSN-L.txt',
+                 sep='\t', index=False)
+    for seed, year in enumerate(YEARS):
+        (root / 'raw' / 'issn_inputs' / str(year)).mkdir(parents=True)
+        make_issn_inputs(30, pairs['ISSN'].to_numpy(), seed).to_csv(
+            raw_list(root, year), index=False)
+    (tmp_path / 'keys').mkdir()
+    for number in range(10):
+        (tmp_path / 'keys' / f'elsevier_apikey_{number}').write_text(
+            f'key-{number}')
+    return root
+
+
+def raw_list(root, year):
+    """ Helper function to locate a year's raw OJS ISSN list"""
+    return root / 'raw' / 'issn_inputs' / str(year) / \
+        f'full_ojs_issn_list_{year}.csv'
+
+
+def run(data_root, client=None):
+    """ Helper function to run every stage of both years once"""
+    if client is None:
+        issns = pd.read_csv(data_root / 'issn_l_lookup' /
+                            '20230427.ISSN-to-ISSN-L.txt', sep='\t')['ISSN']
+        client = FakeBigQueryClient(make_publications(300, issns.to_numpy()))
+    with ScopusStandIn() as stand_in:
+        stages = build_stages(YEARS, str(data_root), client=client,
+                              keys_path=str(data_root.parent / 'keys'),
+                              scopus_base_url=stand_in.base_url)
+        return Pipeline(stages,
+                        str(data_root / 'pipeline_state.json')).run()
+
+
+def test_unchanged_inputs_skip_and_edits_rerun_only_dependent_stages(
+        data_root):
+    first = run(data_root)
+    assert set(first.values()) == {'ran'}
+    assert set(run(data_root).values()) == {'skipped'}
+
+    # a column other than the ISSNs changes, so the ISSN list does not
+    path = raw_list(data_root, 2022)
+    inputs = pd.read_csv(path)
+    inputs['extra'] = 1
+    inputs.to_csv(path, index=False)
+    third = run(data_root)
+    assert {name for name, result in third.items() if result == 'ran'} == \
+        {'issns/2022', 'spine/2022', 'coverage/2022'}
+    assert set(third.values()) == {'ran', 'skipped'}
+
+
+def test_failed_stage_blocks_only_the_stages_after_it(data_root):
+    status = run(data_root, client=BrokenClient(None))
+    for year in YEARS:
+        assert status[f'collect/{year}'] == 'failed'
+        for kind in ('expand', 'graph', 'coverage'):
+            assert status[f'{kind}/{year}'] == 'blocked'
+        for kind in ('issns', 'spine', 'scopus'):
+            assert status[f'{kind}/{year}'] == 'ran'
+    # the failed stages were not recorded, so they run next time
+    status = run(data_root)
+    for year in YEARS:
+        for kind in ('collect', 'expand', 'graph', 'coverage'):
+            assert status[f'{kind}/{year}'] == 'ran'
+        for kind in ('issns', 'spine', 'scopus'):
+            assert status[f'{kind}/{year}'] == 'skipped'
+
+
+def test_incomplete_stage_runs_again_without_blocking(tmp_path):
+    output = tmp_path / 'counts.csv'
+    output.write_text('raw_issn\n')
+    unfinished = [{'given_up': 2, 'retry_queue': 0},
+                  {'given_up': 0, 'retry_queue': 0}]
+    stages = [Stage('scopus/2022', lambda: Incomplete(unfinished.pop(0)),
+                    outputs=[str(output)]),
+              Stage('report/2022', lambda: None, after=['scopus/2022'])]
+    state_path = str(tmp_path / 'pipeline_state.json')
+    pipeline = Pipeline(stages, state_path)
+    assert pipeline.run() == {'scopus/2022': 'incomplete',
+                              'report/2022': 'ran'}
+    assert pipeline.state['stages']['scopus/2022']['unfinished'] == \
+        {'given_up': 2, 'retry_queue': 0}
+    assert Pipeline(stages, state_path).run() == {'scopus/2022': 'ran',
+                                                  'report/2022': 'skipped'}
+    assert Pipeline(stages, state_path).run() == {'scopus/2022': 'skipped',
+                                                  'report/2022': 'skipped'}
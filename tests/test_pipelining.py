@@ -0,0 +1,103 @@
+import time
+
+import pyarrow as pa
+import pytest
+
+from fakes import FakeBigQueryClient, FakeQueryJob
+from gbq_collector import run_pipelined, run_streaming
+
+PUB_IDS = [f'pub.{number}' for number in range(120)]
+CHUNKS = [PUB_IDS[position:position + 10]
+          for position in range(0, len(PUB_IDS), 10)]
+
+
+class SlowJob(FakeQueryJob):
+    """Query job whose result only arrives after a delay."""
+
+    def __init__(self, job, delay):
+        super().__init__(job.table, job.total_bytes_processed,
+                         error=job.error)
+        self.delay = delay
+
+    def result(self, page_size=None):
+        time.sleep(self.delay)
+        return super().result(page_size)
+
+
+class OutOfOrderClient(FakeBigQueryClient):
+    """
+    Fake client whose jobs finish in reverse order of submission, failing
+    the job of any chunk holding the failing pub id.
+    """
+
+    def __init__(self, publications, failing=None):
+        super().__init__(publications)
+        self.failing = failing
+
+    def query(self, query, job_config=None):
+        job = super().query(query, job_config)
+        pub_ids = job_config.query_parameters[0].values
+        if self.failing in pub_ids:
+            job.error = RuntimeError('Job failed')
+        return SlowJob(job, max(0.0, 0.05 - 0.01 * (self.jobs % 5)))
+
+
+@pytest.fixture
+def publications():
+    return pa.table({'id': PUB_IDS,
+                     'type': ['article'] * len(PUB_IDS),
+                     'issn': [None] * len(PUB_IDS),
+                     'eissn': [None] * len(PUB_IDS),
+                     'reference_ids': [[f'ref.{number}'] * (number % 3)
+                                       for number in range(len(PUB_IDS))]})
+
+
+def sequential(publications):
+    """ Helper function to query every chunk one job at a time"""
+    return [(chunk, results['id'].tolist()) for chunk, results in
+            run_pipelined(CHUNKS, OutOfOrderClient(publications), 'article',
+                          max_in_flight=1, columns='links')]
+
+
+def test_pipelined_results_match_sequential(publications):
+    pipelined = [(chunk, results['id'].tolist()) for chunk, results in
+                 run_pipelined(CHUNKS, OutOfOrderClient(publications),
+                               'article', max_in_flight=4, columns='links')]
+    assert pipelined == sequential(publications)
+    assert sum(len(ids) for _, ids in pipelined) == len(PUB_IDS)
+
+
+def test_streamed_results_match_sequential(publications):
+    streamed = {}
+    for number, chunk, batch in run_streaming(CHUNKS,
+                                              OutOfOrderClient(publications),
+                                              'article', max_in_flight=4,
+                                              page_size=4, columns='links'):
+        ids = streamed.setdefault(number, (chunk, []))[1]
+        if batch is not None:
+            ids.extend(batch.column('id').to_pylist())
+    assert sorted(streamed) == list(range(len(CHUNKS)))
+    assert [streamed[number] for number in sorted(streamed)] == \
+        sequential(publications)
+
+
+@pytest.mark.parametrize('max_in_flight', [1, 4])
+def test_chunk_failure_propagates_after_earlier_chunks(publications,
+                                                       max_in_flight):
+    client = OutOfOrderClient(publications, failing='pub.55')
+    yielded = []
+    with pytest.raises(RuntimeError, match='Job failed'):
+        for chunk, results in run_pipelined(CHUNKS, client, 'article',
+                                            max_in_flight=max_in_flight,
+                                            columns='links'):
+            yielded.append((chunk, results['id'].tolist()))
+    assert yielded == sequential(publications)[:5]
+
+    streamed = []
+    with pytest.raises(RuntimeError, match='Job failed'):
+        for number, chunk, batch in run_streaming(
+                CHUNKS, OutOfOrderClient(publications, failing='pub.55'),
+                'article', max_in_flight=max_in_flight, columns='links'):
+            if batch is None:
+                streamed.append(number)
+    assert streamed == list(range(5))
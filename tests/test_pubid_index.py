@@ -0,0 +1,75 @@
+import os
+
+import pyarrow as pa
+import pytest
+
+from fakes import FakeBigQueryClient
+from gbq_collector import collect_issns, get_refs_and_cites
+
+CITATION = pa.struct([('id', pa.string()), ('year', pa.int64())])
+
+
+class RecordingClient(FakeBigQueryClient):
+    """Fake client recording every pub id it is queried for."""
+
+    def __init__(self, publications):
+        super().__init__(publications)
+        self.queried = []
+
+    def query(self, query, job_config=None):
+        parameter = job_config.query_parameters[0]
+        if parameter.name == 'pubids':
+            self.queried += parameter.values
+        return super().query(query, job_config)
+
+
+@pytest.fixture
+def publications():
+    """
+    A seed article of the ISSN, whose references and citations overlap
+    each other, the seed and the pubs of the next hop.
+    """
+    return pa.table({
+        'id': ['pub.a', 'pub.b', 'pub.c', 'pub.d'],
+        'type': ['article'] * 4,
+        'issn': ['1111-1111', None, None, None],
+        'eissn': pa.array([None] * 4, pa.string()),
+        'reference_ids': pa.array([['pub.b', 'pub.c'], ['pub.c', 'pub.d'],
+                                   ['pub.d'], ['pub.a']],
+                                  pa.list_(pa.string())),
+        'citations': pa.array([[{'id': 'pub.c', 'year': 2021}],
+                               [{'id': 'pub.a', 'year': 2022}], [], []],
+                              pa.list_(CITATION)),
+    })
+
+
+def expand(publications, issn_out, output_format, hops=1):
+    """ Helper function to collect and expand the ISSN, recording queries"""
+    client = RecordingClient(publications)
+    if not os.path.exists(os.path.join(
+            issn_out, f'pubs_from_all_issns.{output_format}')):
+        collect_issns(['1111-1111'], issn_out, client, output_format,
+                      'links')
+    get_refs_and_cites(issn_out, client, output_format, hops=hops,
+                       columns='links')
+    return client.queried
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_multi_hop_expansion_queries_every_pub_once(publications, tmp_path,
+                                                    output_format):
+    queried = expand(publications, str(tmp_path), output_format, hops=2)
+    assert sorted(queried) == ['pub.b', 'pub.c', 'pub.d']
+
+
+def test_index_is_filled_from_existing_outputs(publications, tmp_path):
+    issn_out = str(tmp_path)
+    expand(publications, issn_out, 'csv')
+    output = os.path.join(issn_out, 'references_of_all_pubs.csv')
+    with open(output) as file:
+        rows = file.readlines()
+    # outputs written before the index existed
+    os.remove(os.path.join(issn_out, 'fetched_pub_ids.sqlite'))
+    assert expand(publications, issn_out, 'csv') == []
+    with open(output) as file:
+        assert file.readlines() == rows
@@ -0,0 +1,93 @@
+import pytest
+import requests
+
+from checkpoint import Checkpoint
+from fakes import ScopusStandIn
+from response_cache import ResponseCache
+from result_sink import read_sink
+from scopus_counter import count_issns, get_checkpoint_filename
+
+SEARCH_URL = 'https://api.elsevier.com/content/search/scopus?query=issn({})'
+
+
+def make_response(body=b'{}', status_code=200):
+    """ Helper function to build a response as requests returns it"""
+    response = requests.models.Response()
+    response.status_code = status_code
+    response._content = body
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Settable stand-in for the time the cache sees."""
+    now = [1000.0]
+    monkeypatch.setattr('response_cache.time.time', lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_their_endpoint_ttl(tmp_path, clock):
+    path = str(tmp_path / 'cache' / 'responses.sqlite')
+    cache = ResponseCache(path, ttls={'search': 60})
+    url = SEARCH_URL.format('0378-5955')
+    cache.put(url, make_response(b'{"count": 1}'))
+    clock[0] += 30
+    assert cache.get(url).json() == {'count': 1}
+    clock[0] += 31
+    assert cache.get(url) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+    # offline, entries are served regardless of age
+    offline = ResponseCache(path, ttls={'search': 60}, offline=True)
+    assert offline.get(url).json() == {'count': 1}
+    offline.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite'), max_bytes=300)
+    urls = [SEARCH_URL.format(f'0000-000{number}') for number in range(4)]
+    for url in urls[:3]:
+        clock[0] += 1
+        cache.put(url, make_response(b'x' * 100))
+    clock[0] += 1
+    assert cache.get(urls[0]) is not None
+    clock[0] += 1
+    cache.put(urls[3], make_response(b'x' * 100))
+    assert [cache.get(url) is not None for url in urls] == \
+        [True, False, False, True]
+    assert cache.size == 200
+    cache.close()
+
+
+def test_only_final_statuses_are_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'responses.sqlite'))
+    cache.put(SEARCH_URL.format('0378-5955'), make_response(status_code=429))
+    cache.put(SEARCH_URL.format('1050-124X'), make_response(status_code=404))
+    assert cache.get(SEARCH_URL.format('0378-5955')) is None
+    assert cache.get(SEARCH_URL.format('1050-124X')).status_code == 404
+    cache.close()
+
+
+def test_offline_misses_stay_pending(tmp_path):
+    issns = ['0378-5955', '1050-124X', '2049-3630']
+    keys_path = tmp_path / 'keys'
+    keys_path.mkdir()
+    (keys_path / 'elsevier_apikey_0').write_text('key-0')
+    cache_path = str(tmp_path / 'cache' / 'responses.sqlite')
+    csv_file_path = str(tmp_path / 'scopus_counts.csv')
+
+    offline = ResponseCache(cache_path, offline=True)
+    unfinished = count_issns(issns, csv_file_path, cache=offline)
+    offline.close()
+    assert unfinished == {'given_up': 0, 'retry_queue': 0}
+    with Checkpoint(get_checkpoint_filename(csv_file_path)) as checkpoint:
+        assert checkpoint.retry_queue() == []
+        assert checkpoint.completed() == set()
+
+    with ScopusStandIn() as stand_in:
+        cache = ResponseCache(cache_path)
+        count_issns(issns, csv_file_path, str(keys_path), cache,
+                    base_url=stand_in.base_url)
+        cache.close()
+    assert sorted(read_sink(csv_file_path)['raw_issn']) == sorted(issns)
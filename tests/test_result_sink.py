@@ -0,0 +1,32 @@
+import os
+
+import pandas as pd
+import pytest
+
+from result_sink import make_sink, read_sink
+
+COLUMNS = ['raw_issn', 'count']
+
+
+def test_crash_mid_flush_leaves_parquet_output_readable(tmp_path,
+                                                        monkeypatch):
+    path = str(tmp_path / 'counts.parquet')
+    flushed = []
+    sink = make_sink(path, COLUMNS, batch_size=2, on_flush=flushed.extend)
+    sink.write(['0378-5955', '1'], item='0378-5955')
+    sink.write(['1050-124X', '2'], item='1050-124X')
+
+    def truncated(self, file, index=False):
+        file.write(b'PAR1 truncated')
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(pd.DataFrame, 'to_parquet', truncated)
+    sink.write(['2049-3630', '3'], item='2049-3630')
+    with pytest.raises(KeyboardInterrupt):
+        sink.write(['0000-0000', '4'], item='0000-0000')
+    monkeypatch.undo()
+
+    assert flushed == ['0378-5955', '1050-124X']
+    assert read_sink(path)['raw_issn'].tolist() == ['0378-5955', '1050-124X']
+    assert len([name for name in os.listdir(path)
+                if not name.startswith('_')]) == 1
@@ -0,0 +1,88 @@
+import re
+import functools
+import threading
+
+import pytest
+import requests
+
+import scopus_counter
+from checkpoint import Checkpoint
+from fakes import ScopusStandIn
+from key_scheduler import KeyScheduler
+from result_sink import read_sink
+from scopus_counter import call_scopus_search_api, count_issns, \
+    get_checkpoint_filename
+
+ISSNS = [f'{number:04d}-{number % 1000:03d}X'
+         for number in range(1000, 1040)]
+FAILING = ISSNS[7]
+
+
+class Calls:
+    """
+    Stand-in call recording the ISSN of every request, failing every
+    request for FAILING and, once crash_after calls were made, raising
+    KeyboardInterrupt as if the run were killed.
+    """
+
+    def __init__(self, crash_after=None):
+        self.crash_after = crash_after
+        self.issns = []
+        self.lock = threading.Lock()
+
+    def __call__(self, url, key):
+        issn = re.search(r'\d{4}-\d{3}[\dX]', url).group(0)
+        with self.lock:
+            if self.crash_after is not None and \
+                    len(self.issns) >= self.crash_after:
+                raise KeyboardInterrupt
+            self.issns.append(issn)
+        if issn == FAILING:
+            raise requests.exceptions.ConnectionError('connection reset')
+        return call_scopus_search_api(url, key)
+
+
+@pytest.fixture
+def keys_path(tmp_path):
+    path = tmp_path / 'keys'
+    path.mkdir()
+    for number in range(2):
+        (path / f'elsevier_apikey_{number}').write_text(f'key-{number}')
+    return str(path)
+
+
+def test_interrupted_harvest_resumes_without_refetching(tmp_path, keys_path,
+                                                        monkeypatch):
+    # one attempt per url, no real backoff and no rate limit, so failures
+    # reach the checkpoint quickly
+    monkeypatch.setattr(scopus_counter, 'KeyScheduler',
+                        functools.partial(KeyScheduler, rate=1000,
+                                          max_attempts=1,
+                                          backoff_base=0.001,
+                                          backoff_cap=0.001))
+    csv_file_path = str(tmp_path / 'scopus_counts.csv')
+    with ScopusStandIn() as stand_in:
+        crashed = Calls(crash_after=45)
+        monkeypatch.setattr(scopus_counter, 'call_scopus_search_api', crashed)
+        with pytest.raises(KeyboardInterrupt):
+            count_issns(ISSNS, csv_file_path, keys_path, max_attempts=3,
+                        base_url=stand_in.base_url)
+        completed = set(read_sink(csv_file_path)['raw_issn'])
+        assert 0 < len(completed) < len(ISSNS)
+
+        resumed = Calls()
+        monkeypatch.setattr(scopus_counter, 'call_scopus_search_api', resumed)
+        unfinished = count_issns(ISSNS, csv_file_path, keys_path,
+                                 max_attempts=3, base_url=stand_in.base_url)
+
+    assert completed.isdisjoint(resumed.issns)
+    assert unfinished == {'given_up': 1, 'retry_queue': 0}
+    with Checkpoint(get_checkpoint_filename(csv_file_path)) as checkpoint:
+        assert checkpoint.given_up(3) == {FAILING}
+        attempts = checkpoint.connection.execute(
+            'SELECT attempts FROM items WHERE item = ?',
+            (FAILING,)).fetchone()[0]
+    assert attempts == 3
+    rows = read_sink(csv_file_path)
+    assert not rows['raw_issn'].duplicated().any()
+    assert set(rows['raw_issn']) == set(ISSNS) - {FAILING}